@@ -0,0 +1,61 @@
+"""
+Benchmark how `hash_dir_by_file` throughput scales with the number of jobs.
+
+Creates a temporary directory of random files and hashes it with an
+increasing number of jobs, printing the files and megabytes hashed per
+second for each. Usage:
+
+    python benchmarks/hash_dir_by_file.py --files 2000 --size 1048576 --jobs 1 2 4 8
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import catalogue.catalogue as ct
+
+
+def make_tree(folder, n_files, size, files_per_dir=1000):
+    for i in range(n_files):
+        subdir = os.path.join(folder, "dir{:05d}".format(i // files_per_dir))
+        os.makedirs(subdir, exist_ok=True)
+        with open(os.path.join(subdir, "file{:07d}.dat".format(i)), "wb") as f:
+            f.write(os.urandom(size))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--files", type=int, default=2000, help="number of files to hash")
+    parser.add_argument("--size", type=int, default=2**20, help="size of each file in bytes")
+    parser.add_argument("--jobs", type=int, nargs="+", default=[1, 2, 4, 8],
+                        help="numbers of jobs to benchmark")
+    parser.add_argument("--repeat", type=int, default=3, help="best of this many runs is reported")
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp(prefix="catalogue-bench-")
+    try:
+        make_tree(folder, args.files, args.size)
+        total_mb = args.files * args.size / 2**20
+        reference = ct.hash_dir_by_file(folder)
+
+        print("{:>6} {:>10} {:>10} {:>10} {:>8}".format("jobs", "seconds", "files/s", "MB/s", "speedup"))
+        baseline = None
+        for jobs in args.jobs:
+            times = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                hashes = ct.hash_dir_by_file(folder, jobs=jobs)
+                times.append(time.perf_counter() - start)
+            assert hashes == reference, "jobs={} changed the hashes".format(jobs)
+            best = min(times)
+            baseline = baseline or best
+            print("{:>6} {:>10.3f} {:>10.0f} {:>10.1f} {:>7.2f}x".format(
+                jobs, best, args.files / best, total_mb / best, baseline / best))
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+    main()
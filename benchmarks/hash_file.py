@@ -0,0 +1,94 @@
+"""
+Micro-benchmark of the `hash_file` read path.
+
+Compares the original read loop (a new 1 KiB `bytes` object per `read`)
+with the current `hash_file` (reused buffer filled with `readinto`, mmap for
+large files) on files of several sizes, checking both give the same digest.
+Files of 1 GiB or more are created sparse, so the benchmark does not need
+that much free disk space and measures the read and hash loop rather than
+the disk. By default files of 1 KiB, 1 MiB, 1 GiB and 10 GiB are timed; pass
+--sizes to time others, e.g. only the small ones for a quick run:
+
+    python benchmarks/hash_file.py --sizes 1K 1M
+"""
+import argparse
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+import catalogue.catalogue as ct
+
+UNITS = {"": 1, "K": 2**10, "M": 2**20, "G": 2**30}
+
+
+def parse_size(text):
+    text = text.upper().rstrip("B")
+    unit = text[-1] if text[-1] in UNITS else ""
+    return int(float(text[:len(text) - len(unit)]) * UNITS[unit])
+
+
+def old_hash_file(filepath, m=None):
+    """
+    hash_file as it was before the read path was rewritten.
+    """
+    if m is None:
+        m = hashlib.sha512()
+    with open(filepath, 'rb') as f:
+        while True:
+            b = f.read(2**10)
+            if not b:
+                break
+            m.update(b)
+    return m
+
+
+def make_file(path, size):
+    with open(path, "wb") as f:
+        if size >= 2**30:
+            f.truncate(size)
+        else:
+            f.write(os.urandom(size))
+
+
+def best_time(func, path, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        digest = func(path).hexdigest()
+        times.append(time.perf_counter() - start)
+    return min(times), digest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--sizes", nargs="+", default=["1K", "1M", "1G", "10G"],
+                        help="file sizes to benchmark, e.g. 1K 1M 10G")
+    parser.add_argument("--repeat", type=int, default=3, help="best of this many runs is reported")
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp(prefix="catalogue-bench-")
+    try:
+        print("{:>8} {:>12} {:>12} {:>10} {:>10} {:>8}".format(
+            "size", "old s", "new s", "old MB/s", "new MB/s", "speedup"))
+        for text in args.sizes:
+            size = parse_size(text)
+            path = os.path.join(folder, "file.dat")
+            make_file(path, size)
+            # small files are timed over many calls to get past timer resolution
+            calls = max(1, 2**24 // max(size, 1))
+            old, old_digest = best_time(lambda p: [old_hash_file(p) for _ in range(calls)][-1], path, args.repeat)
+            new, new_digest = best_time(lambda p: [ct.hash_file(p) for _ in range(calls)][-1], path, args.repeat)
+            assert old_digest == new_digest, "digests differ for {}".format(text)
+            mb = calls * size / 2**20
+            print("{:>8} {:>12.6f} {:>12.6f} {:>10.1f} {:>10.1f} {:>7.2f}x".format(
+                text, old / calls, new / calls, mb / old, mb / new, old / new))
+            os.remove(path)
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Benchmark how prefetching hides filesystem latency when hashing.
+
+Creates a temporary directory of small random files and hashes it with
+`hash_dir_by_file` and `hash_dir_full` at several prefetch depths. Local
+disks answer too quickly to show the effect, so a fixed delay is added to
+every open and first read, as on a network or cloud-backed filesystem, and
+the digests are checked against those hashed without prefetching. Usage:
+
+    python benchmarks/prefetch.py --files 200 --latency 0.005 --prefetch 0 2 8 32
+"""
+import argparse
+import builtins
+import os
+import shutil
+import tempfile
+import time
+
+import catalogue.catalogue as ct
+
+
+class SlowFile:
+    """
+    File wrapper that waits `latency` seconds before its first read.
+    """
+
+    def __init__(self, f, latency):
+        self._f = f
+        self._latency = latency
+
+    def _wait(self):
+        if self._latency:
+            time.sleep(self._latency)
+            self._latency = 0
+
+    def read(self, *args):
+        self._wait()
+        return self._f.read(*args)
+
+    def readinto(self, b):
+        self._wait()
+        return self._f.readinto(b)
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._f.close()
+
+
+def slow_open(latency):
+    def open_(*args, **kwargs):
+        time.sleep(latency)
+        return SlowFile(builtins.open(*args, **kwargs), latency)
+    return open_
+
+
+def make_tree(folder, n_files, size):
+    for i in range(n_files):
+        with open(os.path.join(folder, "file{:06d}.dat".format(i)), "wb") as f:
+            f.write(os.urandom(size))
+
+
+def best_time(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--files", type=int, default=200, help="number of files to hash")
+    parser.add_argument("--size", type=int, default=2**16, help="size of each file in bytes")
+    parser.add_argument("--latency", type=float, default=0.005,
+                        help="seconds added to every open and to every first read")
+    parser.add_argument("--prefetch", type=int, nargs="+", default=[0, 2, 8, 32],
+                        help="prefetch depths to benchmark")
+    parser.add_argument("--repeat", type=int, default=3, help="best of this many runs is reported")
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp(prefix="catalogue-bench-")
+    try:
+        make_tree(folder, args.files, args.size)
+        by_file = ct.hash_dir_by_file(folder)
+        full = ct.hash_dir_full(folder)
+        ct.open = slow_open(args.latency)
+
+        print("{:>9} {:>12} {:>10} {:>12} {:>10}".format(
+            "prefetch", "by file s", "speedup", "full s", "speedup"))
+        baseline = None
+        for prefetch in args.prefetch:
+            t_file, hashes = best_time(lambda: ct.hash_dir_by_file(folder, prefetch=prefetch), args.repeat)
+            t_full, digest = best_time(lambda: ct.hash_dir_full(folder, prefetch=prefetch), args.repeat)
+            assert hashes == by_file and digest == full, "prefetch={} changed the hashes".format(prefetch)
+            baseline = baseline or (t_file, t_full)
+            print("{:>9} {:>12.3f} {:>9.2f}x {:>12.3f} {:>9.2f}x".format(
+                prefetch, t_file, baseline[0] / t_file, t_full, baseline[1] / t_full))
+    finally:
+        vars(ct).pop("open", None)
+        shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+"""
+Scalability benchmarks of the hashing, storage and compare paths.
+
+`run` times each function on synthetic data of increasing size, and the
+whole `engage` -> `disengage` -> `compare` cycle through the command line,
+and saves the results as JSON. `compare` reads two result files and lists
+the benchmarks that got slower, exiting with status 1 if any slowed down by
+more than the threshold, so it can gate a release. Usage:
+
+    python benchmarks/suite.py run --scale quick --output before.json
+    (change the code)
+    python benchmarks/suite.py run --scale quick --output after.json
+    python benchmarks/suite.py compare before.json after.json --threshold 0.2
+
+Scales (the largest trees and files take a long time and a lot of inodes):
+
+    quick    trees of 10 to 10^3 files, files of 1 B to 1 MiB, 10^3 CSV rows
+    default  trees of 10 to 10^5 files, files of 1 B to 1 GiB, 10^5 CSV rows
+    full     trees of 10 to 10^6 files, files of 1 B to 50 GiB, 10^6 CSV rows
+
+Files of 1 GiB or more are sparse (see `synthetic.py`), so they time the
+read and hash loop rather than the disk. Use --only to run the benchmarks
+whose names match a regular expression, such as --only "hash_file|csv".
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import catalogue
+import catalogue.catalogue as ct
+from catalogue.compare import compare_hashes
+from catalogue.parser import main as catalogue_main
+
+from synthetic import make_catalogue, make_file, make_record, make_tree, parse_size, timestamps
+
+SCALES = {
+    "quick": {
+        "tree_files": [10, 1000],
+        "file_sizes": ["1", "1K", "1M"],
+        "records": [10, 1000],
+        "csv_rows": [10, 1000],
+        "e2e_files": [10, 100],
+    },
+    "default": {
+        "tree_files": [10, 1000, 100000],
+        "file_sizes": ["1", "1K", "1M", "100M", "1G"],
+        "records": [10, 1000, 100000],
+        "csv_rows": [10, 1000, 100000],
+        "e2e_files": [100, 10000],
+    },
+    "full": {
+        "tree_files": [10, 1000, 100000, 1000000],
+        "file_sizes": ["1", "1K", "1M", "100M", "1G", "10G", "50G"],
+        "records": [10, 1000, 100000, 1000000],
+        "csv_rows": [10, 1000, 100000, 1000000],
+        "e2e_files": [100, 10000, 1000000],
+    },
+}
+
+# size of each file in the benchmark trees
+TREE_FILE_SIZE = 1024
+
+
+def best_time(func, repeat, setup=None):
+    """
+    Return the shortest of repeat timings of func(), calling setup() untimed
+    before each.
+    """
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def quiet(func):
+    """
+    Wrap func to discard what it prints.
+    """
+    def quiet_func(*args, **kwargs):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return func(*args, **kwargs)
+    return quiet_func
+
+
+class Runner:
+    """
+    Runs the benchmarks selected by a regular expression and collects their
+    results.
+    """
+
+    def __init__(self, workdir, repeat, only=None):
+        self.workdir = workdir
+        self.repeat = repeat
+        self.only = re.compile(only) if only else None
+        self.results = {}
+
+    def wanted(self, name):
+        return self.only is None or self.only.search(name) is not None
+
+    def run(self, name, func, n, unit, setup=None, repeat=None):
+        if not self.wanted(name):
+            return
+        seconds = best_time(func, repeat or self.repeat, setup)
+        self.results[name] = {"seconds": seconds, "n": n, "unit": unit,
+                              "per_second": n / seconds if seconds > 0 else None}
+        print("{:<40} {:>12.6f} s {:>14.1f} {}/s".format(name, seconds, n / seconds if seconds > 0 else 0, unit))
+        sys.stdout.flush()
+
+    def path(self, *parts):
+        return os.path.join(self.workdir, *parts)
+
+
+def bench_files(runner, sizes):
+    for text in sizes:
+        name = "hash_file[{}]".format(text)
+        if not runner.wanted(name):
+            continue
+        size = parse_size(text)
+        path = runner.path("file.dat")
+        make_file(path, size)
+        # small files are timed over many calls to get past timer resolution
+        calls = max(1, min(10000, 2**24 // max(size, 1)))
+        runner.run(name, lambda: [ct.hash_file(path) for _ in range(calls)], calls * size, "bytes")
+        os.remove(path)
+
+
+def bench_trees(runner, counts):
+    for n in counts:
+        names = ["{}[{}]".format(func, n) for func in ["modified_walk", "hash_dir_full", "hash_dir_by_file"]]
+        if not any(runner.wanted(name) for name in names):
+            continue
+        folder = runner.path("tree")
+        make_tree(folder, n, TREE_FILE_SIZE)
+        repeat = 1 if n >= 100000 else None
+        runner.run(names[0], lambda: sum(1 for _ in ct.modified_walk(folder)), n, "files", repeat=repeat)
+        runner.run(names[1], lambda: ct.hash_dir_full(folder), n, "files", repeat=repeat)
+        runner.run(names[2], lambda: ct.hash_dir_by_file(folder), n, "files", repeat=repeat)
+        shutil.rmtree(folder)
+
+
+def bench_records(runner, counts):
+    for n in counts:
+        record_1 = make_record(n)
+        record_2 = make_record(n, version=1)
+        store = runner.path("records")
+        runner.run("store_hash[{}]".format(n), lambda: ct.store_hash(record_1, "record", store), n, "outputs")
+        path = os.path.join(store, "record.json")
+        if os.path.exists(path):
+            runner.run("load_hash[{}]".format(n), lambda: ct.load_hash(path), n, "outputs")
+        runner.run("compare_hashes[{}]".format(n), lambda: compare_hashes(record_1, record_2), n, "outputs")
+        if os.path.exists(store):
+            shutil.rmtree(store)
+
+
+def bench_catalogues(runner, counts):
+    for n in counts:
+        names = ["save_csv[{}]".format(n), "load_csv[{}]".format(n)]
+        if not any(runner.wanted(name) for name in names):
+            continue
+        path = runner.path("catalogue.csv")
+        ids = make_catalogue(path, n)
+        record = make_record(1, engage=ids[-1], disengage=ids[-1])
+        new_id = timestamps(n + 1)[-1]
+        # appending one record to a catalogue of n rows, and loading the last
+        runner.run(names[0], lambda: quiet(ct.save_csv)(record, new_id, path), 1, "rows")
+        runner.run(names[1], lambda: ct.load_csv(path, ids[-1]), n, "rows")
+        os.remove(path)
+
+
+def bench_end_to_end(runner, counts):
+    for n in counts:
+        name = "engage_disengage_compare[{}]".format(n)
+        if not runner.wanted(name):
+            continue
+        project = runner.path("project")
+        code = os.path.join(project, "code")
+        os.makedirs(code)
+        for command in [["init", "-q"], ["commit", "-q", "--allow-empty", "-m", "benchmark"]]:
+            subprocess.run(["git", "-c", "user.name=bench", "-c", "user.email=bench@example.com"] + command,
+                           cwd=code, check=True)
+        make_tree(os.path.join(project, "data"), n, TREE_FILE_SIZE)
+        make_tree(os.path.join(project, "results"), max(n // 10, 1), TREE_FILE_SIZE)
+        results = os.path.join(project, "catalogue_results")
+        paths = ["--input_data", os.path.join(project, "data"), "--code", code, "--catalogue_results", results,
+                 "--no_cache"]
+        outputs = ["--output_data", os.path.join(project, "results")]
+
+        def cycle():
+            cli("engage", *paths)
+            cli("disengage", *(paths + outputs))
+            record = [entry for entry in os.listdir(results) if entry.endswith(".json")][0]
+            cli("compare", *(paths + outputs + [os.path.join(results, record)]))
+
+        def clean():
+            shutil.rmtree(results, ignore_errors=True)
+            # records are named by the second they are made in
+            time.sleep(1)
+
+        runner.run(name, cycle, n, "files", setup=clean, repeat=1 if n >= 100000 else None)
+        shutil.rmtree(project)
+
+
+def cli(*argv):
+    """
+    Run the catalogue command line, discarding what it prints.
+    """
+    saved = sys.argv
+    sys.argv = ["catalogue"] + list(argv)
+    try:
+        quiet(catalogue_main)()
+    finally:
+        sys.argv = saved
+
+
+def run(args):
+    scale = SCALES[args.scale]
+    workdir = tempfile.mkdtemp(prefix="catalogue-bench-", dir=args.tmpdir)
+    runner = Runner(workdir, args.repeat, args.only)
+    # the command line reads catalogue_config.yaml from the working directory
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        bench_files(runner, scale["file_sizes"])
+        bench_trees(runner, scale["tree_files"])
+        bench_records(runner, scale["records"])
+        bench_catalogues(runner, scale["csv_rows"])
+        bench_end_to_end(runner, scale["e2e_files"])
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+    output = {
+        "meta": {
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "scale": args.scale,
+            "repeat": args.repeat,
+            "catalogue": catalogue.__version__,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "results": runner.results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=2, sort_keys=True)
+    print("results saved to {}".format(args.output))
+
+
+def compare_results(before, after, threshold, min_seconds):
+    """
+    Compare two sets of benchmark results.
+
+    Parameters
+    ----------
+    before, after : dict
+        the "results" of two result files
+    threshold : float
+        relative slowdown above which a benchmark counts as a regression
+    min_seconds : float
+        benchmarks that changed by less than this many seconds are noise
+
+    Returns
+    -------
+    tuple (list of str, list of str)
+        lines of the comparison table, and the names of the regressions
+    """
+    lines = ["{:<40} {:>12} {:>12} {:>8}".format("benchmark", "before s", "after s", "change")]
+    regressions = []
+    for name in sorted(before.keys() | after.keys()):
+        if name not in before or name not in after:
+            lines.append("{:<40} {:>12} {:>12}".format(
+                name, "{:.6f}".format(before[name]["seconds"]) if name in before else "-",
+                "{:.6f}".format(after[name]["seconds"]) if name in after else "-"))
+            continue
+        old = before[name]["seconds"]
+        new = after[name]["seconds"]
+        change = new / old - 1 if old > 0 else 0
+        flag = ""
+        if change > threshold and new - old > min_seconds:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        lines.append("{:<40} {:>12.6f} {:>12.6f} {:>+7.0%}{}".format(name, old, new, change, flag))
+    return lines, regressions
+
+
+def compare(args):
+    results = []
+    for path in [args.before, args.after]:
+        with open(path) as f:
+            results.append(json.load(f))
+    for key in ["scale", "platform", "cpus"]:
+        if results[0]["meta"].get(key) != results[1]["meta"].get(key):
+            print("NOTE the results differ in {}: {} and {}".format(
+                key, results[0]["meta"].get(key), results[1]["meta"].get(key)))
+    lines, regressions = compare_results(results[0]["results"], results[1]["results"], args.threshold,
+                                         args.min_seconds)
+    print("\n".join(lines))
+    if regressions:
+        print("\n{} benchmarks slowed down by more than {:.0%}".format(len(regressions), args.threshold))
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_parser = subparsers.add_parser("run", help="run the benchmarks and save the results")
+    run_parser.add_argument("--scale", choices=sorted(SCALES), default="quick", help="size of the synthetic data")
+    run_parser.add_argument("--only", help="only run benchmarks whose names match this regular expression")
+    run_parser.add_argument("--repeat", type=int, default=3, help="best of this many runs is reported")
+    run_parser.add_argument("--output", default="benchmark.json", help="file to save the results in")
+    run_parser.add_argument("--tmpdir", help="where to create the synthetic data (default is the system default)")
+    run_parser.set_defaults(func=run)
+    compare_parser = subparsers.add_parser("compare", help="compare two result files")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+    compare_parser.add_argument("--threshold", type=float, default=0.1,
+                                help="relative slowdown counted as a regression (default 0.1, 10%%)")
+    compare_parser.add_argument("--min_seconds", type=float, default=0.001,
+                                help="ignore changes smaller than this many seconds (default 0.001)")
+    compare_parser.set_defaults(func=compare)
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+Synthetic data for the benchmarks: directory trees, large files, hash
+records and CSV catalogues of a given size.
+
+Used by `suite.py`, and can also be run on its own to create a tree to
+benchmark by hand. Usage:
+
+    python benchmarks/synthetic.py tree /tmp/tree --files 100000 --size 1K
+"""
+import argparse
+import csv
+import hashlib
+import os
+from datetime import datetime, timedelta
+
+UNITS = {"": 1, "K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+
+# files of at least this size are created sparse, so the benchmarks do not
+# need that much free disk space (and time the hashing rather than the disk)
+SPARSE_SIZE = 2**30
+
+
+def parse_size(text):
+    """
+    Return the number of bytes in a size such as "10", "1K", "2.5M" or "10G".
+    """
+    text = str(text).upper().rstrip("B")
+    unit = text[-1] if text[-1] in UNITS else ""
+    return int(float(text[:len(text) - len(unit)]) * UNITS[unit])
+
+
+def make_file(path, size):
+    """
+    Create a file of size random bytes, or a sparse file of zeros if it is
+    at least `SPARSE_SIZE`.
+    """
+    with open(path, "wb") as f:
+        if size >= SPARSE_SIZE:
+            f.truncate(size)
+        else:
+            f.write(os.urandom(size))
+
+
+def make_tree(folder, n_files, size=1024, files_per_dir=1000, dirs_per_dir=100):
+    """
+    Create n_files files of size bytes under folder.
+
+    Files are spread over directories of at most files_per_dir files, which
+    are grouped in parent directories of at most dirs_per_dir directories,
+    so large trees are several levels deep like real datasets.
+
+    Returns
+    -------
+    int
+        total size in bytes
+    """
+    for i in range(n_files):
+        leaf = i // files_per_dir
+        subdir = os.path.join(folder, "group{:04d}".format(leaf // dirs_per_dir), "dir{:06d}".format(leaf))
+        if i % files_per_dir == 0:
+            os.makedirs(subdir, exist_ok=True)
+        make_file(os.path.join(subdir, "file{:08d}.dat".format(i)), size)
+    return n_files * size
+
+
+def timestamps(n, start=datetime(2020, 1, 1)):
+    """
+    Return n distinct timestamps in the format of `create_timestamp`.
+    """
+    return [(start + timedelta(seconds=i)).strftime("%Y%m%d-%H%M%S") for i in range(n)]
+
+
+def make_record(n_outputs, version=0, engage="20200101-000000", disengage="20200101-000001"):
+    """
+    Return a hash record with n_outputs output files.
+
+    Records made with different versions differ in every tenth output file.
+    """
+    digest = lambda key: "sha512:" + hashlib.sha512(repr(key).encode()).hexdigest()
+    return {
+        "timestamp": {"engage": engage, "disengage": disengage},
+        "input_data": {"data": digest(("data", version))},
+        "code": {"code": "{:040x}".format(12345)},
+        "output_data": {"results": {"results/file{:08d}.dat".format(i): digest((i, version if i % 10 == 0 else 0))
+                                    for i in range(n_outputs)}},
+    }
+
+
+def make_catalogue(path, n_rows, n_outputs=1):
+    """
+    Write a CSV catalogue of n_rows records, as written by `save_csv`, each
+    with n_outputs output files.
+
+    Returns
+    -------
+    list of str
+        the id of each row
+    """
+    headers = ["id", "disengage", "engage", "input_data", "input_hash",
+               "code", "code_hash", "output_data", "output_file1", "output_hash1"]
+    ids = timestamps(n_rows)
+    record = make_record(n_outputs)
+    outputs = [item for pair in record["output_data"]["results"].items() for item in pair]
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(headers)
+        for row_id in ids:
+            writer.writerow([row_id, row_id, row_id, "data", record["input_data"]["data"],
+                             "code", record["code"]["code"], "results"] + outputs)
+    return ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    subparsers = parser.add_subparsers(dest="kind", required=True)
+    tree = subparsers.add_parser("tree", help="a directory tree of random files")
+    tree.add_argument("folder")
+    tree.add_argument("--files", type=int, default=1000, help="number of files")
+    tree.add_argument("--size", default="1K", help="size of each file, e.g. 100 1K 1M")
+    big = subparsers.add_parser("file", help="a single file, sparse from 1G")
+    big.add_argument("path")
+    big.add_argument("--size", default="1G", help="size of the file, e.g. 1M 10G")
+    catalogue = subparsers.add_parser("csv", help="a CSV catalogue")
+    catalogue.add_argument("path")
+    catalogue.add_argument("--rows", type=int, default=10000, help="number of records")
+    args = parser.parse_args()
+
+    if args.kind == "tree":
+        os.makedirs(args.folder, exist_ok=True)
+        make_tree(args.folder, args.files, parse_size(args.size))
+    elif args.kind == "file":
+        make_file(args.path, parse_size(args.size))
+    else:
+        make_catalogue(args.path, args.rows)
+
+
+if __name__ == "__main__":
+    main()
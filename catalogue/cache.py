@@ -0,0 +1,246 @@
+import os
+import time
+import hashlib
+import sqlite3
+
+CACHE_NAME = "digest_cache.sqlite"
+DEFAULT_CACHE_SIZE = 1000000
+
+# files modified this recently (in seconds) are hashed but not cached: a write
+# landing within the filesystem timestamp resolution would not change the key
+RACY_WINDOW = 2
+
+# set to a dict by `catalogue daemon`, so that each digest cache is opened
+# once and kept open between commands
+_open_caches = None
+
+
+def stat_key(st):
+    """
+    Return the part of a stat result that identifies a version of a file.
+
+    Parameters
+    ----------
+    st : os.stat_result
+
+    Returns
+    -------
+    tuple (int, int, int, int, int)
+        (device, inode, size, mtime_ns, ctime_ns)
+    """
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+
+
+class DigestCache:
+    """
+    On-disk cache of file digests keyed on file metadata.
+
+    Digests are stored in an SQLite database (by default
+    `catalogue_results/digest_cache.sqlite`) keyed on the device, inode, size,
+    modification time, change time and hash algorithm of each file, so a file
+    is only read again once any of these change. Each batch of new digests is
+    committed in a transaction, so a crash can lose at most the digests
+    computed since the last commit and never leaves a partial entry. Once the
+    cache holds more than `max_entries` digests, the least recently used are
+    evicted.
+
+    Parameters
+    ----------
+    path : str
+        path to the cache database
+    max_entries : int, optional
+        maximum number of digests kept in the cache
+    verify : bool, optional
+        if True, every cache hit is checked by hashing the file again and
+        mismatches are reported and corrected
+
+    Attributes
+    ----------
+    keep_open : bool
+        if True, `close` commits but leaves the database open, so the cache
+        can be used again after `restart`
+    """
+
+    def __init__(self, path, max_entries=DEFAULT_CACHE_SIZE, verify=False):
+        self.path = path
+        self.keep_open = False
+        self.restart(max_entries, verify)
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = None
+        try:
+            self._connect()
+        except sqlite3.DatabaseError:
+            # a damaged cache only costs a re-hash, so start again from scratch,
+            # without the write-ahead log of the damaged database
+            if self._db is not None:
+                self._db.close()
+            for damaged in [path, path + "-wal", path + "-shm"]:
+                if os.path.exists(damaged):
+                    os.remove(damaged)
+            self._connect()
+
+    def restart(self, max_entries=DEFAULT_CACHE_SIZE, verify=False):
+        """
+        Start a new run, as if the cache had just been opened: recently
+        modified files are judged from now, and the counts of hits, misses
+        and mismatches start again from zero.
+        """
+        assert isinstance(max_entries, int) and max_entries >= 1, "cache size must be a positive integer"
+
+        self.max_entries = max_entries
+        self.verify = verify
+        self.hits = 0
+        self.misses = 0
+        self.mismatches = []
+        self._started = time.time()
+
+    def _connect(self):
+        self._db = sqlite3.connect(self.path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, ctime_ns INTEGER,"
+            "algorithm TEXT, digest TEXT NOT NULL, last_used REAL NOT NULL,"
+            "PRIMARY KEY (dev, ino, size, mtime_ns, ctime_ns, algorithm))")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS trees ("
+            "key TEXT, algorithm TEXT, digest TEXT NOT NULL, last_used REAL NOT NULL,"
+            "PRIMARY KEY (key, algorithm))")
+        self._db.execute("CREATE INDEX IF NOT EXISTS files_last_used ON files (last_used)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS trees_last_used ON trees (last_used)")
+        self._db.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _cacheable(self, st):
+        return st.st_mtime < self._started - RACY_WINDOW
+
+    def lookup(self, st, algorithm="sha512"):
+        """
+        Return the cached digest for the file with stat result `st`, or None.
+        """
+        row = self._db.execute(
+            "SELECT digest FROM files WHERE dev=? AND ino=? AND size=? AND mtime_ns=?"
+            " AND ctime_ns=? AND algorithm=?", stat_key(st) + (algorithm,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._db.execute(
+            "UPDATE files SET last_used=? WHERE dev=? AND ino=? AND size=? AND mtime_ns=?"
+            " AND ctime_ns=? AND algorithm=?", (self._started,) + stat_key(st) + (algorithm,))
+        return row[0]
+
+    def store(self, st, digest, algorithm="sha512"):
+        """
+        Cache the digest of the file with stat result `st`.
+        """
+        if self._cacheable(st):
+            self._db.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                stat_key(st) + (algorithm, digest, self._started))
+
+    def lookup_tree(self, stats, algorithm="sha512"):
+        """
+        Return the cached digest for the sequence of files with stat results
+        `stats` hashed in order, or None.
+        """
+        key = self._tree_key(stats)
+        row = self._db.execute(
+            "SELECT digest FROM trees WHERE key=? AND algorithm=?", (key, algorithm)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._db.execute(
+            "UPDATE trees SET last_used=? WHERE key=? AND algorithm=?", (self._started, key, algorithm))
+        return row[0]
+
+    def store_tree(self, stats, digest, algorithm="sha512"):
+        """
+        Cache the digest of the sequence of files with stat results `stats`.
+        """
+        if all(self._cacheable(st) for st in stats):
+            self._db.execute(
+                "INSERT OR REPLACE INTO trees VALUES (?, ?, ?, ?)",
+                (self._tree_key(stats), algorithm, digest, self._started))
+
+    @staticmethod
+    def _tree_key(stats):
+        m = hashlib.sha256()
+        for st in stats:
+            m.update("{}:{}:{}:{}:{};".format(*stat_key(st)).encode())
+        return m.hexdigest()
+
+    def check(self, path, cached, digest):
+        """
+        Record a mismatch between a cached digest and a freshly computed one.
+        """
+        if cached != digest:
+            self.mismatches.append(path)
+            print("Cached digest for {} is out of date, replacing it".format(path))
+
+    def commit(self):
+        self._db.commit()
+
+    def evict(self):
+        """
+        Drop the least recently used digests beyond `max_entries`.
+        """
+        for table in ["files", "trees"]:
+            n = self._db.execute("SELECT COUNT(*) FROM {}".format(table)).fetchone()[0]
+            if n > self.max_entries:
+                self._db.execute(
+                    "DELETE FROM {0} WHERE rowid IN "
+                    "(SELECT rowid FROM {0} ORDER BY last_used LIMIT ?)".format(table),
+                    (n - self.max_entries,))
+
+    def close(self):
+        if self._db is not None:
+            self.evict()
+            self._db.commit()
+            if self.keep_open:
+                return
+            self._db.close()
+            self._db = None
+
+
+def open_cache(args):
+    """
+    Open the digest cache in `catalogue_results` if the command uses one.
+
+    Parameters
+    ----------
+    args : obj
+        Command line input arguments (argparse.Namespace).
+
+    Returns
+    -------
+    DigestCache or None
+    """
+    if not getattr(args, "cache", False):
+        return None
+    path = os.path.join(args.catalogue_results, CACHE_NAME)
+    max_entries = getattr(args, "cache_size", DEFAULT_CACHE_SIZE)
+    verify = getattr(args, "verify_cache", False)
+    if _open_caches is None:
+        return DigestCache(path, max_entries=max_entries, verify=verify)
+    key = os.path.abspath(path)
+    cache = _open_caches.get(key)
+    # a cache whose database has been deleted is opened again
+    if cache is not None and os.path.exists(path):
+        cache.restart(max_entries, verify)
+        return cache
+    if cache is not None:
+        cache.keep_open = False
+        cache.close()
+    cache = _open_caches[key] = DigestCache(path, max_entries=max_entries, verify=verify)
+    cache.keep_open = True
+    return cache
@@ -1,14 +1,212 @@
 import os
+import sys
+import stat
+import mmap
 import json
 import csv
-from itertools import chain
+import io
+import zlib
+import base64
+import threading
+import time
+import tarfile
+import zipfile
+from collections import deque
+from itertools import chain, islice
 import hashlib
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 import git
 from git import InvalidGitRepositoryError, RepositoryDirtyError
 from .utils import prune_files
+from .cache import open_cache, stat_key
+from .ignore import IgnoreMatcher, active_patterns
+from .progress import Progress, scan_size, reading, report_read
+from .checkpoint import Checkpoint, checkpoint_path
+from .manifest import ManifestWriter, MANIFEST_BATCH, manifest_name
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+DEFAULT_ALGORITHM = "sha512"
+
+# set to dicts by `catalogue daemon`, so that git repositories and thread
+# pools are kept open between commands
+_open_repos = None
+_pools = None
+
+# hash algorithms that can be selected, by the name recorded in digests
+ALGORITHMS = {
+    "sha512": hashlib.sha512,
+    "sha256": hashlib.sha256,
+    "blake2b": hashlib.blake2b,
+    "blake2s": hashlib.blake2s,
+}
+if xxhash is not None:
+    # much faster, but not a cryptographic hash
+    ALGORITHMS["xxh3_128"] = xxhash.xxh3_128
+
+# ways of hashing an input directory, see hash_input
+INPUT_MODES = ["full", "merkle"]
+
+# ways of storing the manifest of input files, see pack_manifest
+INPUT_MANIFESTS = ["none", "plain", "compressed"]
+
+# what identifies the code, see hash_code
+CODE_IDENTITIES = ["commit", "tree"]
+
+# extension of the sidecar index of a CSV file, see index_csv
+CSV_INDEX_EXT = "index"
+
+# seconds to wait for other processes appending to a CSV file, see save_csv_many
+CSV_LOCK_TIMEOUT = 60
+
+# hash_file reads files in chunks of between MIN_CHUNK_SIZE and MAX_CHUNK_SIZE
+# bytes, and hashes regular files of at least MMAP_THRESHOLD bytes through mmap
+MIN_CHUNK_SIZE = 2**16
+MAX_CHUNK_SIZE = 2**22
+MMAP_THRESHOLD = 2**26
+
+# fingerprints hash the size, the first and last blocks and this many blocks
+# sampled in between, see fingerprint_file
+FINGERPRINT_BLOCK = 2**20
+FINGERPRINT_SAMPLES = 62
+
+# content-defined chunks, see hash_chunks: a chunk ends where the last
+# CDC_WINDOW bytes, each mapped to one bit, spell out a fixed pattern, so
+# chunks average about CDC_MIN_CHUNK + 2**CDC_WINDOW bytes
+CDC_MIN_CHUNK = 2**18
+CDC_MAX_CHUNK = 2**23
+CDC_WINDOW = 20
+CDC_READ_SIZE = 2**22
+# bytes of each chunk digest kept in the chunk table
+CDC_DIGEST_SIZE = 16
+
+# archives whose members can be hashed, see hash_archive
+ARCHIVE_EXTS = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz", ".zip")
+# gaps between reads of an archive up to this size are read again to keep
+# hashing the archive in order, see _HashingReader
+ARCHIVE_GAP = 2**16
+
+# read buffer reused by every hash_file call on the same thread
+_buffers = threading.local()
+
+
+def new_hash(algorithm=DEFAULT_ALGORITHM):
+    '''
+    Create a new hash object for a named algorithm
+
+    Parameters
+    ----------
+    algorithm : str, optional
+        name of the hash algorithm, one of `ALGORITHMS` (default is sha512)
+
+    Returns
+    -------
+    hash object
+    '''
+    assert algorithm in ALGORITHMS, "Hash algorithm {} is not available, choose one of {}".format(
+        algorithm, ", ".join(sorted(ALGORITHMS)))
+    return ALGORITHMS[algorithm]()
+
+
+def format_digest(hexdigest, algorithm=DEFAULT_ALGORITHM, mode=None):
+    '''
+    Label a hex digest with how it was produced
+
+    Digests are stored as "<label>:<hex digest>", where the label is the
+    algorithm, prefixed with "<mode>-" for digests that are not a plain hash
+    of the contents (such as "merkle-sha512" for a Merkle tree digest).
+    Plain sha512 digests are stored as the bare hex digest, so records made
+    before the algorithm could be chosen remain valid.
+
+    Parameters
+    ----------
+    hexdigest : str
+    algorithm : str, optional
+    mode : str, optional
+
+    Returns
+    -------
+    str
+    '''
+    label = algorithm if mode is None else "{}-{}".format(mode, algorithm)
+    if label == DEFAULT_ALGORITHM:
+        return hexdigest
+    return "{}:{}".format(label, hexdigest)
+
+
+def split_digest(digest):
+    '''
+    Split a digest created by `format_digest` into label and hex digest
+
+    Parameters
+    ----------
+    digest : str
+
+    Returns
+    -------
+    tuple (str, str)
+    '''
+    if ":" in digest:
+        label, hexdigest = digest.split(":", 1)
+        return label, hexdigest
+    return DEFAULT_ALGORITHM, digest
 
 
-def hash_file(filepath, m=None):
+def split_label(label):
+    '''
+    Split the label of a digest into mode and algorithm
+
+    Parameters
+    ----------
+    label : str
+
+    Returns
+    -------
+    tuple (str or None, str)
+        mode is None for a plain hash of the contents
+    '''
+    if "-" in label:
+        mode, algorithm = label.split("-", 1)
+        return mode, algorithm
+    return None, label
+
+
+def check_digest(digest):
+    '''
+    Check that a digest is well formed
+
+    The hex digest must be hexadecimal and, if its algorithm is available,
+    of the length that algorithm produces.
+
+    Parameters
+    ----------
+    digest : str
+
+    Returns
+    -------
+    bool
+    '''
+    label, hexdigest = split_digest(digest)
+    algorithm = split_label(label)[1]
+    try:
+        int(hexdigest, 16)
+    except ValueError:
+        return False
+    if algorithm in ALGORITHMS:
+        return len(hexdigest) == 2 * new_hash(algorithm).digest_size
+    return True
+
+
+def hash_file(filepath, m=None, algorithm=DEFAULT_ALGORITHM):
     '''
     Hash the contents of a file
 
@@ -18,6 +216,8 @@ def hash_file(filepath, m=None):
         A string pointing to the file you want to hash
     m : hashlib hash object, optional (default is None to create a new object)
         hash_file updates m with the contents of filepath and returns m
+    algorithm : str, optional
+        hash algorithm used to create a new object (default is sha512)
 
     Returns
     -------
@@ -27,57 +227,508 @@ def hash_file(filepath, m=None):
 
 
     if m is None:
-        m = hashlib.sha512()
+        m = new_hash(algorithm)
+
+    with open(filepath, 'rb', buffering=0) as f:
+        return _hash_open_file(f, m)
+
+
+def fingerprint_file(filepath, m=None, algorithm=DEFAULT_ALGORITHM):
+    '''
+    Hash a fingerprint of the contents of a file
+
+    The fingerprint is the file size, its first and last `FINGERPRINT_BLOCK`
+    bytes and `FINGERPRINT_SAMPLES` blocks in between, so hashing it reads at
+    most 64 MiB however large the file is. The file is split into that many
+    equal stretches and one block is read from each, at an offset within the
+    stretch that depends only on the file size, so the same file always gives
+    the same fingerprint. Files too small to sample are hashed in full (along
+    with their size).
+
+    A fingerprint is a much weaker guarantee than a hash of the contents: it
+    detects a file being replaced, truncated or extended, but not a change
+    confined to bytes that are not sampled.
+
+    Parameters
+    ----------
+    filepath : str
+        A string pointing to the file you want to fingerprint
+    m : hashlib hash object, optional (default is None to create a new object)
+        fingerprint_file updates m with the fingerprint and returns m
+    algorithm : str, optional
+        hash algorithm used to create a new object (default is sha512)
+
+    Returns
+    -------
+    hashlib hash object
+    '''
+    assert os.path.exists(filepath), "Path {} does not exist".format(filepath)
+
+    if m is None:
+        m = new_hash(algorithm)
+
+    with open(filepath, 'rb', buffering=0) as f:
+        size = os.fstat(f.fileno()).st_size
+        m.update(b"fingerprint\0" + size.to_bytes(8, "little"))
+        with memoryview(_buffer(FINGERPRINT_BLOCK))[:FINGERPRINT_BLOCK] as view:
+            for offset in _fingerprint_offsets(size):
+                f.seek(offset)
+                n = 0
+                while n < FINGERPRINT_BLOCK:
+                    read = f.readinto(view[n:])
+                    if not read:
+                        break
+                    n += read
+                m.update(view[:n])
+    return m
+
+
+def _fingerprint_offsets(size):
+    """
+    Return the offsets of the blocks hashed by fingerprint_file.
+    """
+    if size <= (FINGERPRINT_SAMPLES + 2) * FINGERPRINT_BLOCK:
+        return range(0, size, FINGERPRINT_BLOCK)
+    stretch = (size - 2 * FINGERPRINT_BLOCK) // FINGERPRINT_SAMPLES
+    offsets = [0]
+    for i in range(FINGERPRINT_SAMPLES):
+        seed = hashlib.sha256("{}:{}".format(size, i).encode()).digest()
+        start = FINGERPRINT_BLOCK + i * stretch
+        offsets.append(start + int.from_bytes(seed[:8], "little") % (stretch - FINGERPRINT_BLOCK + 1))
+    offsets.append(size - FINGERPRINT_BLOCK)
+    return offsets
+
+
+def _cdc_table():
+    """
+    Return the translation table from bytes to bits and the boundary pattern
+    of content-defined chunking, derived from fixed seeds.
+    """
+    seed = hashlib.sha256(b"catalogue content-defined chunking").digest()
+    table = bytes(seed[i // 8] >> i % 8 & 1 for i in range(256))
+    seed = hashlib.sha512(b"catalogue content-defined chunking pattern").digest()
+    return table, bytes(seed[i // 8] >> i % 8 & 1 for i in range(CDC_WINDOW))
+
+
+def hash_chunks(filepath, algorithm=DEFAULT_ALGORITHM):
+    '''
+    Hash the contents of a file, and each of its content-defined chunks
+
+    The file is split into chunks at boundaries that depend only on the bytes
+    just before them: each byte is mapped to one bit, and a chunk ends where
+    the bits of the last `CDC_WINDOW` bytes match a fixed pattern (keeping
+    chunks between `CDC_MIN_CHUNK` and `CDC_MAX_CHUNK` bytes). An
+    edit therefore only changes the chunks around it, and the chunks after
+    an insertion or deletion are the same as before, just moved. Both the
+    mapping and the search for the pattern run in C (`bytes.translate` and
+    `bytearray.find`), so this is much faster than a rolling hash computed
+    byte by byte in Python.
+
+    The file is read once: the digest of the whole file is the same as from
+    `hash_file`.
+
+    Parameters
+    ----------
+    filepath : str
+        A string pointing to the file you want to hash
+    algorithm : str, optional
+        hash algorithm (default is sha512)
+
+    Returns
+    -------
+    tuple (hashlib hash object, list of (int, bytes))
+        hash of the whole file, and the length and digest of each chunk
+    '''
+    assert os.path.exists(filepath), "Path {} does not exist".format(filepath)
+
+    table, pattern = _cdc_table()
+    m = new_hash(algorithm)
+    chunks = []
+    pending = bytearray()
+    bits = bytearray()
+    with open(filepath, 'rb', buffering=0) as f:
+        while True:
+            block = f.read(CDC_READ_SIZE)
+            m.update(block)
+            report_read(len(block))
+            pending += block
+            bits += block.translate(table)
+            start = 0
+            with memoryview(pending) as view:
+                while start < len(pending):
+                    end = bits.find(pattern, start + max(CDC_MIN_CHUNK - len(pattern), 0),
+                                    start + CDC_MAX_CHUNK)
+                    if end != -1:
+                        end += len(pattern)
+                    elif len(pending) - start >= CDC_MAX_CHUNK:
+                        end = start + CDC_MAX_CHUNK
+                    elif not block:
+                        end = len(pending)
+                    else:
+                        break
+                    m_chunk = new_hash(algorithm)
+                    m_chunk.update(view[start:end])
+                    chunks.append((end - start, m_chunk.digest()[:CDC_DIGEST_SIZE]))
+                    start = end
+            del pending[:start]
+            del bits[:start]
+            if not block:
+                break
+    return m, chunks
+
+
+def is_archive(filepath):
+    """
+    Return True if filepath has the extension of an archive `hash_archive`
+    can read.
+    """
+    return filepath.lower().endswith(ARCHIVE_EXTS)
+
+
+def hash_archive(filepath, algorithm=DEFAULT_ALGORITHM):
+    '''
+    Hash the contents of a tar or zip archive, and of each file inside it
+
+    The archive is read with `tarfile` or `zipfile` straight from disk,
+    without extracting anything. Tar archives (compressed or not) are read
+    as a stream, and the bytes read are also fed to the hash of the whole
+    archive, so the archive is read once. A zip archive is read from its
+    central directory at the end, then member by member; the members are
+    normally stored in order, so only the central directory is read twice.
+
+    The digest of the whole archive is the same as from `hash_file`.
 
+    Parameters
+    ----------
+    filepath : str
+        A string pointing to the archive
+    algorithm : str, optional
+        hash algorithm (default is sha512)
+
+    Returns
+    -------
+    tuple (hashlib hash object, dict (str : str))
+        hash of the whole archive, and the digest of each regular file in it
+        keyed on its name in the archive, or None if the archive cannot be
+        read
+    '''
+    assert os.path.exists(filepath), "Path {} does not exist".format(filepath)
+
+    members = {}
     with open(filepath, 'rb') as f:
-        # The following construction lets us read f in chunks,
-        # instead of loading an arbitrary file in all at once.
+        reader = _HashingReader(f, new_hash(algorithm))
+        try:
+            if filepath.lower().endswith(".zip"):
+                with zipfile.ZipFile(reader) as archive:
+                    for info in archive.infolist():
+                        if not info.is_dir():
+                            with archive.open(info) as member:
+                                members[info.filename] = _hash_member(member, algorithm)
+            else:
+                with tarfile.open(fileobj=reader, mode="r|*") as archive:
+                    for info in archive:
+                        if info.isfile():
+                            members[info.name] = _hash_member(archive.extractfile(info), algorithm)
+        except (tarfile.TarError, zipfile.BadZipFile, EOFError, RuntimeError, NotImplementedError, zlib.error):
+            # not an archive after all, or one that cannot be read (such as
+            # an encrypted zip): it is only hashed as a whole
+            members = None
+        return reader.finish(), members
+
+
+def _hash_member(member, algorithm):
+    m = new_hash(algorithm)
+    for block in iter(partial(member.read, MAX_CHUNK_SIZE), b""):
+        m.update(block)
+    return format_digest(m.hexdigest(), algorithm)
+
+
+class _HashingReader:
+    """
+    File wrapper that feeds the bytes read from a file, in order, to a hash.
+
+    Reads that skip ahead of the bytes hashed so far by at most
+    `ARCHIVE_GAP` read the gap too; reads further ahead, or of bytes
+    already hashed, are not hashed. `finish` hashes whatever is left.
+    """
+
+    def __init__(self, f, m):
+        self._f = f
+        self._m = m
+        self._hashed = 0
+
+    def read(self, size=-1):
+        pos = self._f.tell()
+        if self._hashed < pos <= self._hashed + ARCHIVE_GAP:
+            self._f.seek(self._hashed)
+            self._m.update(self._f.read(pos - self._hashed))
+            self._hashed = pos
+        data = self._f.read(size)
+        if pos <= self._hashed < pos + len(data):
+            with memoryview(data) as view:
+                self._m.update(view[self._hashed - pos:])
+            self._hashed = pos + len(data)
+        return data
+
+    def finish(self):
+        self._f.seek(self._hashed)
+        for block in iter(partial(self._f.read, MAX_CHUNK_SIZE), b""):
+            self._m.update(block)
+        return self._m
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+
+def _hash_open_file(f, m, head=b""):
+    """
+    Update m with head, the bytes already read from the start of the
+    unbuffered file f, followed by the rest of f, reporting the bytes to
+    the progress of this thread (see `reading`) as they are hashed.
+    """
+    st = os.fstat(f.fileno())
+    chunk_size = _chunk_size(st)
+    m.update(head)
+    report_read(len(head))
+
+    if stat.S_ISREG(st.st_mode) and st.st_size >= MMAP_THRESHOLD:
+        # hash large files straight from the page cache, in chunks so the
+        # hash object can release the GIL between updates
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mmap, "MADV_SEQUENTIAL"):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            with memoryview(mm) as view:
+                for start in range(len(head), len(view), chunk_size):
+                    m.update(view[start:start + chunk_size])
+                    report_read(min(chunk_size, len(view) - start))
+        return m
+
+    # The following construction lets us read f in chunks into a reused
+    # buffer, instead of loading an arbitrary file in all at once.
+    with memoryview(_buffer(chunk_size))[:chunk_size] as view:
         while True:
-            b = f.read(2**10)
-            if not b:
+            n = f.readinto(view)
+            if not n:
                 break
-            m.update(b)
+            m.update(view[:n])
+            report_read(n)
     return m
 
 
-def modified_walk(folder, ignore_subdirs=[], ignore_exts=[], ignore_dot_files=True):
+def _open_ahead(filepath):
+    """
+    Open filepath and read its first chunk, returning the path, open file and
+    chunk.
+    """
+    f = open(filepath, 'rb', buffering=0)
+    try:
+        return filepath, f, f.read(MIN_CHUNK_SIZE)
+    except BaseException:
+        f.close()
+        raise
+
+
+def _ordered_map(func, items, workers, depth, discard=None):
+    """
+    Call func on each of items on a pool of workers threads, yielding the
+    results in the order of items.
+
+    Unlike `ThreadPoolExecutor.map`, at most depth calls are queued or
+    running at any time, so memory use stays bounded however many items
+    there are. If the caller stops early, discard is called on each result
+    that was computed but not yielded.
+    """
+    executor = _pool(workers)
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= depth:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        if discard is not None:
+            for future in pending:
+                if not future.cancelled() and future.exception() is None:
+                    discard(future.result())
+        if _pools is None:
+            executor.shutdown()
+
+
+def _pool(workers):
+    """
+    Return a pool of workers threads, kept for reuse while `_pools` is set.
+    """
+    if _pools is None:
+        return ThreadPoolExecutor(max_workers=workers)
+    if workers not in _pools:
+        _pools[workers] = ThreadPoolExecutor(max_workers=workers)
+    return _pools[workers]
+
+
+def _prefetch(paths, depth):
+    """
+    Yield (path, open file, first chunk) for each of paths in order, with up
+    to depth files opened and read ahead in the background. With the file
+    being hashed, at most depth + 1 files are open at once, as long as each
+    file is closed before the next one is taken.
+    """
+    return _ordered_map(_open_ahead, paths, depth, depth + 1, discard=lambda result: result[1].close())
+
+
+def _chunk_size(st):
+    """
+    Return the read size for a file with stat result st: the file size
+    clamped to [MIN_CHUNK_SIZE, MAX_CHUNK_SIZE], rounded up to whole
+    filesystem blocks.
+    """
+    block_size = getattr(st, "st_blksize", 0) or 4096
+    size = min(max(st.st_size, MIN_CHUNK_SIZE), MAX_CHUNK_SIZE)
+    return -(-size // block_size) * block_size
+
+
+def _buffer(size):
+    """
+    Return this thread's read buffer, grown to at least size bytes.
+    """
+    buf = getattr(_buffers, "buf", None)
+    if buf is None or len(buf) < size:
+        buf = _buffers.buf = bytearray(size)
+    return buf
+
+
+def modified_walk(folder, ignore_subdirs=[], ignore_exts=[], ignore_dot_files=True, ignore=None,
+                  follow_symlinks=False, special=None):
     '''
-    A wrapper on os.walk() to return a list of paths inside directory "folder"
+    Walk directory "folder" with os.scandir(), yielding the paths inside it
     that do not meet the ignore criteria.
 
+    Paths are yielded lazily, in sorted order. Ignored subdirectories are
+    dropped before they are entered, so nothing inside them is listed.
+
+    Only regular files (or symlinks to them) are yielded. FIFOs, sockets,
+    devices and broken symlinks could block or fail when read, so they are
+    skipped, and listed in special if it is given.
+
     Parameters
     ----------
     folder : str
         a filepath
     ignore_subdirs : list of str, optional
-        a list of subdirectories to ignore. Must include folder in the filepath.
+        a list of subdirectories to ignore, along with everything inside
+        them. Must include folder in the filepath.
     ignore_exts : list of str, optional
         a list of file extensions to ignore.
     ignore_dot_files : bool
+    ignore : IgnoreMatcher, optional
+        gitignore-style patterns for the paths to ignore, relative to folder.
+        Directories that match are not entered.
+    follow_symlinks : bool, optional
+        if True, descend into symlinked directories, except those that link
+        back to a directory the walk is already inside (default is False,
+        skip symlinked directories)
+    special : dict, optional
+        filled with the kind of each special file skipped (or symlink loop
+        not followed), keyed on its path
 
     Returns
     -------
-    list[str]
-        A list of accepted paths
+    generator of str
+        The accepted paths
     '''
     assert os.path.exists(folder), "Path {} does not exist".format(folder)
 
-    path_list = []
-    for path, directories, files in os.walk(folder):
-        # loop over files in the top directory
-        for f in sorted(files):
-            root, ext = os.path.splitext(f)
-            if not (
-                (ext in ignore_exts) or
-                (ignore_dot_files and root.startswith(".")) or
-                (path in ignore_subdirs)
-                ):
-                path_list.append(os.path.join(path, f))
+    ignore_subdirs = {os.path.normpath(subdir) for subdir in ignore_subdirs}
+    if os.path.normpath(folder) in ignore_subdirs:
+        return iter([])
+    rules = (ignore_subdirs, ignore_exts, ignore_dot_files, ignore or None, follow_symlinks,
+             {} if special is None else special)
+    ancestors = frozenset([_inode(os.stat(folder))]) if follow_symlinks else frozenset()
+    return _scan(folder, "", ancestors, rules)
 
-    return path_list
 
+def _inode(st):
+    return (st.st_dev, st.st_ino)
 
-def hash_dir_by_file(folder, **kwargs):
+
+def _special_kind(entry):
+    """
+    Return what kind of special file entry is, or None for a regular file.
+    """
+    try:
+        if entry.is_file():
+            return None
+        mode = entry.stat().st_mode
+    except OSError:
+        return "broken symlink" if entry.is_symlink() else "unreadable"
+    if stat.S_ISFIFO(mode):
+        return "fifo"
+    if stat.S_ISSOCK(mode):
+        return "socket"
+    if stat.S_ISCHR(mode):
+        return "character device"
+    if stat.S_ISBLK(mode):
+        return "block device"
+    return "special"
+
+
+def _scan(folder, prefix, ancestors, rules):
+    """
+    Yield the accepted paths inside folder, whose path relative to the top
+    of the walk is prefix, see modified_walk. ancestors holds the (device,
+    inode) of the directories the walk is inside, when following symlinks.
+    """
+    ignore_subdirs, ignore_exts, ignore_dot_files, ignore, follow_symlinks, special = rules
+    try:
+        with os.scandir(folder) as it:
+            entries = list(it)
+    except OSError:
+        # like os.walk, skip directories that cannot be listed
+        return
+
+    # sorting directories as if their names ended in the separator puts the
+    # paths in the same order as sorting the full paths of all files
+    keyed = []
+    for entry in entries:
+        # is_dir follows symlinks, like os.walk; DirEntry caches the file type
+        # from the listing, so this costs no system call for most entries
+        if entry.is_dir():
+            if (entry.is_symlink() and not follow_symlinks) or \
+                    os.path.normpath(entry.path) in ignore_subdirs or \
+                    (ignore is not None and ignore.match(prefix + entry.name, is_dir=True)):
+                continue
+            inode = _inode(entry.stat()) if follow_symlinks else None
+            if inode in ancestors:
+                special[entry.path] = "symlink loop"
+                continue
+            keyed.append((entry.name + os.sep, entry, inode))
+        else:
+            root, ext = os.path.splitext(entry.name)
+            if not ((ext in ignore_exts) or
+                    (ignore_dot_files and root.startswith(".")) or
+                    (ignore is not None and ignore.match(prefix + entry.name))):
+                keyed.append((entry.name, entry, None))
+    keyed.sort(key=lambda item: item[0])
+    del entries
+
+    for key, entry, inode in keyed:
+        if key.endswith(os.sep):
+            yield from _scan(entry.path, prefix + key[:-len(os.sep)] + "/",
+                             ancestors | {inode} if follow_symlinks else ancestors, rules)
+        else:
+            kind = _special_kind(entry)
+            if kind is None:
+                yield entry.path
+            else:
+                special[entry.path] = kind
+
+
+def hash_dir_by_file(folder, jobs=1, cache=None, algorithm=DEFAULT_ALGORITHM, prefetch=0, fingerprint_threshold=0,
+                     chunk_threshold=0, chunks=None, archive_members=False, members=None, progress=None,
+                     checkpoint=None, **kwargs):
     '''
     Create a dictionary mapping filepaths to hashes. Includes all files
     inside folder unless they meet some ignore criteria. See modified_walk
@@ -87,6 +738,35 @@ def hash_dir_by_file(folder, **kwargs):
     ----------
     folder : str
         filepath
+    jobs : int, optional
+        number of files to hash concurrently (default is 1, hash files
+        one after another)
+    cache : DigestCache, optional
+        digest cache to look files up in before hashing them (default is None,
+        hash every file)
+    algorithm : str, optional
+        hash algorithm, one of `ALGORITHMS` (default is sha512)
+    prefetch : int, optional
+        number of files to open and start reading ahead of the files being
+        hashed, to hide the latency of slow filesystems (default is 0)
+    fingerprint_threshold : int, optional
+        if not 0, files of at least this many bytes are fingerprinted instead
+        of hashed, see `file_digest` (default is 0)
+    chunk_threshold : int, optional
+        if not 0, files of at least this many bytes are also split into
+        content-defined chunks, see `file_digest` (default is 0)
+    chunks : dict, optional
+        filled with the chunk tables of those files, keyed on their paths
+    archive_members : bool, optional
+        if True, also hash the files inside tar and zip archives, see
+        `file_digest` (default is False)
+    members : dict, optional
+        filled with the digests of the files inside those archives, keyed on
+        the archive path
+    progress : Progress, optional
+        reported each file as it is hashed or found in cache
+    checkpoint : Checkpoint, optional
+        journal to resume from, and to record each file hashed in
     **kwargs : dict
         passed through to modified_walk
 
@@ -96,14 +776,60 @@ def hash_dir_by_file(folder, **kwargs):
     '''
     assert os.path.exists(folder), "Path {} does not exist".format(folder)
     assert os.path.isdir(folder), "Provided input {} not a directory".format(folder)
+    assert isinstance(jobs, int) and jobs >= 1, "jobs must be a positive integer"
+
+    paths = list(modified_walk(folder, **kwargs))
+    return dict(zip(paths, _cached_digests(paths, jobs, cache, algorithm, prefetch, fingerprint_threshold,
+                                           chunk_threshold, chunks, archive_members, members, progress,
+                                           checkpoint)))
 
-    hashes = {}
-    for path in modified_walk(folder, **kwargs):
-        hashes[path] = hash_file(path).hexdigest()
-    return hashes
 
+def hash_dir_to_manifest(folder, writer, jobs=1, cache=None, algorithm=DEFAULT_ALGORITHM, prefetch=0,
+                         fingerprint_threshold=0, chunk_threshold=0, chunks=None, archive_members=False, members=None,
+                         progress=None, checkpoint=None, batch_size=MANIFEST_BATCH, **kwargs):
+    '''
+    Hash the files inside folder like `hash_dir_by_file`, writing each path
+    and digest to a manifest instead of returning them.
+
+    Files are walked and hashed batch_size at a time, so memory use does not
+    grow with the number of files. Hard links are only hashed once if they
+    fall in the same batch.
+
+    Parameters
+    ----------
+    folder : str
+        filepath
+    writer : ManifestWriter
+        manifest the paths and digests are added to, in sorted order
+    batch_size : int, optional
+        number of files hashed at a time (default is `MANIFEST_BATCH`)
+
+    The other parameters are as for `hash_dir_by_file`.
 
-def hash_dir_full(folder, **kwargs):
+    Returns
+    -------
+    int
+        number of files hashed
+    '''
+    assert os.path.exists(folder), "Path {} does not exist".format(folder)
+    assert os.path.isdir(folder), "Provided input {} not a directory".format(folder)
+    assert isinstance(jobs, int) and jobs >= 1, "jobs must be a positive integer"
+
+    walk = modified_walk(folder, **kwargs)
+    files = 0
+    while True:
+        paths = list(islice(walk, batch_size))
+        if not paths:
+            return files
+        digests = _cached_digests(paths, jobs, cache, algorithm, prefetch, fingerprint_threshold, chunk_threshold,
+                                  chunks, archive_members, members, progress, checkpoint)
+        for path, digest in zip(paths, digests):
+            writer.add(path, digest)
+        files += len(paths)
+
+
+def hash_dir_full(folder, cache=None, algorithm=DEFAULT_ALGORITHM, manifest=None, prefetch=0, progress=None,
+                  **kwargs):
     '''
     Creates a hash and sequentially updates it with each file in folder.
     Includes all files inside folder unless they meet some ignore criteria
@@ -113,6 +839,22 @@ def hash_dir_full(folder, **kwargs):
     ----------
     folder : str
         filepath
+    cache : DigestCache, optional
+        digest cache to look the directory up in before hashing it (default
+        is None, hash every file)
+    algorithm : str, optional
+        hash algorithm, one of `ALGORITHMS` (default is sha512)
+    manifest : dict, optional
+        if given, filled with the digest of every file, keyed on its path
+        relative to folder using "/" as separator. Each file is still only
+        read once.
+    prefetch : int, optional
+        number of files to open and start reading in the background ahead of
+        the file being hashed, to hide the latency of slow filesystems
+        (default is 0)
+    progress : Progress, optional
+        reported each file as it is hashed, or all files if the directory is
+        found in cache
     **kwargs : dict
         passed through to modified_walk
 
@@ -123,13 +865,437 @@ def hash_dir_full(folder, **kwargs):
     assert os.path.exists(folder), "Path {} does not exist".format(folder)
     assert os.path.isdir(folder), "Provided input {} not a directory".format(folder)
 
-    m = hashlib.sha512()
-    for path in sorted(modified_walk(folder, **kwargs)):
-        m = hash_file(path, m)
+    paths = modified_walk(folder, **kwargs)
+
+    # the digest depends on the contents of every file in order, so it can
+    # only be reused when none of the files have changed (and, if a manifest
+    # is wanted, all their digests are cached too)
+    cached = None
+    if cache is not None:
+        paths = list(paths)
+        stats = [os.stat(path) for path in paths]
+        cached = cache.lookup_tree(stats, algorithm)
+        if cached is not None and not cache.verify:
+            file_digests = [cache.lookup(st, algorithm) for st in stats] if manifest is not None else []
+            if None not in file_digests:
+                if manifest is not None:
+                    manifest.update(zip(_relpaths(paths, folder), file_digests))
+                if progress is not None:
+                    for path, st in zip(paths, stats):
+                        progress.skip(path, st.st_size)
+                return cached
+
+    m = new_hash(algorithm)
+    hashed = []
+    file_digests = []
+    for path, f, head in _prefetch(paths, prefetch) if prefetch else ((path, None, None) for path in paths):
+        if manifest is None:
+            m_all = m
+        else:
+            # feed each chunk to the directory hash and a hash of this file
+            m_file = new_hash(algorithm)
+            m_all = _TeeHash(m, m_file)
+        start = time.perf_counter()
+        with reading(progress):
+            if f is None:
+                hash_file(path, m_all)
+            else:
+                with f:
+                    _hash_open_file(f, m_all, head)
+        if progress is not None:
+            progress.add(path, os.path.getsize(path), time.perf_counter() - start)
+        if manifest is not None:
+            hashed.append(path)
+            file_digests.append(format_digest(m_file.hexdigest(), algorithm))
+    digest = format_digest(m.hexdigest(), algorithm)
+    if manifest is not None:
+        manifest.update(zip(_relpaths(hashed, folder), file_digests))
+
+    if cache is not None:
+        if cached is not None:
+            cache.check(folder, cached, digest)
+        unchanged = [stat_key(os.stat(path)) == stat_key(st) for path, st in zip(paths, stats)]
+        if all(unchanged):
+            cache.store_tree(stats, digest, algorithm)
+        for st, file_hash, same in zip(stats, file_digests, unchanged):
+            if same:
+                cache.store(st, file_hash, algorithm)
+    return digest
+
+
+class _TeeHash:
+    """
+    Hash object that passes every update on to several hash objects.
+    """
+
+    def __init__(self, *hashes):
+        self.hashes = hashes
+
+    def update(self, data):
+        for m in self.hashes:
+            m.update(data)
+
+
+def _relpaths(paths, folder):
+    """
+    Return paths relative to folder, using "/" as separator.
+    """
+    return [os.path.relpath(path, folder).replace(os.sep, "/") for path in paths]
+
+
+def hash_dir_tree(folder, jobs=1, cache=None, algorithm=DEFAULT_ALGORITHM, tree=None, manifest=None, prefetch=0,
+                  fingerprint_threshold=0, chunk_threshold=0, chunks=None, archive_members=False, members=None,
+                  progress=None, checkpoint=None, **kwargs):
+    '''
+    Creates a Merkle tree digest of folder.
+
+    Each file is hashed separately, then the digest of each directory is
+    the hash of the names and digests of its files and subdirectories, in
+    sorted order. Unlike :func:`hash_dir_full`, files can be hashed in
+    parallel and looked up in a digest cache, and the directory digests show
+    which subdirectories changed. Includes all files inside folder unless
+    they meet some ignore criteria detailed in :func:`modified_walk`.
+    Directories with no included files are left out of the tree.
+
+    Parameters
+    ----------
+    folder : str
+        filepath
+    jobs : int, optional
+        number of files to hash concurrently (default is 1)
+    cache : DigestCache, optional
+        digest cache to look files up in before hashing them (default is None)
+    algorithm : str, optional
+        hash algorithm, one of `ALGORITHMS` (default is sha512)
+    tree : dict, optional
+        if given, filled with the digest of every directory, keyed on its path
+        relative to folder using "/" as separator ("." for folder itself)
+    manifest : dict, optional
+        if given, filled with the digest of every file, keyed on its path
+        relative to folder using "/" as separator
+    prefetch : int, optional
+        number of files to open and start reading ahead of the files being
+        hashed (default is 0)
+    fingerprint_threshold : int, optional
+        if not 0, files of at least this many bytes are fingerprinted instead
+        of hashed, see `file_digest`. Fingerprints enter the tree as a
+        different kind of entry, so the digest of a directory never matches
+        one made without them. (default is 0)
+    chunk_threshold : int, optional
+        if not 0, files of at least this many bytes are also split into
+        content-defined chunks, see `file_digest` (default is 0)
+    chunks : dict, optional
+        filled with the chunk tables of those files, keyed on their paths
+    archive_members : bool, optional
+        if True, also hash the files inside tar and zip archives, see
+        `file_digest` (default is False)
+    members : dict, optional
+        filled with the digests of the files inside those archives, keyed on
+        the archive path
+    progress : Progress, optional
+        reported each file as it is hashed or found in cache
+    checkpoint : Checkpoint, optional
+        journal to resume from, and to record each file hashed in
+    **kwargs : dict
+        passed through to modified_walk
+
+    Returns
+    -------
+    str
+        digest of folder, labelled "merkle-<algorithm>"
+    '''
+    assert os.path.exists(folder), "Path {} does not exist".format(folder)
+    assert os.path.isdir(folder), "Provided input {} not a directory".format(folder)
+    assert isinstance(jobs, int) and jobs >= 1, "jobs must be a positive integer"
+
+    paths = list(modified_walk(folder, **kwargs))
+    digests = _cached_digests(paths, jobs, cache, algorithm, prefetch, fingerprint_threshold, chunk_threshold, chunks,
+                              archive_members, members, progress, checkpoint)
+    if manifest is not None:
+        manifest.update(zip(_relpaths(paths, folder), digests))
+
+    # nested dictionaries of directory contents, mapping file names to digests
+    root = {}
+    for path, digest in zip(paths, digests):
+        parts = os.path.relpath(path, folder).split(os.sep)
+        node = root
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = digest
+
+    if tree is None:
+        tree = {}
+    return format_digest(_tree_digest(root, ".", algorithm, tree), algorithm, "merkle")
+
+
+def _tree_digest(node, relpath, algorithm, tree):
+    """
+    Return the hex digest of the directory node at relpath, adding it and the
+    digests of all its subdirectories to tree.
+    """
+    m = new_hash(algorithm)
+    for name in sorted(node):
+        child = node[name]
+        if isinstance(child, dict):
+            kind = b"d"
+            child_relpath = name if relpath == "." else relpath + "/" + name
+            hexdigest = _tree_digest(child, child_relpath, algorithm, tree)
+        else:
+            label, hexdigest = split_digest(child)
+            kind = b"p" if split_label(label)[0] == "fp" else b"f"
+        m.update(kind + b" " + name.encode("utf-8", "surrogateescape") + b"\0" + hexdigest.encode() + b"\n")
+    tree[relpath] = format_digest(m.hexdigest(), algorithm, "merkle")
     return m.hexdigest()
 
 
-def hash_input(input_data):
+def file_digest(filepath, cache=None, algorithm=DEFAULT_ALGORITHM, fingerprint_threshold=0, chunk_threshold=0,
+                chunks=None, archive_members=False, members=None, progress=None, checkpoint=None):
+    '''
+    Return the digest of a file, looking it up in cache first if given.
+
+    Parameters
+    ----------
+    filepath : str
+        A string pointing to the file you want to hash
+    cache : DigestCache, optional
+        digest cache (default is None, always hash the file)
+    algorithm : str, optional
+        hash algorithm, one of `ALGORITHMS` (default is sha512)
+    fingerprint_threshold : int, optional
+        if not 0, a file of at least this many bytes is fingerprinted with
+        `fingerprint_file` instead of hashed, and its digest labelled
+        "fp-<algorithm>" (default is 0)
+    chunk_threshold : int, optional
+        if not 0, a file of at least this many bytes (that is not
+        fingerprinted) is also split into content-defined chunks with
+        `hash_chunks`, in the same read (default is 0)
+    chunks : dict, optional
+        filled with the chunk table of the file, see `pack_chunks`, if it has
+        one
+    archive_members : bool, optional
+        if True and the file is a tar or zip archive (see `ARCHIVE_EXTS`)
+        that is not fingerprinted, also hash each file inside it with
+        `hash_archive`, in the same read (default is False)
+    members : dict, optional
+        filled with the digests of the files inside the archive, keyed on the
+        archive path, if it could be read
+    progress : Progress, optional
+        reported the file once it is hashed or found in cache
+    checkpoint : Checkpoint, optional
+        journal to resume from, and to record the file in once it is hashed
+
+    Returns
+    -------
+    str
+        digest labelled with its algorithm, see `format_digest`
+    '''
+    assert os.path.exists(filepath), "Path {} does not exist".format(filepath)
+    return _cached_digests([filepath], 1, cache, algorithm, fingerprint_threshold=fingerprint_threshold,
+                           chunk_threshold=chunk_threshold, chunks=chunks, archive_members=archive_members,
+                           members=members, progress=progress, checkpoint=checkpoint)[0]
+
+
+def _over(size, threshold):
+    return bool(threshold) and size >= threshold
+
+
+def _digest(filepath, algorithm=DEFAULT_ALGORITHM, fingerprint_threshold=0, chunk_threshold=0,
+            archive_members=False):
+    """
+    Return the labelled digest of a file, its packed chunk table (or None if
+    it is not split into chunks) and, if archive_members is set and it is an
+    archive, the JSON encoded digests of its members (or None).
+    """
+    size = os.path.getsize(filepath)
+    if _over(size, fingerprint_threshold):
+        return format_digest(fingerprint_file(filepath, algorithm=algorithm).hexdigest(), algorithm, "fp"), None, None
+    members = None
+    if archive_members and is_archive(filepath):
+        m, archive = hash_archive(filepath, algorithm)
+        members = json.dumps(archive, sort_keys=True)
+    if _over(size, chunk_threshold):
+        # the chunks need another read of an archive
+        m, chunks = hash_chunks(filepath, algorithm)
+        return format_digest(m.hexdigest(), algorithm), pack_chunks(chunks, algorithm), members
+    if members is None:
+        m = hash_file(filepath, algorithm=algorithm)
+    return format_digest(m.hexdigest(), algorithm), None, members
+
+
+def _hash_files(paths, jobs, algorithm=DEFAULT_ALGORITHM, prefetch=0, fingerprint_threshold=0, chunk_threshold=0,
+                archive_members=False, progress=None, checkpoint=None):
+    """
+    Hash each of paths, returning the digests, chunk tables and member
+    digests (see _digest) in the same order, reporting each file to
+    progress and recording it in checkpoint as soon as it is hashed.
+    """
+    results = []
+    for path, result in zip(paths, _iter_hashes(paths, jobs, algorithm, prefetch, fingerprint_threshold,
+                                                chunk_threshold, archive_members, progress)):
+        if checkpoint is not None:
+            checkpoint.record(path, result)
+        results.append(result)
+    return results
+
+
+def _iter_hashes(paths, jobs, algorithm, prefetch, fingerprint_threshold, chunk_threshold, archive_members,
+                 progress):
+    """
+    Yield the results of _hash_files for each of paths in order.
+    """
+    digest = partial(_digest, algorithm=algorithm, fingerprint_threshold=fingerprint_threshold,
+                     chunk_threshold=chunk_threshold, archive_members=archive_members)
+    if progress is not None:
+        digest = progress.timed(digest)
+    if jobs == 1 and prefetch == 0:
+        for path in paths:
+            yield digest(path)
+
+    elif jobs == 1:
+        for path, f, head in _prefetch(paths, prefetch):
+            with f:
+                size = os.fstat(f.fileno()).st_size
+                if _over(size, fingerprint_threshold) or _over(size, chunk_threshold) or \
+                        (archive_members and is_archive(path)):
+                    result = digest(path)
+                else:
+                    start = time.perf_counter()
+                    with reading(progress):
+                        m = _hash_open_file(f, new_hash(algorithm), head)
+                    if progress is not None:
+                        progress.add(path, size, time.perf_counter() - start)
+                    result = (format_digest(m.hexdigest(), algorithm), None, None)
+            yield result
+
+    else:
+        # results come back in the order of paths, so the digests are
+        # identical to the sequential ones whatever order the files finish in
+        yield from _ordered_map(digest, paths, jobs, jobs + prefetch)
+
+
+def _link_owners(stats):
+    """
+    Return, for each of stats, the index of the first of stats with the same
+    device and inode. Filesystems without inode numbers report 0, and those
+    files are never treated as links.
+    """
+    first = {}
+    return [first.setdefault(_inode(st), i) if st.st_ino else i for i, st in enumerate(stats)]
+
+
+def _cached_digests(paths, jobs, cache, algorithm=DEFAULT_ALGORITHM, prefetch=0, fingerprint_threshold=0,
+                    chunk_threshold=0, chunks=None, archive_members=False, members=None, progress=None,
+                    checkpoint=None):
+    """
+    Hash each of paths that misses the checkpoint and the cache, returning
+    the digests of all paths in order and adding their chunk tables to
+    chunks, and the digests of the members of archives to members. Every
+    path is reported to progress, and every path hashed recorded in
+    checkpoint. Only the main thread touches the cache and the checkpoint.
+    """
+    new_hash(algorithm)  # fail early on an unavailable algorithm
+    assert isinstance(prefetch, int) and prefetch >= 0, "prefetch must be a non-negative integer"
+    assert isinstance(fingerprint_threshold, int) and fingerprint_threshold >= 0, \
+        "fingerprint_threshold must be a non-negative integer"
+    assert isinstance(chunk_threshold, int) and chunk_threshold >= 0, "chunk_threshold must be a non-negative integer"
+    if chunks is None:
+        chunks = {}
+    if members is None:
+        members = {}
+
+    # hard links to one inode are hashed once, and its digest (and chunk
+    # table and member digests) reused for every link
+    stats = [os.stat(path) for path in paths]
+    owner = _link_owners(stats)
+    unique = sorted(set(owner))
+    if len(unique) < len(paths):
+        found_chunks = {}
+        found_members = {}
+        digests = dict(zip(unique, _cached_digests([paths[i] for i in unique], jobs, cache, algorithm, prefetch,
+                                                   fingerprint_threshold, chunk_threshold, found_chunks,
+                                                   archive_members, found_members, progress, checkpoint)))
+        if progress is not None:
+            for i, (path, st) in enumerate(zip(paths, stats)):
+                if owner[i] != i:
+                    progress.skip(path, st.st_size)
+        chunks.update((path, found_chunks[paths[i]]) for path, i in zip(paths, owner) if paths[i] in found_chunks)
+        members.update((path, found_members[paths[i]]) for path, i in zip(paths, owner)
+                       if paths[i] in found_members)
+        return [digests[i] for i in owner]
+
+    # files hashed before an interrupted run stopped are not hashed again
+    resumed = {}
+    if checkpoint is not None:
+        for i, (path, st) in enumerate(zip(paths, stats)):
+            result = checkpoint.lookup(path, st)
+            if result is not None:
+                resumed[i] = result
+                if progress is not None:
+                    progress.skip(path, st.st_size)
+    todo = [i for i in range(len(paths)) if i not in resumed]
+    if cache is None:
+        hashed = _hash_files([paths[i] for i in todo], jobs, algorithm, prefetch, fingerprint_threshold,
+                             chunk_threshold, archive_members, progress, checkpoint)
+    else:
+        hashed = _cached_results([paths[i] for i in todo], [stats[i] for i in todo], jobs, cache, algorithm,
+                                 prefetch, fingerprint_threshold, chunk_threshold, archive_members, progress,
+                                 checkpoint)
+    resumed.update(zip(todo, hashed))
+    results = [resumed[i] for i in range(len(paths))]
+    for path, (_, table, archive) in zip(paths, results):
+        if table is not None:
+            chunks[path] = table
+        if archive is not None and json.loads(archive) is not None:
+            members[path] = json.loads(archive)
+    return [digest for digest, _, _ in results]
+
+
+def _cached_results(paths, stats, jobs, cache, algorithm, prefetch, fingerprint_threshold, chunk_threshold,
+                    archive_members, progress, checkpoint):
+    """
+    Return the results of _hash_files for paths, looking them up in cache
+    and hashing only the misses.
+    """
+    # fingerprints are cached apart from hashes of the whole contents, and
+    # chunk tables and member digests apart from both
+    labels = ["fp-" + algorithm if _over(st.st_size, fingerprint_threshold) else algorithm for st in stats]
+    chunked = [label == algorithm and _over(st.st_size, chunk_threshold) for st, label in zip(stats, labels)]
+    unpacked = [label == algorithm and archive_members and is_archive(path) for path, label in zip(paths, labels)]
+    cached = [(cache.lookup(st, label),
+               cache.lookup(st, "cdc-" + algorithm) if is_chunked else None,
+               cache.lookup(st, "members-" + algorithm) if is_unpacked else None)
+              for st, label, is_chunked, is_unpacked in zip(stats, labels, chunked, unpacked)]
+    todo = [i for i, (digest, table, archive) in enumerate(cached)
+            if digest is None or (chunked[i] and table is None) or (unpacked[i] and archive is None) or
+            cache.verify]
+    for i in sorted(set(range(len(paths))) - set(todo)):
+        if progress is not None:
+            progress.skip(paths[i], stats[i].st_size)
+        if checkpoint is not None:
+            checkpoint.forget(paths[i])
+
+    results = list(cached)
+    hashed = _hash_files([paths[i] for i in todo], jobs, algorithm, prefetch, fingerprint_threshold,
+                         chunk_threshold, archive_members, progress, checkpoint)
+    for i, (digest, table, archive) in zip(todo, hashed):
+        if cached[i][0] is not None:
+            cache.check(paths[i], cached[i][0], digest)
+        # a file that changed while it was read is not cached
+        if stat_key(os.stat(paths[i])) == stat_key(stats[i]):
+            cache.store(stats[i], digest, labels[i])
+            if table is not None:
+                cache.store(stats[i], table, "cdc-" + algorithm)
+            if archive is not None:
+                cache.store(stats[i], archive, "members-" + algorithm)
+        results[i] = (digest, table, archive)
+    cache.commit()
+    return results
+
+
+def hash_input(input_data, cache=None, algorithm=DEFAULT_ALGORITHM, mode="full", jobs=1, tree=None,
+               manifest=None, prefetch=0, ignore=None, fingerprint_threshold=0, chunk_threshold=0, chunks=None,
+               follow_symlinks=False, special=None, archive_members=False, members=None, progress=None,
+               checkpoint=None):
     """
     Hash directory with input data.
 
@@ -137,21 +1303,80 @@ def hash_input(input_data):
     ----------
     input_data: str
         Path to directory with input data.
+    cache: DigestCache, optional
+        Digest cache to look up files in before hashing them.
+    algorithm: str, optional
+        Hash algorithm, one of `ALGORITHMS` (default is sha512).
+    mode: str, optional
+        "full" to hash all files in one stream with :func:`hash_dir_full`
+        (default), or "merkle" for a Merkle tree digest from
+        :func:`hash_dir_tree`.
+    jobs: int, optional
+        Number of files to hash concurrently in "merkle" mode (default is 1).
+    tree: dict, optional
+        Filled with the directory digests in "merkle" mode.
+    manifest: dict, optional
+        Filled with the digest of every file in an input directory, from the
+        same read of each file as the directory hash.
+    prefetch: int, optional
+        Number of files to open and start reading ahead (default is 0).
+    ignore: IgnoreMatcher, optional
+        Patterns for the files and subdirectories of an input directory to
+        leave out.
+    fingerprint_threshold: int, optional
+        If not 0, an input file, or a file in an input directory in "merkle"
+        mode, of at least this many bytes is fingerprinted instead of hashed
+        (default is 0). Directories in "full" mode are always hashed in full.
+    chunk_threshold: int, optional
+        If not 0, the same files, if at least this many bytes, are also split
+        into content-defined chunks (default is 0).
+    chunks: dict, optional
+        Filled with the chunk tables of those files, keyed on their paths.
+    follow_symlinks: bool, optional
+        If True, descend into symlinked subdirectories (default is False).
+    special: dict, optional
+        Filled with the kind of each special file skipped in an input
+        directory, keyed on its path.
+    archive_members: bool, optional
+        If True, the same files, if tar or zip archives, also have the files
+        inside them hashed (default is False).
+    members: dict, optional
+        Filled with the digests of the files inside those archives, keyed on
+        the archive path.
+    progress: Progress, optional
+        Reported each file as it is hashed or found in the digest cache.
+    checkpoint: Checkpoint, optional
+        Journal to resume an interrupted run from, and to record each file
+        hashed in. Directories in "full" mode are not checkpointed.
 
     Returns
     -------
     str
         Hash of the directory.
     """
-    if os.path.isdir(input_data):
-        return hash_dir_full(input_data)
+    assert mode in INPUT_MODES, "Input mode must be one of {}".format(", ".join(INPUT_MODES))
+    if os.path.isdir(input_data) and mode == "merkle":
+        return hash_dir_tree(input_data, jobs=jobs, cache=cache, algorithm=algorithm, tree=tree,
+                             manifest=manifest, prefetch=prefetch, ignore=ignore,
+                             fingerprint_threshold=fingerprint_threshold, chunk_threshold=chunk_threshold,
+                             chunks=chunks, follow_symlinks=follow_symlinks, special=special,
+                             archive_members=archive_members, members=members, progress=progress,
+                             checkpoint=checkpoint)
+    elif os.path.isdir(input_data):
+        return hash_dir_full(input_data, cache=cache, algorithm=algorithm, manifest=manifest,
+                             prefetch=prefetch, ignore=ignore, follow_symlinks=follow_symlinks, special=special,
+                             progress=progress)
     elif os.path.isfile(input_data):
-        return hash_file(input_data).hexdigest()
+        return file_digest(input_data, cache=cache, algorithm=algorithm, fingerprint_threshold=fingerprint_threshold,
+                           chunk_threshold=chunk_threshold, chunks=chunks, archive_members=archive_members,
+                           members=members, progress=progress, checkpoint=checkpoint)
     else:
         raise AssertionError("Provided input {} is not a file or directory".format(input_data))
 
 
-def hash_output(output_data):
+def hash_output(output_data, jobs=1, cache=None, algorithm=DEFAULT_ALGORITHM, prefetch=0, ignore=None,
+                fingerprint_threshold=0, chunk_threshold=0, chunks=None, follow_symlinks=False, special=None,
+                archive_members=False, members=None, progress=None, checkpoint=None, manifest_writer=None):
     """
     Hash analysis output files.
 
@@ -159,25 +1384,86 @@ def hash_output(output_data):
     ----------
     output_data:
         Path to output data directory.
+    jobs: int, optional
+        Number of files to hash concurrently (default is 1).
+    cache: DigestCache, optional
+        Digest cache to look up files in before hashing them.
+    algorithm: str, optional
+        Hash algorithm, one of `ALGORITHMS` (default is sha512).
+    prefetch: int, optional
+        Number of files to open and start reading ahead (default is 0).
+    ignore: IgnoreMatcher, optional
+        Patterns for the files and subdirectories of an output directory to
+        leave out.
+    fingerprint_threshold: int, optional
+        If not 0, output files of at least this many bytes are fingerprinted
+        instead of hashed (default is 0).
+    chunk_threshold: int, optional
+        If not 0, output files of at least this many bytes are also split into
+        content-defined chunks (default is 0).
+    chunks: dict, optional
+        Filled with the chunk tables of those files, keyed on their paths.
+    follow_symlinks: bool, optional
+        If True, descend into symlinked subdirectories (default is False).
+    special: dict, optional
+        Filled with the kind of each special file skipped in an output
+        directory, keyed on its path.
+    archive_members: bool, optional
+        If True, output files that are tar or zip archives also have the files
+        inside them hashed (default is False).
+    members: dict, optional
+        Filled with the digests of the files inside those archives, keyed on
+        the archive path.
+    progress: Progress, optional
+        Reported each file as it is hashed or found in the digest cache.
+    checkpoint: Checkpoint, optional
+        Journal to resume an interrupted run from, and to record each file
+        hashed in.
+
+    manifest_writer: ManifestWriter, optional
+        If given, the digests of the files in an output directory are written
+        to it as they are hashed, see `hash_dir_to_manifest`, and an empty
+        dictionary returned.
 
     Returns
     -------
     dict (str : str)
     """
-    if os.path.isdir(output_data):
-        return hash_dir_by_file(output_data)
+    if os.path.isdir(output_data) and manifest_writer is not None:
+        hash_dir_to_manifest(output_data, manifest_writer, jobs=jobs, cache=cache, algorithm=algorithm,
+                             prefetch=prefetch, ignore=ignore, fingerprint_threshold=fingerprint_threshold,
+                             chunk_threshold=chunk_threshold, chunks=chunks, follow_symlinks=follow_symlinks,
+                             special=special, archive_members=archive_members, members=members,
+                             progress=progress, checkpoint=checkpoint)
+        return {}
+    elif os.path.isdir(output_data):
+        return hash_dir_by_file(output_data, jobs=jobs, cache=cache, algorithm=algorithm, prefetch=prefetch,
+                                ignore=ignore, fingerprint_threshold=fingerprint_threshold,
+                                chunk_threshold=chunk_threshold, chunks=chunks, follow_symlinks=follow_symlinks,
+                                special=special, archive_members=archive_members, members=members,
+                                progress=progress, checkpoint=checkpoint)
     elif os.path.isfile(output_data):
-        return {output_data: hash_file(output_data).hexdigest()}
+        return {output_data: file_digest(output_data, cache=cache, algorithm=algorithm,
+                                         fingerprint_threshold=fingerprint_threshold,
+                                         chunk_threshold=chunk_threshold, chunks=chunks,
+                                         archive_members=archive_members, members=members,
+                                         progress=progress, checkpoint=checkpoint)}
     else:
         raise AssertionError("Provided input {} is not a file or directory".format(output_data))
 
 
-def hash_code(repo_path, catalogue_dir):
+def hash_code(repo_path, catalogue_dir, state=None, identity="commit"):
     """
     Get commit digest for current HEAD commit
 
     Returns the current HEAD commit digest for the code that is run.
 
+    With identity "tree", returns the digest of the git tree of repo_path in
+    the HEAD commit instead, as "tree:<digest>". It only changes when the
+    files under repo_path change, so commits elsewhere in the repository do
+    not change it. It is read from the git objects, without hashing any
+    files.
+
     If the current working directory is dirty (or has untracked files other
     than those held in `catalogue_dir`), it raises a `RepositoryDirtyError`.
 
@@ -187,23 +1473,357 @@ def hash_code(repo_path, catalogue_dir):
         Path to analysis directory git repository.
     catalogue_dir: str
         Path to directory with catalogue output files.
+    state: RepoState, optional
+        Snapshot of the repository already taken by this command, see
+        `repo_state`. If not given, one is taken.
+    identity: str, optional
+        One of `CODE_IDENTITIES`, default is "commit".
 
     Returns
     -------
     str
-        Git commit digest for the current HEAD commit of the git repository
+        Git commit digest for the current HEAD commit of the git repository,
+        or tree digest of repo_path
+    """
+    assert identity in CODE_IDENTITIES, "Code identity must be one of {}".format(", ".join(CODE_IDENTITIES))
+
+    if state is None:
+        state = repo_state(repo_path, excludes=[catalogue_dir])
+
+    if not state.is_clean(catalogue_dir):
+        raise RepositoryDirtyError(state.repo, "git repository contains uncommitted changes")
+    if state.head is None:
+        raise ValueError("git repository has no commits")
+
+    if identity == "tree":
+        relpath = os.path.relpath(os.path.realpath(repo_path), os.path.realpath(state.repo.working_tree_dir))
+        relpath = "" if relpath == "." else relpath.replace(os.sep, "/")
+        return "tree:" + state.repo.git.rev_parse("{}:{}".format(state.head, relpath))
+
+    return state.head
+
+
+class RepoState:
+    """
+    Snapshot of the status of a git repository.
+
+    Parameters
+    ----------
+    repo : git.Repo
+        the repository
+    head : str or None
+        digest of the HEAD commit, None if there are no commits
+    dirty : bool
+        whether any tracked file (or submodule) has changes, staged or not
+    untracked : list of str
+        untracked files, relative to the top of the repository
+    """
+
+    def __init__(self, repo, head, dirty, untracked):
+        self.repo = repo
+        self.head = head
+        self.dirty = dirty
+        self.untracked = untracked
+
+    def is_clean(self, catalogue_dir):
+        """
+        Return whether there are no uncommitted changes, ignoring untracked
+        files held in `catalogue_dir`.
+        """
+        return not self.dirty and len(prune_files(self.untracked, catalogue_dir)) == 0
+
+
+def repo_state(repo_path, excludes=()):
+    """
+    Take a snapshot of the HEAD commit, changes and untracked files of the
+    git repository at repo_path.
+
+    Runs a single `git status`, where `Repo.is_dirty`, `Repo.untracked_files`
+    and `Repo.head` run several git commands, each of them reading the whole
+    working tree. A command takes one snapshot and passes it to `git_query`
+    and `hash_code`.
+
+    Only the files under repo_path are checked, if it is a subdirectory of
+    the repository, and git does not look inside the excluded paths at all
+    (see `status_pathspecs`).
+
+    Parameters
+    ----------
+    repo_path: str
+        Path to analysis directory git repository.
+    excludes: list of str, optional
+        Paths to leave out of the snapshot, see `git_excludes`.
+
+    Returns
+    -------
+    RepoState
+    """
+    repo = open_repo(repo_path)
+    output = repo.git.status("--porcelain=v2", "-z", "--branch", "--untracked-files=all", "--",
+                             *status_pathspecs(repo.working_tree_dir, repo_path, excludes))
+    head = None
+    dirty = False
+    untracked = []
+    entries = iter(output.split("\0"))
+    for entry in entries:
+        if entry.startswith("# branch.oid "):
+            oid = entry[len("# branch.oid "):]
+            head = None if oid == "(initial)" else oid
+        elif entry.startswith("? "):
+            untracked.append(entry[2:])
+        elif entry[:2] in ("1 ", "2 ", "u "):
+            dirty = True
+            if entry.startswith("2 "):
+                # a rename or copy is followed by the original path
+                next(entries, None)
+    return RepoState(repo, head, dirty, untracked)
+
+
+def status_pathspecs(working_tree_dir, repo_path, excludes):
+    """
+    Return the git pathspecs limiting `git status` to repo_path, leaving out
+    the excluded paths.
+
+    Paths outside the working tree, and excludes that would leave out the
+    whole of repo_path, are dropped.
+
+    Parameters
+    ----------
+    working_tree_dir: str
+        Top of the working tree of the repository.
+    repo_path: str
+        Path to analysis directory git repository.
+    excludes: list of str
+        Paths to leave out.
+
+    Returns
+    -------
+    list of str
     """
+    top = os.path.realpath(working_tree_dir)
+    relpath = lambda path: os.path.relpath(os.path.realpath(path), top)
+    inside = lambda rel, parent: parent == "." or rel == parent or rel.startswith(parent + os.sep)
+
+    code = relpath(repo_path)
+    if not inside(code, "."):
+        code = "."
+    pathspecs = [] if code == "." else [":(top){}".format(code)]
+    for path in excludes:
+        rel = relpath(path)
+        if rel.startswith(os.pardir) or inside(code, rel):
+            continue
+        pathspecs.append(":(top,exclude){}".format(rel))
+    return pathspecs
+
+
+def git_excludes(args):
+    """
+    Return the paths left out of the git status checks for a command: the
+    `catalogue_results` directory, the input and output data and any
+    `git_exclude` paths given.
+
+    Parameters
+    ----------
+    args : obj
+        Command line input arguments (argparse.Namespace).
 
+    Returns
+    -------
+    list of str
+    """
+    excludes = [args.catalogue_results, args.input_data]
+    if hasattr(args, "output_data"):
+        excludes.append(args.output_data)
+    return excludes + list(getattr(args, "git_exclude", None) or [])
+
+
+def open_repo(repo_path):
+    """
+    Open the git repository at repo_path, or in one of its parent
+    directories.
+
+    While `_open_repos` is set (by `catalogue daemon`), repositories are
+    kept open and reused by later calls.
+
+    Parameters
+    ----------
+    repo_path: str
+        Path to analysis directory git repository.
+
+    Returns
+    -------
+    git.Repo
+    """
+    key = os.path.abspath(repo_path)
+    if _open_repos is not None and key in _open_repos:
+        repo = _open_repos[key]
+        if os.path.isdir(repo.git_dir):
+            return repo
+        repo.close()
     try:
         repo = git.Repo(repo_path, search_parent_directories=True)
     except InvalidGitRepositoryError:
         raise InvalidGitRepositoryError("provided code directory is not a valid git repository")
+    if _open_repos is not None:
+        _open_repos[key] = repo
+    return repo
+
+
+def record_algorithm(hash_dict):
+    """
+    Return the hash algorithm used for the input data in a hash dictionary.
+
+    Parameters
+    ----------
+    hash_dict : dict { str : dict }
+
+    Returns
+    -------
+    str
+    """
+    return split_label(split_digest(list(hash_dict["input_data"].values())[0])[0])[1]
+
+
+def record_options(hash_dict):
+    """
+    Return the hashing options used to create a hash dictionary.
+
+    Used to hash the current state in the same way as an earlier record, so
+    that the two can be compared.
+
+    Parameters
+    ----------
+    hash_dict : dict { str : dict }
+
+    Returns
+    -------
+    dict { str : str }
+        values for the `algorithm` and `input_mode` arguments, for
+        `input_manifest` if the record has an input manifest, the
+        `input_ignore` patterns the input data was hashed with, the
+        `fingerprint_threshold` and `chunk_threshold` used, whether
+        symlinked directories were followed (`follow_symlinks`), whether
+        archive members were hashed (`archive_members`), whether the code
+        was identified by its commit or tree (`code_identity`) and for
+        `stream_outputs` if the record has an output manifest
+    """
+    mode = split_label(split_digest(list(hash_dict["input_data"].values())[0])[0])[0]
+    options = {
+        "algorithm": record_algorithm(hash_dict),
+        "input_mode": "merkle" if mode == "merkle" else "full"
+    }
+    if "input_manifest" in hash_dict:
+        packed = list(hash_dict["input_manifest"].values())[0]
+        options["input_manifest"] = "compressed" if isinstance(packed, str) else "plain"
+    options["input_ignore"] = record_ignore(hash_dict, "input_data")
+    options["fingerprint_threshold"] = hash_dict.get("fingerprint_threshold", 0)
+    options["chunk_threshold"] = hash_dict.get("chunk_threshold", 0)
+    options["follow_symlinks"] = hash_dict.get("follow_symlinks", False)
+    options["archive_members"] = hash_dict.get("archive_members", False)
+    options["code_identity"] = "tree" if list(hash_dict["code"].values())[0].startswith("tree:") else "commit"
+    if "output_manifest" in hash_dict:
+        options["stream_outputs"] = True
+    return options
+
+
+def record_ignore(hash_dict, key):
+    """
+    Return the ignore patterns used to hash the input or output data of a
+    hash dictionary.
+
+    Parameters
+    ----------
+    hash_dict : dict { str : dict }
+    key : str
+        "input_data" or "output_data"
+
+    Returns
+    -------
+    list of str
+        the patterns, empty for records made without any
+    """
+    return hash_dict.get("ignore", {}).get(key, [])
+
+
+def pack_manifest(manifest, compress=False):
+    """
+    Prepare a manifest of file digests for storing in a hash dictionary.
+
+    Parameters
+    ----------
+    manifest : dict { str : str }
+        digests keyed on file path
+    compress : bool, optional
+        if True, the manifest is stored as a string "zlib:<base64 of the
+        zlib compressed JSON manifest>"
+
+    Returns
+    -------
+    dict { str : str } or str
+    """
+    if not compress:
+        return dict(sorted(manifest.items()))
+    data = json.dumps(manifest, sort_keys=True, separators=(",", ":")).encode()
+    return "zlib:" + base64.b64encode(zlib.compress(data, 9)).decode("ascii")
+
+
+def unpack_manifest(packed):
+    """
+    Return the manifest of file digests stored by `pack_manifest`.
+
+    Parameters
+    ----------
+    packed : dict { str : str } or str
+
+    Returns
+    -------
+    dict { str : str }
+    """
+    if isinstance(packed, str):
+        assert packed.startswith("zlib:"), "unknown manifest encoding"
+        return json.loads(zlib.decompress(base64.b64decode(packed[len("zlib:"):])).decode())
+    return packed
+
 
-    untracked = prune_files(repo.untracked_files, catalogue_dir)
-    if repo.is_dirty() or len(untracked) != 0:
-        raise RepositoryDirtyError(repo, "git repository contains uncommitted changes")
+def pack_chunks(chunks, algorithm=DEFAULT_ALGORITHM):
+    """
+    Prepare a table of content-defined chunks for storing in a hash dictionary.
+
+    Parameters
+    ----------
+    chunks : list of (int, bytes)
+        length and digest of each chunk, from `hash_chunks`
+    algorithm : str, optional
+        hash algorithm of the chunk digests
+
+    Returns
+    -------
+    str
+        "cdc-<algorithm>:<base64 of the chunk lengths and digests>"
+    """
+    data = b"".join(length.to_bytes(4, "little") + digest for length, digest in chunks)
+    return format_digest(base64.b64encode(data).decode("ascii"), algorithm, "cdc")
+
+
+def unpack_chunks(packed):
+    """
+    Return the table of content-defined chunks stored by `pack_chunks`.
+
+    Parameters
+    ----------
+    packed : str
 
-    return repo.head.commit.hexsha
+    Returns
+    -------
+    tuple (str, list of (int, bytes))
+        label of the table and the length and digest of each chunk
+    """
+    label, data = split_digest(packed)
+    assert split_label(label)[0] == "cdc", "unknown chunk table encoding"
+    data = base64.b64decode(data)
+    size = 4 + CDC_DIGEST_SIZE
+    return label, [(int.from_bytes(data[i:i + 4], "little"), data[i + 4:i + size])
+                   for i in range(0, len(data), size)]
 
 
 def construct_dict(timestamp, args):
@@ -222,20 +1842,150 @@ def construct_dict(timestamp, args):
     dict
         A dictionary with hashes of all inputs.
     """
-    results = {
-        "timestamp": {
-            args.command: timestamp
-        },
-        "input_data": {
-            args.input_data : hash_input(args.input_data)
-        },
-        "code": {
-            args.code : hash_code(args.code, args.catalogue_results)
+    algorithm = getattr(args, "algorithm", DEFAULT_ALGORITHM)
+    jobs = getattr(args, "jobs", 1)
+    prefetch = getattr(args, "prefetch", 0)
+    fingerprint_threshold = getattr(args, "fingerprint_threshold", 0)
+    chunk_threshold = getattr(args, "chunk_threshold", 0)
+    follow_symlinks = getattr(args, "follow_symlinks", False)
+    archive_members = getattr(args, "archive_members", False)
+    chunks = {}
+    members = {}
+    special = {}
+    patterns = getattr(args, "ignore", None) or []
+    # the input patterns are taken from a lock or record when re-hashing it
+    input_ignore = getattr(args, "input_ignore", None)
+    if input_ignore is None:
+        input_ignore = active_patterns(args.input_data, patterns)
+    output_ignore = active_patterns(args.output_data, patterns) if hasattr(args, "output_data") else []
+    input_manifest_mode = getattr(args, "input_manifest", "none")
+    assert input_manifest_mode in INPUT_MANIFESTS, "Input manifest must be one of {}".format(
+        ", ".join(INPUT_MANIFESTS))
+    input_tree = {}
+    input_manifest = None if input_manifest_mode == "none" else {}
+    show_progress = getattr(args, "progress", False)
+    record_stats = getattr(args, "record_stats", False)
+    progress = None
+    if show_progress or record_stats:
+        progress = Progress(sys.stderr if show_progress else None)
+    # a lock whose input data is known to be unchanged, so need not be hashed again
+    reuse_input = getattr(args, "reuse_input", None)
+    if show_progress and reuse_input is None:
+        # count the files and bytes to hash, for the estimate of time left
+        progress.expect(*scan_size(args.input_data, partial(modified_walk, ignore=IgnoreMatcher(input_ignore),
+                                                            follow_symlinks=follow_symlinks)))
+        if hasattr(args, "output_data"):
+            progress.expect(*scan_size(args.output_data, partial(modified_walk, ignore=IgnoreMatcher(output_ignore),
+                                                                 follow_symlinks=follow_symlinks)))
+    checkpoint = None
+    checkpoint_interval = getattr(args, "checkpoint_interval", 0)
+    if checkpoint_interval:
+        options = {"algorithm": algorithm, "fingerprint_threshold": fingerprint_threshold,
+                   "chunk_threshold": chunk_threshold, "archive_members": archive_members}
+        checkpoint = Checkpoint(checkpoint_path(args.catalogue_results, args.command), options,
+                                interval=checkpoint_interval)
+    manifest_writer = None
+    if getattr(args, "stream_outputs", False) and hasattr(args, "output_data") and os.path.isdir(args.output_data):
+        manifest_writer = ManifestWriter(os.path.join(args.catalogue_results, manifest_name(timestamp, args.command)))
+    cache = open_cache(args)
+    completed = False
+    try:
+        if reuse_input is None:
+            input_hash = hash_input(args.input_data, cache=cache, algorithm=algorithm,
+                                    mode=getattr(args, "input_mode", "full"), jobs=jobs,
+                                    tree=input_tree, manifest=input_manifest, prefetch=prefetch,
+                                    ignore=IgnoreMatcher(input_ignore),
+                                    fingerprint_threshold=fingerprint_threshold,
+                                    chunk_threshold=chunk_threshold, chunks=chunks,
+                                    follow_symlinks=follow_symlinks, special=special,
+                                    archive_members=archive_members, members=members,
+                                    progress=progress, checkpoint=checkpoint)
+        else:
+            input_hash = reuse_input["input_data"][args.input_data]
+            input_tree.update(reuse_input.get("input_tree", {}).get(args.input_data, {}))
+            inside = lambda path: path == args.input_data or path.startswith(os.path.join(args.input_data, ""))
+            for key, found in [("chunks", chunks), ("members", members), ("special_files", special)]:
+                found.update((path, value) for path, value in reuse_input.get(key, {}).items() if inside(path))
+        state = getattr(args, "repo_state", None) or repo_state(args.code, excludes=git_excludes(args))
+        code_identity = getattr(args, "code_identity", "commit")
+        results = {
+            "timestamp": {
+                args.command: timestamp
+            },
+            "input_data": {
+                args.input_data : input_hash
+            },
+            "code": {
+                args.code : hash_code(args.code, args.catalogue_results, state=state, identity=code_identity)
+            }
         }
-    }
-    if hasattr(args, 'output_data'):
-        results["output_data"] = {}
-        results["output_data"].update({args.output_data : hash_output(args.output_data)})
+        if code_identity == "tree":
+            # the commit is kept for reference, but not compared
+            results["code_commit"] = {args.code: state.head}
+        if hasattr(args, 'output_data'):
+            results["output_data"] = {}
+            results["output_data"].update({
+                args.output_data : hash_output(args.output_data, jobs=jobs, cache=cache, algorithm=algorithm,
+                                               prefetch=prefetch, ignore=IgnoreMatcher(output_ignore),
+                                               fingerprint_threshold=fingerprint_threshold,
+                                               chunk_threshold=chunk_threshold, chunks=chunks,
+                                               follow_symlinks=follow_symlinks, special=special,
+                                               archive_members=archive_members, members=members,
+                                               progress=progress, checkpoint=checkpoint,
+                                               manifest_writer=manifest_writer)
+            })
+            if manifest_writer is not None:
+                manifest_writer.close()
+                results["output_manifest"] = {
+                    args.output_data: {"file": manifest_writer.path, "files": manifest_writer.files}
+                }
+        if input_tree:
+            results["input_tree"] = {args.input_data: input_tree}
+        if input_manifest:
+            results["input_manifest"] = {
+                args.input_data: pack_manifest(input_manifest, compress=input_manifest_mode == "compressed")
+            }
+        elif reuse_input is not None and "input_manifest" in reuse_input:
+            results["input_manifest"] = {args.input_data: reuse_input["input_manifest"][args.input_data]}
+        ignore = {key: value for key, value in [("input_data", input_ignore), ("output_data", output_ignore)]
+                  if value}
+        if ignore:
+            results["ignore"] = ignore
+        if fingerprint_threshold:
+            results["fingerprint_threshold"] = fingerprint_threshold
+        if chunk_threshold:
+            results["chunk_threshold"] = chunk_threshold
+        if chunks:
+            results["chunks"] = dict(sorted(chunks.items()))
+        if archive_members:
+            results["archive_members"] = True
+        if members:
+            results["members"] = dict(sorted(members.items()))
+        if follow_symlinks:
+            results["follow_symlinks"] = True
+        if special:
+            for path, kind in sorted(special.items()):
+                print("Skipping {} ({})".format(path, kind))
+            results["special_files"] = dict(sorted(special.items()))
+        completed = True
+    finally:
+        if cache is not None:
+            cache.close()
+        if progress is not None:
+            progress.close()
+        # an interrupted run keeps its checkpoint, to resume from
+        if checkpoint is not None and completed:
+            checkpoint.discard()
+        elif checkpoint is not None:
+            checkpoint.close()
+        if manifest_writer is not None and not completed:
+            manifest_writer.discard()
+    if checkpoint is not None and checkpoint.resumed:
+        print("Resumed {} files hashed before an interrupted run".format(checkpoint.resumed))
+    if show_progress:
+        print(progress.summary())
+    if record_stats:
+        results["hashing_stats"] = progress.stats()
     return results
 
 
@@ -243,6 +1993,9 @@ def store_hash(hash_dict, timestamp, store, ext="json"):
     """
     Save hash information to <timestamp.ext> file.
 
+    The file is written under a temporary name and renamed once it is on
+    disk, so it is either complete or absent, even after a crash.
+
     Parameters
     ----------
     hash_dict: dict { str: dict }
@@ -261,14 +2014,27 @@ def store_hash(hash_dict, timestamp, store, ext="json"):
 
     os.makedirs(store, exist_ok=True)
 
-    with open(os.path.join(store, "{}.{}".format(timestamp, ext)),"w") as f:
+    if "output_manifest" in hash_dict:
+        # the manifest is found relative to the record, wherever it is moved
+        hash_dict = dict(hash_dict, output_manifest={
+            key: dict(value, file=os.path.relpath(value["file"], store))
+            for key, value in hash_dict["output_manifest"].items()})
+
+    path = os.path.join(store, "{}.{}".format(timestamp, ext))
+    with open(path + ".tmp", "w") as f:
         json.dump(hash_dict, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
 
 
 def load_hash(filepath):
     """
     Load hashes from json file.
 
+    The paths of output manifests, stored relative to the file, are made
+    relative to the current directory.
+
     Parameters
     ----------
     filepath : str
@@ -279,16 +2045,43 @@ def load_hash(filepath):
     dict { str : dict }
     """
     with open(filepath, "r") as f:
-        return json.load(f)
+        hash_dict = json.load(f)
+    for value in hash_dict.get("output_manifest", {}).values():
+        value["file"] = os.path.join(os.path.dirname(filepath), value["file"])
+    return hash_dict
+
 
+def remove_manifests(hash_dict):
+    """
+    Delete the output manifests of a hash dictionary that is not saved.
+
+    Parameters
+    ----------
+    hash_dict : dict { str : dict }
 
-def save_csv(hash_dict, timestamp, store):
+    Returns
+    -------
+    None
+    """
+    for value in hash_dict.get("output_manifest", {}).values():
+        if os.path.exists(value["file"]):
+            os.remove(value["file"])
+
+
+CSV_HEADERS = ["id" ,"disengage", "engage", "input_data", "input_hash",
+               "code", "code_hash", "output_data", "output_file1", "output_hash1"]
+
+
+def save_csv(hash_dict, timestamp, store, timeout=CSV_LOCK_TIMEOUT):
     """
     Save hash information to CSV file
 
     Dumps the relevant hash information into a line in a CSV file. If the file does not
     exist, a new file is created. If the file exists, it appends the record to the existing
     file as long as the header information is consistent with the desired output format.
+    The sidecar index of the file (see `index_csv`) is then brought up to date.
+
+    The file is locked while the record is appended, see `save_csv_many`.
 
     Parameters
     ----------
@@ -298,37 +2091,218 @@ def save_csv(hash_dict, timestamp, store):
         timestamp (will be used as an id for this run)
     store: str
         path to CSV file where
+    timeout: float, optional
+        seconds to wait for other processes appending to the file
 
     Returns
     -------
     None
     """
+    save_csv_many([(hash_dict, timestamp)], store, timeout=timeout)
 
-    headers = ["id" ,"disengage", "engage", "input_data", "input_hash",
-               "code", "code_hash", "output_data", "output_file1", "output_hash1"]
+
+def save_csv_many(records, store, timeout=CSV_LOCK_TIMEOUT):
+    """
+    Save several records to a CSV file in one append
+
+    The file is opened once, and locked with an advisory lock (`fcntl.lockf`, which also
+    works on NFS) while its header is checked, once, and the rows of all the records are
+    appended in a single write. Processes saving to the same file at the same time, such as
+    the `disengage` runs of an array job, wait for each other, so rows never interleave.
+    The sidecar index (see `index_csv`) is updated under the same lock. Without `fcntl`
+    (on Windows), the file is not locked.
+
+    Parameters
+    ----------
+    records: list of tuple (dict { str: dict }, str)
+        hash dictionaries and the timestamps to save them with, see `save_csv`
+    store: str
+        path to CSV file
+    timeout: float, optional
+        seconds to wait for other processes appending to the file
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    TimeoutError
+        if the file is still locked by another process after timeout seconds
+    """
+    for hash_dict, _ in records:
+        assert "output_manifest" not in hash_dict, "Streamed output digests cannot be saved to a CSV file"
+        # the CSV columns have no room for the patterns, without which the record cannot be
+        # compared with the current state
+        assert "ignore" not in hash_dict, "Records made with ignore patterns cannot be saved to a CSV file"
+        # nor for the fingerprint threshold or for following symlinks, without which the
+        # current state would not be hashed in the same way to compare them
+        assert "fingerprint_threshold" not in hash_dict, \
+            "Records made with a fingerprint threshold cannot be saved to a CSV file"
+        assert "follow_symlinks" not in hash_dict, \
+            "Records made with --follow_symlinks cannot be saved to a CSV file"
+
+    rows = io.StringIO()
+    fwriter = csv.writer(rows)
+    for hash_dict, timestamp in records:
+        output_key = list(hash_dict["output_data"].keys())[0]
+        fwriter.writerow([timestamp, hash_dict["timestamp"]["disengage"], hash_dict["timestamp"]["engage"]] +
+                    list(hash_dict["input_data"].keys()) + list(hash_dict["input_data"].values()) +
+                    list(hash_dict["code"].keys())       + list(hash_dict["code"].values()) +
+                    [ output_key ] +
+                    list(chain.from_iterable((i, j) for (i, j) in zip(hash_dict["output_data"][output_key].keys(),
+                                                                      hash_dict["output_data"][output_key].values()))))
 
     os.makedirs(os.path.dirname(store), exist_ok=True)
 
-    try:
-        needs_header = False
-        with open(store, 'r') as f:
-            line = f.readline().strip().split(",")
-            print(line)
-            assert line == headers, "Existing CSV file header is not formatted correctly"
-    except FileNotFoundError:
-        needs_header = True
-    finally:
-        with open(store, 'a') as f:
-            fwriter = csv.writer(f)
-            if needs_header:
-                fwriter.writerow(headers)
-            output_key = list(hash_dict["output_data"].keys())[0]
-            fwriter.writerow([timestamp, hash_dict["timestamp"]["disengage"], hash_dict["timestamp"]["engage"]] +
-                        list(hash_dict["input_data"].keys()) + list(hash_dict["input_data"].values()) +
-                        list(hash_dict["code"].keys())       + list(hash_dict["code"].values()) +
-                        [ output_key ] +
-                        list(chain.from_iterable((i, j) for (i, j) in zip(hash_dict["output_data"][output_key].keys(),
-                                                                          hash_dict["output_data"][output_key].values()))))
+    with open(store, 'a+') as f:
+        _lock_file(f, timeout)
+        try:
+            f.seek(0)
+            line = f.readline()
+            if line:
+                assert line.strip().split(",") == CSV_HEADERS, "Existing CSV file header is not formatted correctly"
+            else:
+                header = io.StringIO()
+                csv.writer(header).writerow(CSV_HEADERS)
+                rows = io.StringIO(header.getvalue() + rows.getvalue())
+            f.write(rows.getvalue())
+            f.flush()
+            os.fsync(f.fileno())
+            index_csv(store, update=True)
+        finally:
+            _unlock_file(f)
+
+
+def _lock_file(f, timeout):
+    """
+    Take an exclusive advisory lock on the open file f, waiting up to timeout seconds.
+    """
+    if fcntl is None:
+        return
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            fcntl.lockf(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return
+        except OSError:
+            if time.monotonic() >= deadline:
+                raise TimeoutError("{} is locked by another process".format(f.name))
+            time.sleep(0.05)
+
+
+def _unlock_file(f):
+    if fcntl is not None:
+        fcntl.lockf(f, fcntl.LOCK_UN)
+
+
+def csv_index_path(filepath):
+    """
+    Return the path of the sidecar index of the CSV file at filepath.
+    """
+    return "{}.{}".format(filepath, CSV_INDEX_EXT)
+
+
+def _read_csv_row(f):
+    """
+    Read the CSV row starting at the current position of the binary file f, which spans
+    several lines if a quoted field holds a line break.
+    """
+    row = f.readline()
+    while row.count(b'"') % 2 and row.endswith(b"\n"):
+        line = f.readline()
+        if not line:
+            break
+        row += line
+    return row
+
+
+def _row_at(f, offset):
+    """
+    Read and parse the CSV row at offset in the binary file f.
+    """
+    f.seek(offset)
+    return next(csv.reader(io.StringIO(_read_csv_row(f).decode(), newline="")), [])
+
+
+def index_csv(filepath, update=None):
+    """
+    Index the rows of a CSV file by their id
+
+    The sidecar index, at `csv_index_path(filepath)`, holds one line per row of the CSV
+    file (header included), with the id, byte offset and length of the row. As CSV files are
+    only appended to, rows added since the index was last updated are indexed by reading
+    them alone. If the index does not match the file (the file is shorter than the index
+    says, or the last indexed row is not at its offset), it is rebuilt from scratch.
+
+    Parameters
+    ----------
+    filepath : str
+        path to CSV file
+    update : bool, optional
+        whether to write the new entries to the index file. By default, an existing index
+        is updated, but no new index is created (`save_csv` creates them)
+
+    Returns
+    -------
+    str
+        the index, to look rows up in with `_csv_offset`
+    """
+    index_path = csv_index_path(filepath)
+    if update is None:
+        update = os.path.exists(index_path)
+
+    index = ""
+    rewrite = True
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = f.read()
+        # drop a line torn while the index was written
+        rewrite = not index.endswith("\n")
+        index = index[:index.rfind("\n") + 1]
+
+    new = []
+    with open(filepath, "rb") as f:
+        last = index[index.rfind("\n", 0, -1) + 1:].split(" ")
+        if index and not (len(last) == 3 and last[1].isdigit() and last[2].strip().isdigit() and
+                          int(last[1]) + int(last[2]) <= os.fstat(f.fileno()).st_size and
+                          _row_at(f, int(last[1]))[:1] == [last[0]]):
+            # the file was rewritten since it was indexed
+            index = ""
+            rewrite = True
+        f.seek(int(last[1]) + int(last[2]) if index else 0)
+        while True:
+            offset = f.tell()
+            row = _read_csv_row(f)
+            if not row.endswith(b"\n"):
+                # the end of the file, or a row still being written
+                break
+            run_id = next(csv.reader([row.split(b",", 1)[0].decode()]))[0]
+            new.append("{} {} {}\n".format(run_id, offset, len(row)))
+
+    # readers update the index too, without locking the file: appending the same entries
+    # twice is harmless, and a rewritten index replaces the old one in one step
+    if update and rewrite:
+        tmp_path = "{}.{}.tmp".format(index_path, os.getpid())
+        with open(tmp_path, "w") as f:
+            f.write(index + "".join(new))
+        os.replace(tmp_path, index_path)
+    elif update and new:
+        with open(index_path, "a") as f:
+            f.write("".join(new))
+    return index + "".join(new)
+
+
+def _csv_offset(index, run_id):
+    """
+    Return the byte offset of the first row with id run_id in an index made by `index_csv`,
+    or None.
+    """
+    start = ("\n" + index).find("\n{} ".format(run_id))
+    if start < 0:
+        return None
+    return int(index[start:index.index("\n", start)].split(" ")[1])
+
 
 def load_csv(filepath, timestamp):
     """
@@ -337,6 +2311,9 @@ def load_csv(filepath, timestamp):
     Load hash information from a CSV file from a specific time stamp. Returns a hash
     dictionary of the standard form outlined above.
 
+    The row is found with the index of the file (see `index_csv`) rather than by reading the
+    file from the top.
+
     The timestamp must be a 15 character timestamp string. If the specific entry is not found
     in the CSV file, an EOFError is thrown. Also performs a number of checks of the length
     of the existing record, and confirms that the timestamps and hashes are of the correct
@@ -355,28 +2332,89 @@ def load_csv(filepath, timestamp):
     dict { str : dict }
     """
 
-    assert isinstance(timestamp, str)
-    assert len(timestamp) == 15, "bad format for timestamp"
+    return load_csv_many(filepath, [timestamp])[0]
+
+
+def load_csv_many(filepath, timestamps):
+    """
+    Load hashes from several time stamps from a CSV file
 
-    found_record = None
+    Like `load_csv`, but finds all the records in one pass. The rows are found with the
+    index of the file (see `index_csv`), and read directly from their offsets.
 
+    Parameters
+    ----------
+    filepath : str
+        path to CSV file to be loaded
+    timestamps : list of str
+        timestamps of desired analyses to be loaded
+
+    Returns
+    -------
+    list of dict { str : dict }
+        in the order of timestamps
+    """
+    for timestamp in timestamps:
+        assert isinstance(timestamp, str)
+        assert len(timestamp) == 15, "bad format for timestamp"
+
+    def find_rows(f):
+        offsets = [_csv_offset(index, timestamp) for timestamp in timestamps]
+        return [None if offset is None else _row_at(f, offset) for offset in offsets]
+
+    index = index_csv(filepath)
+    with open(filepath, "rb") as f:
+        rows = find_rows(f)
+        if any(row is not None and row[:1] != [timestamp] for row, timestamp in zip(rows, timestamps)):
+            # the index is out of date in a way that index_csv could not tell, so start again
+            index_path = csv_index_path(filepath)
+            update = os.path.exists(index_path)
+            if update:
+                os.remove(index_path)
+            index = index_csv(filepath, update=update)
+            rows = find_rows(f)
+
+    records = []
+    for row, timestamp in zip(rows, timestamps):
+        if row is None:
+            raise EOFError("Unable to find desired record in {}".format(filepath))
+        records.append(_csv_record(row, timestamp, filepath))
+    return records
+
+
+def load_csv_records(filepath):
+    """
+    Load every record in a CSV file
+
+    Parameters
+    ----------
+    filepath : str
+        path to CSV file to be loaded
+
+    Returns
+    -------
+    generator of tuple (str, dict { str : dict })
+        the id (timestamp) and hash dictionary of each record, in the order of the file
+    """
     with open(filepath, "r") as f:
         freader = csv.reader(f)
+        next(freader, None)
         for line in freader:
-            if line[0] == timestamp:
-                found_record = list(line)
-                break
+            if line:
+                yield line[0], _csv_record(line, line[0], filepath)
 
-    if found_record is None:
-        raise EOFError("Unable to find desired record in {}".format(filepath))
 
+def _csv_record(found_record, timestamp, filepath):
+    """
+    Check a line of a CSV file and turn it into a hash dictionary.
+    """
     assert len(found_record) >= 9, "bad length for record {} in {}".format(timestamp, filepath)
     assert len(found_record) % 2 == 0, "bad length for record {} in {}".format(timestamp, filepath)
     for i in range(3):
         assert len(found_record[i]) == 15
     for i in [4] + list(range(9, len(found_record), 2)):
-        assert len(found_record[i]) == 128
-    assert len(found_record[6]) == 40
+        assert check_digest(found_record[i]), "bad hash in record {} in {}".format(timestamp, filepath)
+    assert len(found_record[6]) == 40 or found_record[6].startswith("tree:")
 
     result = {
         "timestamp": {
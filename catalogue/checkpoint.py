@@ -0,0 +1,165 @@
+import os
+import json
+import time
+
+from .cache import RACY_WINDOW, stat_key
+
+# seconds between writes of the digests computed so far to the checkpoint
+DEFAULT_CHECKPOINT_INTERVAL = 60
+
+
+def checkpoint_path(catalogue_results, command):
+    """
+    Return the path of the checkpoint of command in catalogue_results.
+    """
+    return os.path.join(catalogue_results, "{}.checkpoint".format(command))
+
+
+class Checkpoint:
+    """
+    Journal of the files hashed so far, so that an interrupted run can
+    resume without hashing them again.
+
+    The digest of each file (with its chunk table and member digests, see
+    `file_digest`) is recorded with the device, inode, size, modification time
+    and change time the file had before it was hashed, and written to the
+    journal every `interval` seconds. When a checkpoint is opened on a
+    journal left by an interrupted run, the digests in it are reused for
+    files whose stat data is still the same. The first line of the journal
+    holds the hashing options; a journal made with other options is started
+    again.
+
+    Like `DigestCache`, files modified within `RACY_WINDOW` seconds before
+    the checkpoint was opened, and files that changed while they were read,
+    are not recorded.
+
+    Parameters
+    ----------
+    path : str
+        path to the journal
+    options : dict
+        hashing options that the digests depend on
+    interval : float, optional
+        seconds between writes to the journal
+
+    Attributes
+    ----------
+    resumed : int
+        number of files whose digests were reused from the journal
+    """
+
+    def __init__(self, path, options, interval=DEFAULT_CHECKPOINT_INTERVAL):
+        self.path = path
+        self.options = options
+        self.interval = interval
+        self.resumed = 0
+        self._done = {}
+        self._before = {}
+        self._pending = []
+        self._started = time.time()
+        self._written = time.monotonic()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        torn = self._load()
+        if torn is None:
+            self._f = open(path, "w")
+            self._f.write(json.dumps(options, sort_keys=True) + "\n")
+            self._f.flush()
+        else:
+            self._f = open(path, "a")
+            if torn:
+                # finish the line being written when the run was interrupted
+                self._f.write("\n")
+
+    def _load(self):
+        """
+        Read the digests in an existing journal made with the same options.
+        Returns None if there is none, else whether its last line is torn.
+        """
+        try:
+            with open(self.path) as f:
+                lines = f.read().split("\n")
+        except FileNotFoundError:
+            return None
+        try:
+            if json.loads(lines[0]) != json.loads(json.dumps(self.options)):
+                return None
+        except ValueError:
+            return None
+        for line in lines[1:]:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # a line torn by the interruption
+                continue
+            self._done[entry["path"]] = (tuple(entry["key"]), tuple(entry["result"]))
+        return lines[-1] != ""
+
+    def lookup(self, path, st):
+        """
+        Return the digest, chunk table and member digests recorded for the
+        file at path with stat result `st`, or None. A file that is not
+        found is expected to be hashed and passed to `record`, or else
+        passed to `forget`.
+        """
+        key = os.path.abspath(path)
+        entry = self._done.get(key)
+        if entry is not None and entry[0] == stat_key(st):
+            self.resumed += 1
+            return entry[1]
+        self._before[key] = stat_key(st)
+        return None
+
+    def record(self, path, result):
+        """
+        Record the digest, chunk table and member digests of the file at path.
+        """
+        key = os.path.abspath(path)
+        before = self._before.pop(key, None)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        if before is None or stat_key(st) != before or st.st_mtime >= self._started - RACY_WINDOW:
+            return
+        self._pending.append(json.dumps({"path": key, "key": before, "result": list(result)}))
+        if time.monotonic() - self._written >= self.interval:
+            self.write()
+
+    def forget(self, path):
+        """
+        Forget the file at path, not found by `lookup`, that will not be
+        hashed after all (it was found in the digest cache).
+        """
+        self._before.pop(os.path.abspath(path), None)
+
+    def write(self):
+        """
+        Write the digests recorded since the last write to the journal.
+        """
+        if self._pending:
+            self._f.write("".join(line + "\n" for line in self._pending))
+            self._f.flush()
+            os.fsync(self._f.fileno())
+            self._pending = []
+        self._written = time.monotonic()
+
+    def close(self):
+        """
+        Write any recorded digests and close the journal, to resume from.
+        """
+        if self._f is not None:
+            self.write()
+            self._f.close()
+            self._f = None
+
+    def discard(self):
+        """
+        Close and delete the journal, once the run has finished.
+        """
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -1,5 +1,10 @@
 import os
+import copy
+import posixpath
+from collections import defaultdict
 from . import catalogue as ct
+from .manifest import read_manifest, merge_manifests
+from .store import RecordStore, store_path
 from .utils import create_timestamp
 
 def compare(args):
@@ -8,25 +13,60 @@ def compare(args):
 
     Compares two hash files, given as input arguments to the command line tool.
     If only one file is given that input is compared to the current state.
+    With `--csv` or `--store sqlite`, the records are given by their ids
+    (timestamps) in the CSV file or record store instead.
     Prints results on the command line.
     """
 
     assert len(args.hashes) == 1 or len(args.hashes) == 2, "compare can only accept 1 or 2 hash files"
 
-    if args.csv is None:
-        hash_dict_1 = ct.load_hash(args.hashes[0])
+    if args.csv is not None:
+        records = dict(zip(args.hashes[:2], ct.load_csv_many(os.path.join(args.catalogue_results, args.csv),
+                                                             args.hashes[:2])))
+        load = records.get
+    elif getattr(args, "store", "json") == "sqlite":
+        store = RecordStore(store_path(args.catalogue_results))
+        records = {run_id: store.load(run_id) for run_id in args.hashes[:2]}
+        store.close()
+        load = records.get
     else:
-        hash_dict_1 = ct.load_csv(os.path.join(args.catalogue_results, args.csv), args.hashes[0])
+        load = ct.load_hash
+
+    hash_dict_1 = load(args.hashes[0])
 
     if len(args.hashes) == 2:
-        if args.csv is None:
-            hash_dict_2 = ct.load_hash(args.hashes[1])
-        else:
-            hash_dict_2 = ct.load_csv(os.path.join(args.catalogue_results, args.csv), args.hashes[1])
+        hash_dict_2 = load(args.hashes[1])
     else:
+        # hash the current state in the same way as the record
+        args = copy.copy(args)
+        vars(args).update(ct.record_options(hash_dict_1))
         hash_dict_2 = ct.construct_dict(create_timestamp(), args)
 
-    print_comparison(compare_hashes(hash_dict_1, hash_dict_2))
+    try:
+        comparison = compare_hashes(hash_dict_1, hash_dict_2)
+    finally:
+        if len(args.hashes) == 1:
+            ct.remove_manifests(hash_dict_2)
+    if getattr(args, "verify_full", False):
+        verify_fingerprints(hash_dict_1, hash_dict_2, comparison, getattr(args, "verify_full_threshold", 0))
+    print_comparison(comparison)
+
+    fingerprinted = fingerprint_matches(hash_dict_1, hash_dict_2, comparison["matches"])
+    if fingerprinted:
+        print("\n".join([
+            "NOTE these hashes only match by fingerprint, not by their full contents:",
+            *fingerprinted,
+            ""
+            ]))
+
+    chunk_lines = chunk_changes(hash_dict_1, hash_dict_2, comparison["differs"])
+    if chunk_lines:
+        print("\n".join([
+            "changed chunks in {} files:".format(len(chunk_lines)),
+            "=========================",
+            *chunk_lines,
+            ""
+            ]))
 
 
 def compare_hashes(hash_dict_1, hash_dict_2):
@@ -36,7 +76,27 @@ def compare_hashes(hash_dict_1, hash_dict_2):
     Compare two hash dictionaries. Returns a dictionary mapping a string to a list, which
     summarizes the matches (when two hashes are identical), differences (when a hash has been
     computed for the same entity twice and they are different), and failures (when an entry
-    only exists in one of the two hash dictionaries).
+    only exists in one of the two hash dictionaries, or the two hashes were computed with
+    different algorithms, or the input data with different ignore patterns, or the code is
+    identified by its commit in one and by its git tree in the other).
+
+    Code identified by its git tree ("tree:<digest>", see `hash_code`) matches whenever the
+    files of the code directory are the same, even if the commits recorded under
+    "code_commit" differ.
+
+    If an archive differs and both dictionaries hold the digests of the files inside it (under
+    "members"), the changed files are also listed as differences, as "<archive>::<file>", and
+    files only in one of them as failures.
+
+    If the input data differs and both dictionaries hold manifests of the input files (under
+    "input_manifest"), the changed input files are also listed as differences, and input files
+    only in one manifest as failures. Otherwise, if both hold Merkle tree digests of the input
+    directory (under "input_tree"), the changed subdirectories are listed as differences.
+
+    If either dictionary holds the digests of its output files in a manifest (under
+    "output_manifest", see `hash_dir_to_manifest`), the two sets of output files are merged
+    one file at a time: differing files and files only in one of them are listed, while the
+    matching files are counted, and listed as one entry "<n> files in <output path>".
 
     Parameters
     ----------
@@ -61,11 +121,24 @@ def compare_hashes(hash_dict_1, hash_dict_2):
             entry_2 = get_h(hash_dict_2[key])
         except KeyError:
             failures.append(key)
+            continue
 
-        if entry_1 == entry_2:
+        if key == "input_data" and not (_same_scheme(entry_1, entry_2) and
+                                        ct.record_ignore(hash_dict_1, key) == ct.record_ignore(hash_dict_2, key)):
+            failures.append(key)
+        elif key == "code" and entry_1.startswith("tree:") != entry_2.startswith("tree:"):
+            # a commit and a tree digest cannot be compared
+            failures.append(key)
+        elif entry_1 == entry_2:
             matches.append(key)
         else:
             differs.append(key)
+            if key == "input_data":
+                input_differs, input_failures = compare_inputs(hash_dict_1, hash_dict_2)
+                member_differs, member_failures = compare_members(hash_dict_1, hash_dict_2,
+                                                                  list(hash_dict_1[key].keys())[0])
+                differs.extend(input_differs + member_differs)
+                failures.extend(input_failures + member_failures)
 
     try:
         output_1 = get_h(hash_dict_1["output_data"])
@@ -81,25 +154,354 @@ def compare_hashes(hash_dict_1, hash_dict_2):
     if output_1 is None and output_2 is None:
         failures.append("output_data")
     elif output_1 is None:
-        failures.extend(output_2.keys())
+        failures.extend(_output_summary(hash_dict_2))
     elif output_2 is None:
-        failures.extend(output_1.keys())
+        failures.extend(_output_summary(hash_dict_1))
+    elif "output_manifest" in hash_dict_1 or "output_manifest" in hash_dict_2:
+        # compare the streamed outputs without holding them in memory
+        matched = 0
+        for out_file, digest_1, digest_2 in merge_manifests(_output_items(hash_dict_1), _output_items(hash_dict_2)):
+            if digest_1 is None or digest_2 is None or not _same_scheme(digest_1, digest_2):
+                failures.append(out_file)
+            elif digest_1 == digest_2:
+                matched += 1
+            else:
+                differs.append(out_file)
+                member_differs, member_failures = compare_members(hash_dict_1, hash_dict_2, out_file)
+                differs.extend(member_differs)
+                failures.extend(member_failures)
+        if matched:
+            matches.append("{} files in {}".format(matched, list(hash_dict_1["output_data"].keys())[0]))
     else:
         # both accesses succeeded, check each unique file
         all_outputs = list(output_1.keys() | output_2.keys()) # union of two dict_keys objects converted to list
 
         for out_file in all_outputs:
             try:
-                if output_1[out_file] == output_2[out_file]:
+                if not _same_scheme(output_1[out_file], output_2[out_file]):
+                    failures.append(out_file)
+                elif output_1[out_file] == output_2[out_file]:
                     matches.append(out_file)
                 else:
                     differs.append(out_file)
+                    member_differs, member_failures = compare_members(hash_dict_1, hash_dict_2, out_file)
+                    differs.extend(member_differs)
+                    failures.extend(member_failures)
             except KeyError:
                 failures.append(out_file)
 
     return { "matches" : matches, "differs" : differs, "failures" : failures }
 
 
+def _output_items(hash_dict):
+    """
+    Yield the (path, digest) pairs of the output files of a hash dictionary, sorted by path,
+    from its output manifest if it has one.
+    """
+    if "output_manifest" in hash_dict:
+        return read_manifest(list(hash_dict["output_manifest"].values())[0]["file"])
+    return iter(sorted(list(hash_dict["output_data"].values())[0].items()))
+
+
+def _output_summary(hash_dict):
+    """
+    List the output files of a hash dictionary, or summarise them if they are in a manifest.
+    """
+    if "output_manifest" in hash_dict:
+        output_path, manifest = list(hash_dict["output_manifest"].items())[0]
+        return ["{} files in {}".format(manifest["files"], output_path)]
+    return list(list(hash_dict["output_data"].values())[0].keys())
+
+
+def _same_scheme(digest_1, digest_2):
+    return ct.split_digest(digest_1)[0] == ct.split_digest(digest_2)[0]
+
+
+def _file_digests(hash_dict):
+    """
+    Map the names of the entries of a hash dictionary that are hashes of single files to
+    the file path and digest.
+    """
+    get_h = lambda x: list(x.values())[0]
+    entries = {}
+    if "input_data" in hash_dict:
+        input_path, digest = list(hash_dict["input_data"].items())[0]
+        if ct.split_label(ct.split_digest(digest)[0])[0] != "merkle":
+            entries["input_data"] = (input_path, digest)
+    if "output_data" in hash_dict:
+        for path, digest in get_h(hash_dict["output_data"]).items():
+            entries[path] = (path, digest)
+    return entries
+
+
+def verify_fingerprints(hash_dict_1, hash_dict_2, comparison, threshold=0):
+    """
+    Settle comparisons between a fingerprint and a full hash of a file using the file on disk
+
+    A fingerprint (see `fingerprint_file`) and a hash of the full contents cannot be compared
+    directly, so `compare_hashes` lists them as failures. If the file still exists, it is
+    fingerprinted and hashed in full: when both match, so do the two hash dictionaries; when
+    only one matches, they differ. Otherwise, or if the file is larger than threshold bytes, the
+    entry stays a failure.
+
+    Parameters
+    ----------
+    hash_dict_1: dict { str : dict }
+        First hash dictionary
+    hash_dict_2: dict { str : dict }
+        Second hash dictionary
+    comparison: dict {str: list}
+        Output of `compare_hashes`, updated in place
+    threshold: int, optional
+        Size in bytes of the largest file to hash in full, or 0 (default) for no limit
+
+    Returns
+    -------
+    None
+    """
+    entries_1 = _file_digests(hash_dict_1)
+    entries_2 = _file_digests(hash_dict_2)
+    for name in list(comparison["failures"]):
+        if name not in entries_1 or name not in entries_2:
+            continue
+        path, digest_1 = entries_1[name]
+        digest_2 = entries_2[name][1]
+        mode_1, algorithm_1 = ct.split_label(ct.split_digest(digest_1)[0])
+        mode_2, algorithm_2 = ct.split_label(ct.split_digest(digest_2)[0])
+        if {mode_1, mode_2} != {"fp", None} or algorithm_1 != algorithm_2 or not os.path.isfile(path):
+            continue
+        if threshold and os.path.getsize(path) > threshold:
+            continue
+
+        current = {
+            "fp": ct.format_digest(ct.fingerprint_file(path, algorithm=algorithm_1).hexdigest(), algorithm_1, "fp"),
+            None: ct.format_digest(ct.hash_file(path, algorithm=algorithm_1).hexdigest(), algorithm_1)
+        }
+        same_1 = current[mode_1] == digest_1
+        same_2 = current[mode_2] == digest_2
+        if same_1 or same_2:
+            comparison["failures"].remove(name)
+            comparison["matches" if same_1 and same_2 else "differs"].append(name)
+
+
+def fingerprint_matches(hash_dict_1, hash_dict_2, matches):
+    """
+    Find the matches between two hash dictionaries that only compare fingerprints
+
+    Parameters
+    ----------
+    hash_dict_1: dict { str : dict }
+        First hash dictionary
+    hash_dict_2: dict { str : dict }
+        Second hash dictionary
+    matches: list of str
+        Matching entries, as listed by `compare_hashes`
+
+    Returns
+    -------
+    list of str
+    """
+    entries = _file_digests(hash_dict_1)
+    fingerprinted = []
+    for name in matches:
+        if name in entries:
+            fingerprinted_file = ct.split_label(ct.split_digest(entries[name][1])[0])[0] == "fp"
+        else:
+            fingerprinted_file = False
+        # the Merkle tree of an input directory may include fingerprints of its files
+        tree_with_fingerprints = name == "input_data" and name not in entries and (
+            hash_dict_1.get("fingerprint_threshold") or hash_dict_2.get("fingerprint_threshold"))
+        if fingerprinted_file or tree_with_fingerprints:
+            fingerprinted.append(name)
+    return fingerprinted
+
+
+def changed_chunks(table_1, table_2):
+    """
+    Find the chunks of a file that are not in an earlier version of it
+
+    Chunks are matched on their digests wherever they are in the file, so data that only
+    moved (because of an insertion or deletion earlier in the file) is not counted as
+    changed.
+
+    Parameters
+    ----------
+    table_1: str
+        Chunk table of the earlier version, from `pack_chunks`
+    table_2: str
+        Chunk table of the later version
+
+    Returns
+    -------
+    tuple (int, int, list of (int, int))
+        the number of chunks of the later version that are new, the number of chunks in
+        it, and the first and last byte of each stretch of new chunks
+    """
+    chunks_1 = set(digest for _, digest in ct.unpack_chunks(table_1)[1])
+    chunks_2 = ct.unpack_chunks(table_2)[1]
+    changed = 0
+    ranges = []
+    offset = 0
+    for length, digest in chunks_2:
+        if digest not in chunks_1:
+            changed += 1
+            if ranges and ranges[-1][1] == offset - 1:
+                ranges[-1] = (ranges[-1][0], offset + length - 1)
+            else:
+                ranges.append((offset, offset + length - 1))
+        offset += length
+    return changed, len(chunks_2), ranges
+
+
+def chunk_changes(hash_dict_1, hash_dict_2, differs):
+    """
+    Describe the changed chunks of differing files that both hash dictionaries have chunk
+    tables for (under "chunks").
+
+    Parameters
+    ----------
+    hash_dict_1: dict { str : dict }
+        First hash dictionary
+    hash_dict_2: dict { str : dict }
+        Second hash dictionary
+    differs: list of str
+        Differing entries, as listed by `compare_hashes`
+
+    Returns
+    -------
+    list of str
+        one line per file, with the number of changed chunks and their byte ranges in the
+        file of the second hash dictionary
+    """
+    tables_1 = {os.path.normpath(path): table for path, table in hash_dict_1.get("chunks", {}).items()}
+    tables_2 = {os.path.normpath(path): table for path, table in hash_dict_2.get("chunks", {}).items()}
+    lines = []
+    for name in differs:
+        path = list(hash_dict_1["input_data"].keys())[0] if name == "input_data" else name
+        path = os.path.normpath(path)
+        if path not in tables_1 or path not in tables_2:
+            continue
+        if ct.split_digest(tables_1[path])[0] != ct.split_digest(tables_2[path])[0]:
+            continue
+        changed, total, ranges = changed_chunks(tables_1[path], tables_2[path])
+        if ranges:
+            lines.append("{}: {} of {} chunks changed, bytes {}".format(
+                path, changed, total, ", ".join("{}-{}".format(first, last) for first, last in ranges)))
+        else:
+            lines.append("{}: no new chunks, data was only removed".format(path))
+    return lines
+
+
+def compare_members(hash_dict_1, hash_dict_2, path):
+    """
+    Find the files that differ inside an archive, if both hash dictionaries hold the digests
+    of its members (see `hash_archive`)
+
+    Parameters
+    ----------
+    hash_dict_1: dict { str : dict }
+        First hash dictionary
+    hash_dict_2: dict { str : dict }
+        Second hash dictionary
+    path: str
+        Path to the archive
+
+    Returns
+    -------
+    tuple (list of str, list of str)
+        files inside the archive, as "<archive>::<file>", that differ, and that are only in one
+        of the dictionaries
+    """
+    members_1 = {os.path.normpath(archive): files for archive, files in hash_dict_1.get("members", {}).items()}
+    members_2 = {os.path.normpath(archive): files for archive, files in hash_dict_2.get("members", {}).items()}
+    path = os.path.normpath(path)
+    if path not in members_1 or path not in members_2:
+        return [], []
+    files_1 = members_1[path]
+    files_2 = members_2[path]
+    join = lambda name: "{}::{}".format(path, name)
+    differs = [join(name) for name in sorted(files_1.keys() & files_2.keys()) if files_1[name] != files_2[name]]
+    failures = [join(name) for name in sorted(files_1.keys() ^ files_2.keys())]
+    return differs, failures
+
+
+def compare_inputs(hash_dict_1, hash_dict_2):
+    """
+    Find where the input data of two hash dictionaries differs
+
+    Uses the input file manifests if both hash dictionaries have one, and the Merkle trees
+    of input directory digests otherwise.
+
+    Parameters
+    ----------
+    hash_dict_1: dict { str : dict }
+        First hash dictionary
+    hash_dict_2: dict { str : dict }
+        Second hash dictionary
+
+    Returns
+    -------
+    tuple (list of str, list of str)
+        input paths (under the input path of the first dictionary) that differ, and that
+        could not be compared
+    """
+    get_h = lambda x: list(x.values())[0]
+    input_path = list(hash_dict_1["input_data"].keys())[0]
+    join = lambda relpath: os.path.normpath(os.path.join(input_path, relpath))
+
+    if "input_manifest" in hash_dict_1 and "input_manifest" in hash_dict_2:
+        manifest_1 = ct.unpack_manifest(get_h(hash_dict_1["input_manifest"]))
+        manifest_2 = ct.unpack_manifest(get_h(hash_dict_2["input_manifest"]))
+        differs = [join(relpath) for relpath in sorted(manifest_1.keys() & manifest_2.keys())
+                   if manifest_1[relpath] != manifest_2[relpath]]
+        failures = [join(relpath) for relpath in sorted(manifest_1.keys() ^ manifest_2.keys())]
+        return differs, failures
+
+    if "input_tree" in hash_dict_1 and "input_tree" in hash_dict_2:
+        tree_1 = get_h(hash_dict_1["input_tree"])
+        tree_2 = get_h(hash_dict_2["input_tree"])
+        return [join(relpath) for relpath in changed_dirs(tree_1, tree_2)], []
+
+    return [], []
+
+
+def changed_dirs(tree_1, tree_2):
+    """
+    Find the changed directories between two Merkle trees of directory digests
+
+    Walks down from the root, only descending into directories whose digests differ,
+    and returns the deepest changed directories: those with no changed subdirectories
+    (so the change is in their own files), and those that only exist in one tree.
+
+    Parameters
+    ----------
+    tree_1: dict { str : str }
+        Directory digests keyed on relative path, as filled in by `hash_dir_tree`
+    tree_2: dict { str : str }
+        Directory digests keyed on relative path
+
+    Returns
+    -------
+    list of str
+        sorted relative paths of the changed directories
+    """
+    children = defaultdict(list)
+    for relpath in tree_1.keys() | tree_2.keys():
+        if relpath != ".":
+            children[posixpath.dirname(relpath) or "."].append(relpath)
+
+    changed = []
+    stack = ["."] if tree_1.get(".") != tree_2.get(".") else []
+    while stack:
+        relpath = stack.pop()
+        changed_children = [child for child in children[relpath] if tree_1.get(child) != tree_2.get(child)]
+        if relpath not in tree_1 or relpath not in tree_2 or not changed_children:
+            changed.append(relpath)
+        else:
+            stack.extend(changed_children)
+    return sorted(changed)
+
+
 def print_comparison(compare_dict):
     """
     Print a nicely formatted summary of hash comparisons
@@ -1,6 +1,78 @@
 import os.path
 import yaml
 from .utils import read_config_file, CONFIG_LOC, dictionary_printer
+from .catalogue import ALGORITHMS, INPUT_MODES, INPUT_MANIFESTS, CODE_IDENTITIES
+from .store import STORES
+
+
+def _is_positive_int(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 1
+
+
+def _is_non_negative_int(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+
+def _is_bool(value):
+    return isinstance(value, bool)
+
+
+def _is_pattern_list(value):
+    return isinstance(value, list) and all(isinstance(pattern, str) for pattern in value)
+
+
+def _is_algorithm(value):
+    return value in ALGORITHMS
+
+
+def _is_code_identity(value):
+    return value in CODE_IDENTITIES
+
+
+def _is_store(value):
+    return value in STORES
+
+
+def _is_input_mode(value):
+    return value in INPUT_MODES
+
+
+def _is_input_manifest(value):
+    return value in INPUT_MANIFESTS
+
+
+# config keys holding paths, whose values must be strings
+PATH_KEYS = ['catalogue_results', 'code', 'csv', 'input_data', 'output_data']
+
+# config keys holding other options, mapped to a check of their value and
+# the description printed when the check fails
+OPTION_KEYS = {
+    'jobs': (_is_positive_int, 'a positive integer'),
+    'prefetch': (_is_non_negative_int, 'a non-negative integer'),
+    'cache': (_is_bool, 'true or false'),
+    'verify_cache': (_is_bool, 'true or false'),
+    'cache_size': (_is_positive_int, 'a positive integer'),
+    'algorithm': (_is_algorithm, 'one of {}'.format(', '.join(sorted(ALGORITHMS)))),
+    'input_mode': (_is_input_mode, 'one of {}'.format(', '.join(INPUT_MODES))),
+    'input_manifest': (_is_input_manifest, 'one of {}'.format(', '.join(INPUT_MANIFESTS))),
+    'ignore': (_is_pattern_list, 'a list of patterns'),
+    'fingerprint_threshold': (_is_non_negative_int, 'a non-negative integer'),
+    'chunk_threshold': (_is_non_negative_int, 'a non-negative integer'),
+    'follow_symlinks': (_is_bool, 'true or false'),
+    'archive_members': (_is_bool, 'true or false'),
+    'progress': (_is_bool, 'true or false'),
+    'record_stats': (_is_bool, 'true or false'),
+    'watch': (_is_bool, 'true or false'),
+    'use_daemon': (_is_bool, 'true or false'),
+    'checkpoint_interval': (_is_non_negative_int, 'a non-negative integer'),
+    'stream_outputs': (_is_bool, 'true or false'),
+    'git_exclude': (_is_pattern_list, 'a list of paths'),
+    'code_identity': (_is_code_identity, 'one of {}'.format(', '.join(CODE_IDENTITIES))),
+    'store': (_is_store, 'one of {}'.format(', '.join(STORES))),
+    'verify_full': (_is_bool, 'true or false'),
+    'verify_full_threshold': (_is_non_negative_int, 'a non-negative integer'),
+}
+
 
 def config_validator(config_loc):
 
@@ -12,8 +84,9 @@ def config_validator(config_loc):
 
     - config file can be read as a dictionary
     - argument keys are a subset of (`--input_data`, `--code`, `--output_data`, `-csv`
-    `catalogue_results`)
-    - argument values are all strings
+    `catalogue_results`) and the option keys in `OPTION_KEYS`
+    - path argument values are all strings
+    - option values pass the check for their key in `OPTION_KEYS`
 
     config_loc specifies the location of the config file. Commands that involve
     existing config files (such as the parser), will only use a validated config file.
@@ -37,17 +110,23 @@ def config_validator(config_loc):
     if isinstance(config_dict, dict):
 
         # checks that the config keys are a subset of the correct ones
-        valid_keys = ['catalogue_results','code','csv','input_data','output_data']
+        valid_keys = PATH_KEYS + list(OPTION_KEYS)
         if not set(config_dict.keys()).issubset(valid_keys):
             valid = False
             print('Config error: invalid keys present in the yaml file')
 
-        # check that all config file keys only have string values (i.e. no nested)
-        values_list = list(config_dict.values())
+        # check that all config file path keys only have string values (i.e. no nested)
+        values_list = [value for key, value in config_dict.items() if key not in OPTION_KEYS]
         for value in values_list:
             if not isinstance(value, str) and value is not None:
                 valid = False
                 print('Config error: config files are not all strings')
+
+        # check that the option keys have values of the right kind
+        for key, (check, description) in OPTION_KEYS.items():
+            if key in config_dict and not check(config_dict[key]):
+                valid = False
+                print('Config error: {} must be {}'.format(key, description))
     else:
         valid = False
         print('Config error: yaml file cannot be read as a dictionary')
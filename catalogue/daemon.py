@@ -0,0 +1,288 @@
+import os
+import sys
+import json
+import signal
+import socket
+import argparse
+import builtins
+import threading
+import traceback
+from contextlib import redirect_stdout, redirect_stderr
+
+from . import cache as cc
+from . import catalogue as ct
+from .engage import engage, disengage
+from .compare import compare
+
+SOCKET_NAME = "catalogue.sock"
+
+# the commands that are forwarded to a running daemon
+COMMANDS = {"engage": engage, "disengage": disengage, "compare": compare}
+
+
+class DaemonStopped(BaseException):
+    """
+    Raised in the daemon when it gets SIGTERM. It is not an Exception, so a
+    command that is running is stopped rather than reporting an error.
+    """
+
+
+def _stop(signum, frame):
+    raise DaemonStopped()
+
+
+def socket_path(catalogue_results):
+    """
+    Return the path of the socket of the daemon for catalogue_results.
+    """
+    return os.path.join(catalogue_results, SOCKET_NAME)
+
+
+def _send(f, message):
+    f.write(json.dumps(message) + "\n")
+    f.flush()
+
+
+def _connect(path):
+    """
+    Return a socket connected to the daemon listening on path, or None if
+    there is none.
+    """
+    if not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        # a socket left by a daemon that did not stop cleanly
+        sock.close()
+        return None
+    return sock
+
+
+def forward(args):
+    """
+    Run a command on the daemon for `args.catalogue_results`, if one is
+    running.
+
+    The command runs in the daemon with the arguments already parsed here,
+    including any taken from `catalogue_config.yaml`, and in the current
+    directory. Its output is written here as it runs, and any question it
+    asks is answered here.
+
+    Parameters
+    ----------
+    args : obj
+        Command line input arguments (argparse.Namespace).
+
+    Returns
+    -------
+    bool
+        True if the command ran on the daemon, False if no daemon is running
+        and the command should be run here
+
+    Raises
+    ------
+    SystemExit
+        if the command failed, or the daemon stopped before it finished
+    """
+    sock = _connect(socket_path(args.catalogue_results))
+    if sock is None:
+        return False
+    with sock, sock.makefile("rw", encoding="utf-8") as f:
+        _send(f, {
+            "args": {key: value for key, value in vars(args).items() if key != "func"},
+            "cwd": os.getcwd(),
+            "tty": {"out": sys.stdout.isatty(), "err": sys.stderr.isatty()}
+        })
+        for line in f:
+            message = json.loads(line)
+            if "out" in message:
+                sys.stdout.write(message["out"])
+                sys.stdout.flush()
+            elif "err" in message:
+                sys.stderr.write(message["err"])
+                sys.stderr.flush()
+            elif "input" in message:
+                _send(f, {"input": input(message["input"])})
+            else:
+                if message.get("error"):
+                    sys.stderr.write(message["error"])
+                if message["exit"]:
+                    raise SystemExit(message["exit"])
+                return True
+    raise SystemExit("The catalogue daemon stopped before the command finished")
+
+
+class _Stream:
+    """
+    A file that sends what is written to it to the client.
+    """
+
+    def __init__(self, f, name, tty):
+        self._f = f
+        self._name = name
+        self._tty = tty
+
+    def write(self, text):
+        if text:
+            _send(self._f, {self._name: text})
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return self._tty
+
+
+def _handle(f, home):
+    """
+    Run the command requested on f. Returns False if the daemon was asked
+    to stop, and raises DaemonStopped if it got SIGTERM while running the
+    command, after telling the client.
+    """
+    request = json.loads(f.readline())
+    if request.get("stop"):
+        _send(f, {"exit": 0})
+        return False
+
+    args = argparse.Namespace(**request["args"])
+    ask = lambda prompt="": (_send(f, {"input": prompt}), json.loads(f.readline())["input"])[1]
+    code, error, stopped = 0, None, False
+    original_input = builtins.input
+    builtins.input = ask
+    try:
+        os.chdir(request["cwd"])
+        with redirect_stdout(_Stream(f, "out", request["tty"]["out"])), \
+                redirect_stderr(_Stream(f, "err", request["tty"]["err"])):
+            COMMANDS[args.command](args)
+    except SystemExit as e:
+        if isinstance(e.code, int) or e.code is None:
+            code = e.code or 0
+        else:
+            code, error = 1, "{}\n".format(e.code)
+    except (BrokenPipeError, ConnectionResetError):
+        # the client has gone, so there is no one to tell
+        return True
+    except DaemonStopped:
+        code, error, stopped = 128 + signal.SIGTERM, "catalogue daemon stopped before {} finished\n".format(
+            args.command), True
+    except Exception:
+        code, error = 1, traceback.format_exc()
+    finally:
+        builtins.input = original_input
+        os.chdir(home)
+    try:
+        _send(f, {"exit": code, "error": error})
+    except (BrokenPipeError, ConnectionResetError):
+        pass
+    if stopped:
+        raise DaemonStopped()
+    return True
+
+
+def stop_daemon(catalogue_results):
+    """
+    Stop the daemon for catalogue_results.
+
+    Returns
+    -------
+    bool
+        False if no daemon was running
+    """
+    sock = _connect(socket_path(catalogue_results))
+    if sock is None:
+        return False
+    with sock, sock.makefile("rw", encoding="utf-8") as f:
+        _send(f, {"stop": True})
+        f.readline()
+    return True
+
+
+def serve(catalogue_results):
+    """
+    Run commands forwarded by `forward` until stopped by `stop_daemon`,
+    SIGTERM or Ctrl-C.
+
+    Git repositories, digest cache databases and thread pools are kept open
+    between commands, so each command only pays for opening them once.
+    Commands run one at a time, in the order they arrive.
+
+    Parameters
+    ----------
+    catalogue_results : str
+        directory for the socket
+    """
+    path = socket_path(catalogue_results)
+    os.makedirs(catalogue_results, exist_ok=True)
+    if os.path.exists(path):
+        os.remove(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # only the user running the daemon may connect to it
+    umask = os.umask(0o177)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(umask)
+    server.listen()
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, _stop)
+
+    ct._open_repos, cc._open_caches, ct._pools = {}, {}, {}
+    home = os.getcwd()
+    print("catalogue daemon listening on {}".format(path))
+    sys.stdout.flush()
+    try:
+        running = True
+        while running:
+            conn, _ = server.accept()
+            with conn, conn.makefile("rw", encoding="utf-8") as f:
+                running = _handle(f, home)
+    except (KeyboardInterrupt, DaemonStopped):
+        pass
+    finally:
+        server.close()
+        if os.path.exists(path):
+            os.remove(path)
+        for cache in cc._open_caches.values():
+            cache.keep_open = False
+            cache.close()
+        for pool in ct._pools.values():
+            pool.shutdown()
+        for repo in ct._open_repos.values():
+            repo.close()
+        ct._open_repos, cc._open_caches, ct._pools = None, None, None
+
+
+def daemon(args):
+    """
+    The `catalogue daemon` command.
+
+    Starts a daemon for the `catalogue_results` directory, that keeps
+    catalogue loaded, with its git repositories, digest cache and thread
+    pools open. While it runs, `engage`, `disengage` and `compare` with the
+    same `catalogue_results` run on the daemon, see `forward`. With `--stop`,
+    stops the running daemon instead.
+
+    Parameters
+    ----------
+    args : obj
+        Command line input arguments (argparse.Namespace).
+
+    Returns
+    -------
+    None
+    """
+    if args.stop:
+        if stop_daemon(args.catalogue_results):
+            print("Stopped the catalogue daemon")
+        else:
+            print("No catalogue daemon is running")
+        return
+    sock = _connect(socket_path(args.catalogue_results))
+    if sock is not None:
+        sock.close()
+        print("A catalogue daemon is already running. To stop it run 'catalogue daemon --stop'")
+        return
+    serve(args.catalogue_results)
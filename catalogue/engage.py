@@ -1,14 +1,17 @@
 import os
+import copy
 import json
-import git
-from git import InvalidGitRepositoryError, BadName
+from git import BadName
 
 from . import catalogue as ct
 from .compare import compare_hashes, print_comparison
 from .utils import create_timestamp, check_paths_exists, prune_files
+from .watch import start_watcher, stop_watcher, changed_under, watchable
+from .store import RecordStore, store_path
+from .ignore import active_patterns
 
 
-def git_query(repo_path, catalogue_dir, commit_changes=False):
+def git_query(repo_path, catalogue_dir, commit_changes=False, state=None):
     """
     Check status of a git repository
 
@@ -34,20 +37,22 @@ def git_query(repo_path, catalogue_dir, commit_changes=False):
     commit_changes : bool
         boolean indicating if the user should be prompted to stage and commit changes
         (optional, default is False)
+    state : RepoState
+        snapshot of the repository already taken by the command, see `repo_state`
+        (optional, taken if not given)
 
     Returns:
     ---------
     Boolean indicating if git directory is clean
     """
 
-    try:
-        repo = git.Repo(repo_path, search_parent_directories=True)
-    except InvalidGitRepositoryError:
-        raise InvalidGitRepositoryError("provided code directory is not a valid git repository")
+    if state is None:
+        state = ct.repo_state(repo_path)
+    repo = state.repo
 
-    untracked = prune_files(repo.untracked_files, catalogue_dir)
+    untracked = prune_files(state.untracked, catalogue_dir)
 
-    if repo.is_dirty() or (len(untracked) != 0):
+    if not state.is_clean(catalogue_dir):
         if commit_changes:
             print("Working directory contains uncommitted changes.")
             print("Do you want to stage and commit all changes? (y/[n])")
@@ -89,6 +94,10 @@ def engage(args):
         - gets hashes for the input_data and code (from `construct_dict()`)
         - saves the hashes to a `.lock` file
 
+    With `--watch`, a watcher is started in the background to journal the
+    changes made to the `input_data` until `disengage`, which then does not
+    need to hash the input data again if none were made.
+
     Once engaged (a `.lock` file exists), the command cannot be run again until
     `disengage` has been run.
 
@@ -103,14 +112,36 @@ def engage(args):
     """
     assert check_paths_exists(args), 'Not all provided filepaths exist.'
 
-    if git_query(args.code, args.catalogue_results, True):
+    state = ct.repo_state(args.code, excludes=ct.git_excludes(args))
+    if git_query(args.code, args.catalogue_results, True, state=state):
+        # hash the code from the same snapshot, unless it is out of date
+        # because the changes were committed
+        args = copy.copy(args)
+        args.repo_state = state if state.is_clean(args.catalogue_results) else None
         try:
             assert not os.path.exists(os.path.join(args.catalogue_results, ".lock"))
         except AssertionError:
             print("Already engaged (.lock file exists). To disengage run 'catalogue disengage...'")
             print("See 'catalogue disengage --help' for details")
         else:
-            hash_dict = ct.construct_dict(create_timestamp(), args)
+            watching = getattr(args, "watch", False)
+            if watching and (getattr(args, "follow_symlinks", False) or not watchable(args.input_data)):
+                print("The input data holds symlinks or hard links, follows symlinks or is on a network "
+                      "filesystem, where the watcher can miss changes, so it will be hashed again at disengage")
+                watching = False
+            if watching:
+                # started before hashing, so no change made while hashing is missed
+                watching = start_watcher([args.input_data], args.catalogue_results)
+                if not watching:
+                    print("Could not start the watcher, the input data will be hashed again at disengage")
+            try:
+                hash_dict = ct.construct_dict(create_timestamp(), args)
+            except BaseException:
+                if watching:
+                    stop_watcher(args.catalogue_results)
+                raise
+            if watching:
+                hash_dict["watch"] = True
             ct.store_hash(hash_dict, "", args.catalogue_results, ext="lock")
             print("'catalogue engage' succeeded. Proceed with analysis")
 
@@ -125,11 +156,19 @@ def disengage(args):
 
     The disengage command:
         - reads hashes stored in the `.lock` file created during `engage`
-        - gets hashes for the `input_data`, `code` and `output_data` (from `construct_dict()`)
+        - if `engage` started a watcher, stops it, and reuses the `input_data`
+            hashes from the `.lock` file if the watcher saw no changes to it
+            and still sees every change (see `watchable`)
+        - gets hashes, with the hash algorithm and input mode used at `engage`, for the `input_data`, `code` and `output_data` (from `construct_dict()`)
         - compares the two sets of hashes
             (if `input_data` and `code` hashes match, saves the hashes to a file)
+        - removes the `.lock` file
         - prints the results of the comparison
 
+    The `.lock` file is only removed once the hashes are saved, so if
+    `disengage` is interrupted it can be run again, and resumes hashing from
+    its checkpoint (see `Checkpoint`).
+
     Parameters:
     ------------
     args : obj
@@ -140,16 +179,37 @@ def disengage(args):
     None
     """
     assert check_paths_exists(args), 'Not all provided filepaths exist.'
+    assert args.csv is None or not getattr(args, "stream_outputs", False), \
+        "Streamed output digests cannot be saved to a CSV file"
 
     timestamp = create_timestamp()
     try:
         LOCK_FILE_PATH = os.path.join(args.catalogue_results, ".lock")
         lock_dict = ct.load_hash(LOCK_FILE_PATH)
-        os.remove(LOCK_FILE_PATH)
     except FileNotFoundError:
         print("Not currently engaged (could not find .lock file). To engage run 'catalogue engage...'")
         print("See 'catalogue engage --help' for details")
     else:
+        if (args.csv is not None) and (os.path.splitext(args.csv)[1] == '.csv'):
+            # checked before hashing, so the run can be disengaged again without --csv
+            assert not (ct.record_ignore(lock_dict, "input_data") or
+                        active_patterns(args.output_data, getattr(args, "ignore", None) or [])), \
+                "Records made with ignore patterns cannot be saved to a CSV file"
+            assert not lock_dict.get("fingerprint_threshold"), \
+                "Records made with a fingerprint threshold cannot be saved to a CSV file"
+            assert not lock_dict.get("follow_symlinks"), \
+                "Records made with --follow_symlinks cannot be saved to a CSV file"
+        # the watcher stops by itself once the lock is removed, leaving an
+        # incomplete journal, so it is stopped before that
+        changed = stop_watcher(args.catalogue_results) if lock_dict.pop("watch", False) else None
+        # hash in the same way as at engage, so the hashes can be compared
+        args = copy.copy(args)
+        vars(args).update(ct.record_options(lock_dict))
+        # links may have been made since engage, so the input data is checked again
+        if changed is not None and args.input_data in lock_dict["input_data"] and \
+                not changed_under(changed, args.input_data) and not args.follow_symlinks and \
+                watchable(args.input_data):
+            args.reuse_input = lock_dict
         hash_dict = ct.construct_dict(timestamp, args)
         compare = compare_hashes(hash_dict, lock_dict)
         # check if 'input_data' and 'code' were in matches
@@ -159,6 +219,12 @@ def disengage(args):
             hash_dict["timestamp"].update({"engage": lock_dict["timestamp"]["engage"]})
             if (args.csv is not None) and (os.path.splitext(args.csv)[1] == '.csv'):
                 ct.save_csv(hash_dict, timestamp, os.path.join(args.catalogue_results, args.csv))
+            elif getattr(args, "store", "json") == "sqlite":
+                with RecordStore(store_path(args.catalogue_results)) as store:
+                    store.save(hash_dict, timestamp)
             else:
                 ct.store_hash(hash_dict, timestamp, args.catalogue_results)
+        else:
+            ct.remove_manifests(hash_dict)
+        os.remove(LOCK_FILE_PATH)
         print_comparison(compare)
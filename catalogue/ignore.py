@@ -0,0 +1,186 @@
+import os
+import re
+
+IGNORE_FILE = ".catalogueignore"
+
+
+def read_ignore_file(folder):
+    """
+    Read the patterns in the `.catalogueignore` file at the top of folder.
+
+    Parameters
+    ----------
+    folder : str
+        directory that may hold a `.catalogueignore` file
+
+    Returns
+    -------
+    list of str
+        the patterns, without blank lines and comments (empty if there is no
+        such file)
+    """
+    path = os.path.join(folder, IGNORE_FILE)
+    if not os.path.isfile(path):
+        return []
+    with open(path, encoding="utf-8") as f:
+        lines = [_strip(line) for line in f]
+    return [line for line in lines if line and not line.startswith("#")]
+
+
+def active_patterns(folder, patterns=()):
+    """
+    Return the ignore patterns that apply inside folder: those in its
+    `.catalogueignore` file followed by patterns.
+
+    Parameters
+    ----------
+    folder : str
+        input or output data path; a file has no `.catalogueignore`
+    patterns : list of str, optional
+        further patterns, from the command line or config file
+
+    Returns
+    -------
+    list of str
+    """
+    from_file = read_ignore_file(folder) if os.path.isdir(folder) else []
+    return from_file + list(patterns)
+
+
+def _strip(line):
+    # trailing spaces are dropped unless escaped with a backslash
+    line = line.rstrip("\r\n")
+    stripped = line.rstrip(" ")
+    if stripped.endswith("\\") and len(stripped) < len(line):
+        stripped += " "
+    return stripped
+
+
+def compile_pattern(pattern):
+    """
+    Translate one gitignore-style pattern into a regular expression.
+
+    Parameters
+    ----------
+    pattern : str
+
+    Returns
+    -------
+    tuple (str, bool, bool)
+        regular expression matching the "/" separated paths, relative to the
+        top directory, that the pattern applies to; whether the pattern is
+        negated ("!"); and whether it only applies to directories (trailing
+        "/")
+    """
+    negate = pattern.startswith("!")
+    if negate:
+        pattern = pattern[1:]
+    elif pattern.startswith("\\!") or pattern.startswith("\\#"):
+        pattern = pattern[1:]
+    dir_only = pattern.endswith("/")
+    pattern = pattern.rstrip("/")
+
+    # patterns with a "/" before the end are relative to the top directory,
+    # others match a name at any depth
+    anchored = "/" in pattern
+    pattern = pattern.lstrip("/")
+    regex = "" if anchored else "(?:.*/)?"
+
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if pattern.startswith("**", i) and (i == 0 or pattern[i - 1] == "/") and \
+                (i + 2 == n or pattern[i + 2] == "/"):
+            if i + 2 == n:
+                regex += ".*"
+            else:
+                regex += "(?:.*/)?"
+                i += 1
+            i += 2
+            continue
+        if c == "*":
+            regex += "[^/]*"
+        elif c == "?":
+            regex += "[^/]"
+        elif c == "[":
+            start = i + 1
+            if pattern[start:start + 1] in ("!", "^"):
+                start += 1
+            if pattern[start:start + 1] == "]":
+                start += 1
+            j = pattern.find("]", start)
+            if j == -1:
+                regex += re.escape(c)
+            else:
+                inner = pattern[i + 1:j]
+                if inner[0] in ("!", "^"):
+                    inner = "^" + inner[1:]
+                regex += "[" + inner.replace("\\", "\\\\") + "]"
+                i = j
+        elif c == "\\" and i + 1 < n:
+            i += 1
+            regex += re.escape(pattern[i])
+        else:
+            regex += re.escape(c)
+        i += 1
+    return regex, negate, dir_only
+
+
+class IgnoreMatcher:
+    """
+    Decides which paths inside a directory are ignored, from a list of
+    gitignore-style patterns.
+
+    As in `.gitignore` files, blank patterns and patterns starting with "#"
+    are skipped, "*", "?" and "[...]" match within one path component, "**"
+    matches any number of directories, a pattern ending in "/" only matches
+    directories, a pattern with a "/" anywhere else is relative to the top
+    directory, and a pattern starting with "!" re-includes what an earlier
+    pattern ignored. The last matching pattern wins.
+
+    The patterns are compiled once into a few regular expressions: each run
+    of consecutive patterns that all ignore (or all re-include) becomes a
+    single alternation, so most paths are decided by one regular expression
+    match.
+
+    Parameters
+    ----------
+    patterns : list of str
+    """
+
+    def __init__(self, patterns=()):
+        self.patterns = [pattern for pattern in patterns if pattern and not pattern.startswith("#")]
+        compiled = [compile_pattern(pattern) for pattern in self.patterns]
+        self._dirs = self._group(compiled)
+        self._files = self._group([c for c in compiled if not c[2]])
+
+    @staticmethod
+    def _group(compiled):
+        groups = []
+        for regex, negate, _ in compiled:
+            if groups and groups[-1][1] == negate:
+                groups[-1][0].append(regex)
+            else:
+                groups.append(([regex], negate))
+        # checked from the last group, as later patterns override earlier ones
+        return [(re.compile("(?:" + ")|(?:".join(regexes) + ")"), negate)
+                for regexes, negate in reversed(groups)]
+
+    def __bool__(self):
+        return bool(self.patterns)
+
+    def match(self, relpath, is_dir=False):
+        """
+        Return True if the path is ignored.
+
+        Parameters
+        ----------
+        relpath : str
+            path relative to the top directory, using "/" as separator
+        is_dir : bool, optional
+            whether the path is a directory
+        """
+        for regex, negate in self._dirs if is_dir else self._files:
+            if regex.fullmatch(relpath):
+                return not negate
+        return False
@@ -0,0 +1,106 @@
+import os
+import json
+
+MANIFEST_EXT = "manifest.jsonl"
+
+# number of files hashed, and held in memory, at a time when streaming
+MANIFEST_BATCH = 10000
+
+
+def manifest_name(timestamp, command):
+    """
+    Return the file name of the output manifest made by command at
+    timestamp.
+    """
+    return "{}.{}.{}".format(timestamp, command, MANIFEST_EXT)
+
+
+class ManifestWriter:
+    """
+    Writes the digests of output files to a manifest as they are hashed.
+
+    A manifest is a JSON Lines file with one `[path, digest]` array per
+    line, sorted by path, so it can be written and read one file at a time
+    and two manifests can be compared by merging them (see
+    `merge_manifests`). It is written under a temporary name and renamed
+    by `close`, so a manifest is always complete.
+
+    Parameters
+    ----------
+    path : str
+        path of the manifest
+
+    Attributes
+    ----------
+    files : int
+        number of files written
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.files = 0
+        self._last = None
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._f = open(path + ".tmp", "w")
+
+    def add(self, path, digest):
+        """
+        Add the digest of the file at path, which must sort after every path
+        added before.
+        """
+        assert self._last is None or path > self._last, "Manifest paths must be added in sorted order"
+        self._f.write(json.dumps([path, digest]) + "\n")
+        self._last = path
+        self.files += 1
+
+    def close(self):
+        """
+        Finish the manifest.
+        """
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._f.close()
+        os.replace(self.path + ".tmp", self.path)
+
+    def discard(self):
+        """
+        Delete the manifest, finished or not.
+        """
+        self._f.close()
+        for path in [self.path + ".tmp", self.path]:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def read_manifest(path):
+    """
+    Yield the (path, digest) pairs of a manifest in order.
+    """
+    with open(path) as f:
+        for line in f:
+            file_path, digest = json.loads(line)
+            yield file_path, digest
+
+
+def merge_manifests(items_1, items_2):
+    """
+    Merge two sequences of (path, digest) pairs sorted by path, yielding
+    (path, digest_1, digest_2) for every path in either, with None for the
+    digest of a path missing from one of them.
+    """
+    items_1 = iter(items_1)
+    items_2 = iter(items_2)
+    item_1 = next(items_1, None)
+    item_2 = next(items_2, None)
+    while item_1 is not None or item_2 is not None:
+        if item_2 is None or (item_1 is not None and item_1[0] < item_2[0]):
+            yield item_1[0], item_1[1], None
+            item_1 = next(items_1, None)
+        elif item_1 is None or item_2[0] < item_1[0]:
+            yield item_2[0], None, item_2[1]
+            item_2 = next(items_2, None)
+        else:
+            yield item_1[0], item_1[1], item_2[1]
+            item_1 = next(items_1, None)
+            item_2 = next(items_2, None)
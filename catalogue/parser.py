@@ -2,9 +2,14 @@ import argparse
 import textwrap
 import os
 from .engage import engage, disengage
+from .daemon import daemon, forward
 from .compare import compare
 from .config import config, config_validator
 from .utils import read_config_file, CONFIG_LOC, dictionary_printer
+from .cache import DEFAULT_CACHE_SIZE
+from .checkpoint import DEFAULT_CHECKPOINT_INTERVAL
+from .catalogue import ALGORITHMS, DEFAULT_ALGORITHM, INPUT_MODES, INPUT_MANIFESTS, CODE_IDENTITIES
+from .store import STORES, import_records
 
 
 
@@ -52,6 +57,20 @@ def main():
     Note that if `compare` mode is used with 1 input, any use of flags to set data or code
     paths must come before the hash file due to how arguments are parsed.
 
+    daemon
+    ------
+    The `daemon` mode starts a long-running process for the `catalogue_results` directory
+    (set with `--catalogue_results`). While it runs, `engage`, `disengage` and `compare`
+    are run by the daemon, which keeps git repositories, the digest cache and thread pools
+    open between commands. Arguments, including those from the config file, are still
+    parsed by each command. Run with `--stop` to stop the daemon.
+
+    import
+    ------
+    The `import` mode saves existing JSON record files, CSV files and directories of JSON
+    record files into the indexed record store of the `catalogue_results` directory, used
+    with `--store sqlite`. Records already in the store are skipped.
+
     config
     ------
     The `config` mode is used to generate config files that aid in the use of the library
@@ -76,7 +95,31 @@ def main():
                      'code': r'code',
                      'catalogue_results' : r'catalogue_results',
                      'output_data': r'output_data',
-                     'csv' : None}
+                     'csv' : None,
+                     'jobs' : 1,
+                     'prefetch' : 0,
+                     'cache' : True,
+                     'verify_cache' : False,
+                     'cache_size' : DEFAULT_CACHE_SIZE,
+                     'algorithm' : DEFAULT_ALGORITHM,
+                     'input_mode' : 'full',
+                     'input_manifest' : 'none',
+                     'ignore' : [],
+                     'fingerprint_threshold' : 0,
+                     'chunk_threshold' : 0,
+                     'follow_symlinks' : False,
+                     'archive_members' : False,
+                     'progress' : False,
+                     'record_stats' : False,
+                     'watch' : False,
+                     'use_daemon' : True,
+                     'checkpoint_interval' : DEFAULT_CHECKPOINT_INTERVAL,
+                     'stream_outputs' : False,
+                     'git_exclude' : [],
+                     'code_identity' : 'commit',
+                     'store' : 'json',
+                     'verify_full' : False,
+                     'verify_full_threshold' : 0}
 
     if os.path.isfile(CONFIG_LOC):
         if config_validator(CONFIG_LOC):
@@ -113,6 +156,199 @@ def main():
         default=main_dict['catalogue_results']
     )
 
+    common_parser.add_argument(
+        '--jobs',
+        type=int,
+        metavar='jobs',
+        help=textwrap.dedent("Number of files to hash concurrently when hashing output data, and input" +
+                             " data in 'merkle' input mode. Default is 1."),
+        default=main_dict['jobs']
+    )
+
+    common_parser.add_argument(
+        '--prefetch',
+        type=int,
+        metavar='prefetch',
+        help=textwrap.dedent("Number of files to open and start reading in the background ahead of the" +
+                             " files being hashed, to hide the latency of network filesystems. Default is 0."),
+        default=main_dict['prefetch']
+    )
+
+    common_parser.add_argument(
+        '--no_cache',
+        dest='cache',
+        action='store_false',
+        help=textwrap.dedent("Hash every file instead of reusing digests of unchanged files from the" +
+                             " digest cache in the 'catalogue_results' directory."),
+        default=main_dict['cache']
+    )
+
+    common_parser.add_argument(
+        '--verify_cache',
+        action='store_true',
+        help=textwrap.dedent("Hash every file and check the digests in the digest cache against them," +
+                             " replacing any that are out of date."),
+        default=main_dict['verify_cache']
+    )
+
+    common_parser.add_argument(
+        '--cache_size',
+        type=int,
+        metavar='cache_size',
+        help=textwrap.dedent("Maximum number of digests kept in the digest cache; the least recently" +
+                             " used are evicted first. Default is {}.".format(DEFAULT_CACHE_SIZE)),
+        default=main_dict['cache_size']
+    )
+
+    common_parser.add_argument(
+        '--algorithm',
+        type=str,
+        choices=sorted(ALGORITHMS),
+        help=textwrap.dedent("Hash algorithm used to hash input and output data. The algorithm is" +
+                             " recorded with each hash. Default is {}.".format(DEFAULT_ALGORITHM)),
+        default=main_dict['algorithm']
+    )
+
+    common_parser.add_argument(
+        '--input_mode',
+        type=str,
+        choices=INPUT_MODES,
+        help=textwrap.dedent("How to hash the input data directory: 'full' hashes all files in one stream," +
+                             " 'merkle' builds a Merkle tree of file and directory digests, which can use" +
+                             " several jobs and the digest cache, and lets `compare` list the changed" +
+                             " subdirectories. Default is full."),
+        default=main_dict['input_mode']
+    )
+
+    common_parser.add_argument(
+        '--input_manifest',
+        type=str,
+        choices=INPUT_MANIFESTS,
+        help=textwrap.dedent("Also record the digest of every input file, from the same read as the" +
+                             " input data hash, so that `compare` can list the input files that differ." +
+                             " 'compressed' stores the manifest zlib compressed. Default is none."),
+        default=main_dict['input_manifest']
+    )
+
+    common_parser.add_argument(
+        '--ignore',
+        type=str,
+        action='append',
+        metavar='pattern',
+        help=textwrap.dedent("A gitignore-style pattern for files and directories to leave out when hashing" +
+                             " input and output data, in addition to those in a '.catalogueignore' file at" +
+                             " the top of each. Can be given several times."),
+        default=main_dict['ignore']
+    )
+
+    common_parser.add_argument(
+        '--code_identity',
+        type=str,
+        choices=CODE_IDENTITIES,
+        help=textwrap.dedent("How to identify the code: 'commit' records the HEAD commit of the repository," +
+                             " 'tree' records the git tree of the code directory, so commits that do not" +
+                             " change it (elsewhere in a larger repository) do not make the code differ." +
+                             " Default is commit."),
+        default=main_dict['code_identity']
+    )
+
+    common_parser.add_argument(
+        '--git_exclude',
+        type=str,
+        action='append',
+        metavar='path',
+        help=textwrap.dedent("A path inside the code repository, such as a virtualenv, that git should not" +
+                             " look inside when checking for uncommitted changes and untracked files. The" +
+                             " 'catalogue_results' directory and the input and output data are always left" +
+                             " out. Can be given several times."),
+        default=main_dict['git_exclude']
+    )
+
+    common_parser.add_argument(
+        '--fingerprint_threshold',
+        type=int,
+        metavar='bytes',
+        help=textwrap.dedent("Fingerprint files of at least this many bytes instead of hashing their full" +
+                             " contents: only their size and a fixed sample of blocks are hashed. Much" +
+                             " faster for very large files, but a weaker guarantee. Applies to output files," +
+                             " an input file and, in 'merkle' input mode, input files. Default is 0, never."),
+        default=main_dict['fingerprint_threshold']
+    )
+
+    common_parser.add_argument(
+        '--chunk_threshold',
+        type=int,
+        metavar='bytes',
+        help=textwrap.dedent("Also split files of at least this many bytes into content-defined chunks and" +
+                             " record a digest of each chunk, so that `compare` can report which byte ranges" +
+                             " of a large file changed. Default is 0, never."),
+        default=main_dict['chunk_threshold']
+    )
+
+    common_parser.add_argument(
+        '--follow_symlinks',
+        action='store_true',
+        help=textwrap.dedent("Descend into symlinked directories inside the input and output data, except" +
+                             " those that link back to a directory above them. By default they are skipped."),
+        default=main_dict['follow_symlinks']
+    )
+
+    common_parser.add_argument(
+        '--archive_members',
+        action='store_true',
+        help=textwrap.dedent("Also hash each file inside tar and zip archives, without extracting them, so" +
+                             " that `compare` can list the files inside an archive that differ. Applies to the" +
+                             " same files as --chunk_threshold."),
+        default=main_dict['archive_members']
+    )
+
+    common_parser.add_argument(
+        '--progress',
+        action='store_true',
+        help=textwrap.dedent("Show the progress of hashing, with the throughput and an estimate of the time" +
+                             " left, and a summary with the slowest files at the end. On a terminal the" +
+                             " progress line is updated in place, otherwise a line is written every 30 seconds."),
+        default=main_dict['progress']
+    )
+
+    common_parser.add_argument(
+        '--record_stats',
+        action='store_true',
+        help=textwrap.dedent("Store the number of files and bytes hashed, the time taken, the mean" +
+                             " throughput and the slowest files in the hash record."),
+        default=main_dict['record_stats']
+    )
+
+    common_parser.add_argument(
+        '--checkpoint_interval',
+        type=int,
+        metavar='seconds',
+        help=textwrap.dedent("Every this many seconds, save the digests of the files hashed so far to a" +
+                             " checkpoint in the 'catalogue_results' directory, so that an interrupted" +
+                             " command resumes from there when run again. 0 turns checkpoints off." +
+                             " Default is {}.".format(DEFAULT_CHECKPOINT_INTERVAL)),
+        default=main_dict['checkpoint_interval']
+    )
+
+    common_parser.add_argument(
+        '--stream_outputs',
+        action='store_true',
+        help=textwrap.dedent("Write the digests of the files in an output directory to a manifest in the" +
+                             " 'catalogue_results' directory as they are hashed, instead of holding them in" +
+                             " memory and in the hash record, so that memory use stays the same however" +
+                             " many output files there are. Not supported with --csv."),
+        default=main_dict['stream_outputs']
+    )
+
+    common_parser.add_argument(
+        '--no_daemon',
+        dest='use_daemon',
+        action='store_false',
+        help=textwrap.dedent("Run the command in this process even if a `catalogue daemon` is running for" +
+                             " the 'catalogue_results' directory."),
+        default=main_dict['use_daemon']
+    )
+
     output_parser = argparse.ArgumentParser(add_help=False)
     output_parser.add_argument(
         '--output_data',
@@ -131,6 +367,15 @@ def main():
                              "for no CSV output"),
         default= main_dict['csv'])
 
+    output_parser.add_argument(
+        "--store",
+        type=str,
+        choices=STORES,
+        help=textwrap.dedent("Where to save records: 'json' writes one JSON file per run, 'sqlite' saves" +
+                             " them in an indexed database, 'catalogue.sqlite' in the 'catalogue_results'" +
+                             " directory, where `compare` finds them by their timestamps. Default is json."),
+        default=main_dict['store'])
+
     # create subparsers
     subparsers = parser.add_subparsers(dest="command")
 
@@ -138,11 +383,34 @@ def main():
         "engage", parents=[common_parser], description="", help=""
     )
     engage_parser.set_defaults(func=engage)
+    engage_parser.add_argument(
+        '--watch',
+        action='store_true',
+        help=textwrap.dedent("Watch the input data for changes in the background until `disengage`, using" +
+                             " inotify where available and otherwise checking the files every few seconds." +
+                             " If it is unchanged, `disengage` does not hash it again."),
+        default=main_dict['watch']
+    )
 
     compare_parser = subparsers.add_parser("compare", parents=[common_parser, output_parser],
                                            description="", help="")
     compare_parser.set_defaults(func=compare)
     compare_parser.add_argument("hashes", type=str, nargs='+', help="")
+    compare_parser.add_argument(
+        '--verify_full',
+        action='store_true',
+        help=textwrap.dedent("Where one hash is a fingerprint and the other a hash of the full contents" +
+                             " of a file, fingerprint and hash the file as it is now to compare them."),
+        default=main_dict['verify_full']
+    )
+    compare_parser.add_argument(
+        '--verify_full_threshold',
+        type=int,
+        metavar='bytes',
+        help=textwrap.dedent("With --verify_full, only hash files of at most this many bytes in full; larger" +
+                             " files are left as could not be compared. Default is 0, no limit."),
+        default=main_dict['verify_full_threshold']
+    )
 
     disengage_parser = subparsers.add_parser(
         "disengage", parents=[common_parser, output_parser], description="", help=""
@@ -152,8 +420,57 @@ def main():
     config_parser = subparsers.add_parser("config", parents=[common_parser, output_parser], description="", help="")
     config_parser.set_defaults(func=config)
 
+    daemon_parser = subparsers.add_parser("daemon", description="", help="")
+    daemon_parser.set_defaults(func=daemon)
+    daemon_parser.add_argument(
+        '--catalogue_results',
+        type=str,
+        metavar='catalogue_results',
+        help=textwrap.dedent("The 'catalogue_results' directory of the commands the daemon runs, where it" +
+                             " listens for them. Default is catalogue_results."),
+        default=main_dict['catalogue_results']
+    )
+    daemon_parser.add_argument(
+        '--stop',
+        action='store_true',
+        help=textwrap.dedent("Stop the running daemon."),
+        default=False
+    )
+
+    import_parser = subparsers.add_parser("import", description="", help="")
+    import_parser.set_defaults(func=import_records)
+    import_parser.add_argument(
+        "sources",
+        type=str,
+        nargs='+',
+        help=textwrap.dedent("JSON record files, CSV files and directories of JSON record files to import" +
+                             " into the record store."))
+    import_parser.add_argument(
+        '--catalogue_results',
+        type=str,
+        metavar='catalogue_results',
+        help=textwrap.dedent("The 'catalogue_results' directory holding the record store. Default is" +
+                             " catalogue_results."),
+        default=main_dict['catalogue_results']
+    )
+
     args = parser.parse_args()
+    if args.command in ("daemon", "import"):
+        args.func(args)
+        return
     assert args.code != args.catalogue_results, "The 'catalogue_results' and 'code' paths cannot be the same"
+    assert args.jobs >= 1, "The 'jobs' argument must be a positive integer"
+    assert args.prefetch >= 0, "The 'prefetch' argument must be a non-negative integer"
+    assert args.fingerprint_threshold >= 0, "The 'fingerprint_threshold' argument must be a non-negative integer"
+    assert args.chunk_threshold >= 0, "The 'chunk_threshold' argument must be a non-negative integer"
+    assert args.checkpoint_interval >= 0, "The 'checkpoint_interval' argument must be a non-negative integer"
+    assert getattr(args, "verify_full_threshold", 0) >= 0, \
+        "The 'verify_full_threshold' argument must be a non-negative integer"
+    assert getattr(args, "csv", None) is None or getattr(args, "store", "json") == "json", \
+        "The 'csv' and 'store' arguments cannot be used together"
+    # engage, disengage and compare run on a daemon if one is running
+    if args.use_daemon and args.command != "config" and forward(args):
+        return
     args.func(args)
 
 
@@ -0,0 +1,276 @@
+import os
+import sys
+import time
+import heapq
+import threading
+from contextlib import contextmanager
+
+# number of slowest files listed in the summary and the hash record
+SLOWEST = 5
+# seconds between updates of the progress line on a terminal, and between
+# progress lines in a log
+TTY_INTERVAL = 0.2
+LOG_INTERVAL = 30
+
+# the Progress that the bytes read on each thread are reported to, see `reading`
+_local = threading.local()
+
+
+def scan_size(path, walk):
+    """
+    Count the files that will be hashed in path, and their total size.
+
+    Parameters
+    ----------
+    path : str
+        input or output data path
+    walk : callable
+        yields the files inside a directory path, called as walk(path)
+
+    Returns
+    -------
+    tuple (int, int)
+        number of files and total bytes
+    """
+    if os.path.isfile(path):
+        return 1, os.path.getsize(path)
+    files = 0
+    size = 0
+    for filepath in walk(path):
+        try:
+            size += os.path.getsize(filepath)
+        except OSError:
+            continue
+        files += 1
+    return files, size
+
+
+def format_bytes(n):
+    """
+    Return a number of bytes as a short human-readable string.
+    """
+    for unit in ["B", "kB", "MB", "GB", "TB"]:
+        if abs(n) < 1000 or unit == "TB":
+            return "{:.0f} {}".format(n, unit) if unit == "B" else "{:.1f} {}".format(n, unit)
+        n /= 1000
+
+
+def format_duration(seconds):
+    """
+    Return a number of seconds as "1h02m03s", "2m03s" or "3s".
+    """
+    seconds = int(round(seconds))
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if hours:
+        return "{}h{:02d}m{:02d}s".format(hours, minutes, seconds)
+    if minutes:
+        return "{}m{:02d}s".format(minutes, seconds)
+    return "{}s".format(seconds)
+
+
+@contextmanager
+def reading(progress):
+    """
+    Report the bytes read by `report_read` on this thread to progress (if
+    not None) while hashing one file, which is then reported with
+    `Progress.add`.
+    """
+    _local.progress, _local.read = progress, 0
+    try:
+        yield
+    finally:
+        _local.progress = None
+
+
+def report_read(n):
+    """
+    Report that n more bytes of the file being hashed on this thread were
+    read, if it is hashed inside `reading`.
+    """
+    progress = getattr(_local, "progress", None)
+    if progress is not None:
+        progress.read(n)
+
+
+class Progress:
+    """
+    Progress of hashing, with throughput and an estimate of the time left.
+
+    The hashing functions report each file as it is hashed (`add`) or found
+    in the digest cache (`skip`), and the bytes read so far of the files
+    being hashed (`read`), so that progress is shown within a large file. Given the number of files and bytes to
+    hash, from a pre-scan (`expect`), a progress line is shown: on a
+    terminal it is redrawn in place several times a second, otherwise (such
+    as when the output goes to a log file) a new line is written every
+    `LOG_INTERVAL` seconds. `summary` describes the whole run, including the
+    slowest files, and `stats` gives the same numbers for the hash record.
+
+    Files may be reported from several threads at once.
+
+    Parameters
+    ----------
+    stream : file, optional
+        where to show progress (default is sys.stderr), or None to only
+        collect the numbers
+    tty : bool, optional
+        whether stream is a terminal (default is to ask stream)
+    """
+
+    def __init__(self, stream=sys.stderr, tty=None):
+        self.stream = stream
+        if tty is None:
+            tty = stream is not None and hasattr(stream, "isatty") and stream.isatty()
+        self.tty = tty
+        self.interval = TTY_INTERVAL if tty else LOG_INTERVAL
+        self.total_files = 0
+        self.total_bytes = 0
+        self.files = 0
+        self.bytes = 0
+        self.hashed_bytes = 0
+        self.hash_seconds = 0.0
+        self.slowest = []
+        self._lock = threading.Lock()
+        self._started = time.perf_counter()
+        self._shown = self._started
+        self._width = 0
+
+    def expect(self, files, size):
+        """
+        Add files and size bytes to the work to do.
+        """
+        with self._lock:
+            self.total_files += files
+            self.total_bytes += size
+
+    def read(self, n):
+        """
+        Record that n more bytes of the file being hashed on this thread
+        were read.
+        """
+        with self._lock:
+            self.bytes += n
+            _local.read += n
+            self._maybe_show()
+
+    def add(self, path, size, seconds):
+        """
+        Record that the file at path, of size bytes, was hashed in seconds.
+        """
+        # the bytes already reported with `read` are not counted twice
+        done, _local.read = getattr(_local, "read", 0), 0
+        with self._lock:
+            self.files += 1
+            self.bytes += size - done
+            self.hashed_bytes += size
+            self.hash_seconds += seconds
+            if len(self.slowest) < SLOWEST:
+                heapq.heappush(self.slowest, (seconds, path))
+            elif seconds > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, (seconds, path))
+            self._maybe_show()
+
+    def skip(self, path, size):
+        """
+        Record that the file at path, of size bytes, needed no hashing.
+        """
+        with self._lock:
+            self.files += 1
+            self.bytes += size
+            self._maybe_show()
+
+    def timed(self, func):
+        """
+        Wrap func(path, ...) so that each call is reported with `add`.
+        """
+        def timed_func(path, *args, **kwargs):
+            start = time.perf_counter()
+            with reading(self):
+                result = func(path, *args, **kwargs)
+            self.add(path, os.path.getsize(path), time.perf_counter() - start)
+            return result
+        return timed_func
+
+    def elapsed(self):
+        return time.perf_counter() - self._started
+
+    def line(self):
+        """
+        Return the current progress as one line of text.
+        """
+        elapsed = self.elapsed()
+        rate = self.bytes / elapsed if elapsed > 0 else 0
+        files = "{} of {}".format(self.files, self.total_files) if self.total_files else str(self.files)
+        parts = ["hashed {} files, {}".format(files, format_bytes(self.bytes))]
+        if self.total_bytes:
+            parts[0] += " of {} ({:.0%})".format(format_bytes(self.total_bytes),
+                                                 min(self.bytes / self.total_bytes, 1))
+        parts.append("{}/s".format(format_bytes(rate)))
+        if self.total_bytes and rate > 0:
+            parts.append("ETA {}".format(format_duration(max(self.total_bytes - self.bytes, 0) / rate)))
+        return ", ".join(parts)
+
+    def _maybe_show(self):
+        now = time.perf_counter()
+        if self.stream is None or now - self._shown < self.interval:
+            return
+        self._shown = now
+        self._show()
+
+    def _show(self):
+        line = self.line()
+        if self.tty:
+            self.stream.write("\r" + line.ljust(self._width))
+            self._width = len(line)
+        else:
+            self.stream.write(line + "\n")
+        self.stream.flush()
+
+    def close(self):
+        """
+        Clear the progress line from a terminal.
+        """
+        if self.stream is not None and self.tty and self._width:
+            self.stream.write("\r" + " " * self._width + "\r")
+            self.stream.flush()
+            self._width = 0
+
+    def stats(self):
+        """
+        Return the numbers of the whole run, for storing in a hash record.
+
+        Returns
+        -------
+        dict
+            the number of `files`, their total `bytes`, the `hashed_bytes`
+            read rather than found in the digest cache, the elapsed `seconds`,
+            the mean throughput `mb_per_s` (in MB of hashed data per second
+            spent hashing) and the `slowest` files with the seconds each took
+        """
+        return {
+            "files": self.files,
+            "bytes": self.bytes,
+            "hashed_bytes": self.hashed_bytes,
+            "seconds": round(self.elapsed(), 3),
+            "mb_per_s": round(self.hashed_bytes / self.hash_seconds / 1e6, 3) if self.hash_seconds else 0,
+            "slowest": {path: round(seconds, 3) for seconds, path in sorted(self.slowest, reverse=True)}
+        }
+
+    def summary(self):
+        """
+        Return a summary of the whole run, with the slowest files.
+
+        Returns
+        -------
+        str
+        """
+        stats = self.stats()
+        lines = ["hashed {} files, {} ({} read) in {}, {:.1f} MB/s".format(
+            stats["files"], format_bytes(stats["bytes"]), format_bytes(stats["hashed_bytes"]),
+            format_duration(stats["seconds"]), stats["mb_per_s"])]
+        if stats["slowest"]:
+            lines.append("slowest files:")
+            lines.extend("  {} ({})".format(path, format_duration(seconds) if seconds >= 1 else
+                                            "{:.3f}s".format(seconds))
+                         for path, seconds in stats["slowest"].items())
+        return "\n".join(lines)
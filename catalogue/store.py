@@ -0,0 +1,232 @@
+import os
+import json
+import glob
+import sqlite3
+
+from . import catalogue as ct
+from .manifest import read_manifest
+
+STORE_NAME = "catalogue.sqlite"
+
+# where `disengage` saves records, see --store
+STORES = ["json", "sqlite"]
+
+
+def store_path(catalogue_results):
+    """
+    Return the path of the record store in catalogue_results.
+    """
+    return os.path.join(catalogue_results, STORE_NAME)
+
+
+class RecordStore:
+    """
+    Indexed SQLite store of hash records.
+
+    Each record is saved as a row of `runs`, keyed on its id (the timestamp
+    it was saved with), with one row per digest in `inputs`, `code` and
+    `outputs`. The engage and disengage timestamps and every input, code and
+    output digest are indexed, so runs can be found without reading every
+    record (see `find`). The rest of the record (ignore patterns, chunk
+    tables, archive members, ...) is kept as JSON in `runs`.
+
+    The database is in WAL mode and each record is saved in one transaction,
+    so several `disengage` processes can save records at the same time, and
+    readers never see a partly saved record.
+
+    Parameters
+    ----------
+    path : str
+        path to the database
+    timeout : float, optional
+        seconds to wait for another process to finish saving a record
+    """
+
+    def __init__(self, path, timeout=60):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=timeout)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS runs ("
+            "id TEXT PRIMARY KEY, engage TEXT, disengage TEXT, record TEXT NOT NULL)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS inputs ("
+            "run_id TEXT NOT NULL, path TEXT NOT NULL, digest TEXT NOT NULL, PRIMARY KEY (run_id, path))")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS code ("
+            "run_id TEXT NOT NULL, path TEXT NOT NULL, digest TEXT NOT NULL, PRIMARY KEY (run_id, path))")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS outputs ("
+            "run_id TEXT NOT NULL, path TEXT NOT NULL, digest TEXT NOT NULL, PRIMARY KEY (run_id, path))")
+        self._db.execute("CREATE INDEX IF NOT EXISTS runs_engage ON runs (engage)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS runs_disengage ON runs (disengage)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS inputs_digest ON inputs (digest)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS code_digest ON code (digest)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS outputs_digest ON outputs (digest)")
+        self._db.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __contains__(self, run_id):
+        return self._db.execute("SELECT 1 FROM runs WHERE id=?", (run_id,)).fetchone() is not None
+
+    def save(self, hash_dict, run_id):
+        """
+        Save a hash dictionary as the record with id run_id.
+
+        The digests of streamed output files are read from the output
+        manifest (see `hash_dir_to_manifest`) one at a time, and the manifest
+        is kept, found relative to the database.
+
+        Saving the same record again with its id, such as when a run is
+        saved twice, changes nothing.
+
+        Raises
+        ------
+        AssertionError
+            if a different record with the same id is already in the store
+        """
+        record = dict(hash_dict)
+        output_path, outputs = list(hash_dict.get("output_data", {None: {}}).items())[0]
+        if "output_manifest" in hash_dict:
+            manifest = list(hash_dict["output_manifest"].values())[0]
+            outputs = read_manifest(manifest["file"])
+            record["output_manifest"] = {
+                key: dict(value, file=os.path.relpath(value["file"], os.path.dirname(self.path) or "."))
+                for key, value in hash_dict["output_manifest"].items()}
+        else:
+            outputs = outputs.items()
+        if output_path is not None:
+            record["output_data"] = {output_path: {}}
+
+        try:
+            with self._db:
+                self._db.execute("INSERT INTO runs VALUES (?, ?, ?, ?)",
+                                 (run_id, hash_dict["timestamp"].get("engage"),
+                                  hash_dict["timestamp"].get("disengage"), json.dumps(record)))
+                self._db.executemany("INSERT INTO inputs VALUES (?, ?, ?)",
+                                     [(run_id, path, digest) for path, digest in hash_dict["input_data"].items()])
+                self._db.executemany("INSERT INTO code VALUES (?, ?, ?)",
+                                     [(run_id, path, digest) for path, digest in hash_dict["code"].items()])
+                self._db.executemany("INSERT INTO outputs VALUES (?, ?, ?)",
+                                     ((run_id, path, digest) for path, digest in outputs))
+        except sqlite3.IntegrityError:
+            # the id is taken; the first insert failed, so no output digests were read yet
+            row = self._db.execute("SELECT record FROM runs WHERE id=?", (run_id,)).fetchone()
+            if row is None:
+                raise
+            saved = self._db.execute("SELECT path, digest FROM outputs WHERE run_id=?", (run_id,))
+            assert json.loads(row[0]) == json.loads(json.dumps(record)) and dict(saved) == dict(outputs), \
+                "A different record with id {} is already in {}".format(run_id, self.path)
+
+    def load(self, run_id):
+        """
+        Load the record with id run_id.
+
+        Raises
+        ------
+        EOFError
+            if there is no such record
+        """
+        row = self._db.execute("SELECT record FROM runs WHERE id=?", (run_id,)).fetchone()
+        if row is None:
+            raise EOFError("Unable to find desired record in {}".format(self.path))
+        record = json.loads(row[0])
+        if "output_manifest" in record:
+            for value in record["output_manifest"].values():
+                value["file"] = os.path.join(os.path.dirname(self.path), value["file"])
+        elif "output_data" in record:
+            output_path = list(record["output_data"].keys())[0]
+            record["output_data"][output_path] = dict(self._db.execute(
+                "SELECT path, digest FROM outputs WHERE run_id=? ORDER BY path", (run_id,)))
+        return record
+
+    def find(self, input_hash=None, code_hash=None, output_digest=None, since=None, until=None):
+        """
+        Find the records with all the given digests, disengaged between since
+        and until (timestamps, inclusive).
+
+        Returns
+        -------
+        list of str
+            ids of the records, in order
+        """
+        query = "SELECT id FROM runs WHERE 1"
+        params = []
+        for table, digest in [("inputs", input_hash), ("code", code_hash), ("outputs", output_digest)]:
+            if digest is not None:
+                query += " AND id IN (SELECT run_id FROM {} WHERE digest=?)".format(table)
+                params.append(digest)
+        if since is not None:
+            query += " AND disengage >= ?"
+            params.append(since)
+        if until is not None:
+            query += " AND disengage <= ?"
+            params.append(until)
+        return [row[0] for row in self._db.execute(query + " ORDER BY id", params)]
+
+    def import_file(self, path):
+        """
+        Save the records in a JSON record file, a CSV file (see `save_csv`), or
+        the JSON record files in a directory, skipping records already in the
+        store.
+
+        Returns
+        -------
+        tuple (int, int)
+            number of records imported and skipped
+        """
+        if os.path.isdir(path):
+            records = ((os.path.splitext(os.path.basename(json_file))[0], json_file)
+                       for json_file in sorted(glob.glob(os.path.join(path, "*.json"))))
+            records = ((run_id, ct.load_hash(json_file)) for run_id, json_file in records)
+        elif os.path.splitext(path)[1] == ".csv":
+            records = ct.load_csv_records(path)
+        else:
+            records = [(os.path.splitext(os.path.basename(path))[0], ct.load_hash(path))]
+
+        imported = skipped = 0
+        for run_id, hash_dict in records:
+            if run_id in self:
+                skipped += 1
+            else:
+                self.save(hash_dict, run_id)
+                imported += 1
+        return imported, skipped
+
+    def close(self):
+        self._db.close()
+
+
+def import_records(args):
+    """
+    The `catalogue import` command.
+
+    Imports the records in JSON record files, CSV files and directories of
+    JSON record files into the record store of `catalogue_results` (see
+    `RecordStore.import_file`).
+
+    Parameters
+    ----------
+    args : obj
+        Command line input arguments (argparse.Namespace).
+
+    Returns
+    -------
+    None
+    """
+    for source in args.sources:
+        assert os.path.exists(source), "Path {} does not exist".format(source)
+    with RecordStore(store_path(args.catalogue_results)) as store:
+        imported = skipped = 0
+        for source in args.sources:
+            counts = store.import_file(source)
+            imported += counts[0]
+            skipped += counts[1]
+    print("Imported {} records into {}, skipped {} already there".format(imported, store.path, skipped))
@@ -22,7 +22,7 @@ def check_paths_exists(args):
     Boolean indicating if all filepaths exist.
     """
     paths = [value for key, value in vars(args).items()
-            if key not in ["command", "func", "csv", "catalogue_results"]]
+            if key in ["input_data", "code", "output_data"]]
     path_checks = [os.path.exists(path) for path in paths]
     return all(path_checks)
 
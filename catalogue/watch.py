@@ -0,0 +1,448 @@
+import os
+import re
+import sys
+import stat
+import json
+import time
+import errno
+import select
+import signal
+import struct
+import argparse
+import subprocess
+import ctypes
+import ctypes.util
+
+JOURNAL_NAME = "watch.journal"
+PID_NAME = "watch.pid"
+# written to the journal when the watcher stops cleanly; a journal without it
+# may have missed changes
+STOPPED = "# stopped"
+# written to the journal when the watcher can no longer tell what changed
+EVERYTHING = "*"
+
+# seconds between scans of the polling watcher, and between checks that the
+# lock file still exists
+POLL_INTERVAL = 5
+# seconds to wait for the watcher to start or stop
+WAIT_TIMEOUT = 30
+
+# filesystems where files can change without the watcher being told, because
+# they are written by other machines
+REMOTE_FILESYSTEMS = {"nfs", "nfs4", "cifs", "smb3", "smbfs", "ncpfs", "afs", "9p", "ceph", "glusterfs",
+                      "lustre", "gpfs", "beegfs", "fuse.sshfs", "fuse.s3fs", "fuse.gcsfuse"}
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_DONT_FOLLOW = 0x02000000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+              IN_DELETE_SELF | IN_MOVE_SELF | IN_DONT_FOLLOW)
+_EVENT = struct.Struct("iIII")
+
+
+def _libc():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init1, libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class InotifyWatcher:
+    """
+    Reports the paths changed inside some files and directory trees, using
+    Linux inotify.
+
+    inotify watches single directories, so every directory in the trees is
+    watched, including those created later.
+
+    Parameters
+    ----------
+    paths : list of str
+        files and directories to watch
+
+    Raises
+    ------
+    OSError
+        if inotify is not available, or the trees have more directories
+        than the inotify watch limit
+    """
+
+    method = "inotify"
+
+    def __init__(self, paths):
+        self._libc = _libc()
+        if self._libc is None:
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self._fd = self._libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._dirs = {}
+        try:
+            for path in paths:
+                self._add_tree(path)
+        except OSError:
+            self.close()
+            raise
+
+    def _add(self, path):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error in (errno.ENOENT, errno.ENOTDIR):
+                return
+            raise OSError(error, os.strerror(error), path)
+        self._dirs[wd] = path
+
+    def _add_tree(self, path):
+        """
+        Watch path and every directory inside it, returning the files inside.
+        """
+        self._add(path)
+        found = []
+        for root, dirs, files in os.walk(path):
+            for name in dirs:
+                self._add(os.path.join(root, name))
+            found.extend(os.path.join(root, name) for name in files)
+        return found
+
+    def changes(self, timeout):
+        """
+        Wait up to timeout seconds for changes, and return the changed paths.
+        """
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        changed = []
+        while readable:
+            try:
+                data = os.read(self._fd, 2**16)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = _EVENT.unpack_from(data, offset)
+                offset += _EVENT.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    changed.append(EVERYTHING)
+                    continue
+                if mask & IN_IGNORED:
+                    self._dirs.pop(wd, None)
+                    continue
+                base = self._dirs.get(wd)
+                if base is None:
+                    continue
+                path = os.path.join(base, name) if name else base
+                changed.append(path)
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    # files may be written to a new directory before it is
+                    # watched, so they are all listed as changed
+                    changed.extend(self._add_tree(path))
+        return changed
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+class PollingWatcher:
+    """
+    Reports the paths changed inside some files and directory trees, by
+    comparing the stat data of every file between scans.
+
+    Works on any filesystem, but each scan reads the metadata of every file.
+
+    Parameters
+    ----------
+    paths : list of str
+        files and directories to watch
+    interval : float, optional
+        seconds between scans
+    """
+
+    method = "polling"
+
+    def __init__(self, paths, interval=POLL_INTERVAL):
+        self.paths = paths
+        self.interval = interval
+        self._snapshot = self._scan()
+        self._scanned = time.monotonic()
+
+    def _scan(self):
+        snapshot = {}
+        for path in self.paths:
+            entries = [(path, [])] if not os.path.isdir(path) else \
+                [(root, files) for root, _, files in os.walk(path)]
+            for root, files in entries:
+                for filepath in [root] + [os.path.join(root, name) for name in files]:
+                    try:
+                        st = os.lstat(filepath)
+                    except OSError:
+                        continue
+                    snapshot[filepath] = (st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_mode)
+        return snapshot
+
+    def changes(self, timeout, force=False):
+        """
+        Wait up to timeout seconds, scanning again if the interval has passed
+        (or force is set), and return the changed paths.
+        """
+        if not force:
+            time.sleep(max(min(timeout, self._scanned + self.interval - time.monotonic()), 0))
+            if time.monotonic() < self._scanned + self.interval:
+                return []
+        snapshot = self._scan()
+        self._scanned = time.monotonic()
+        changed = [path for path in snapshot.keys() | self._snapshot.keys()
+                   if snapshot.get(path) != self._snapshot.get(path)]
+        self._snapshot = snapshot
+        return sorted(changed)
+
+    def close(self):
+        pass
+
+
+def watch(paths, journal, lock=None, method="auto", interval=POLL_INTERVAL):
+    """
+    Write the paths that change inside paths to journal until stopped by
+    SIGTERM or SIGINT, or until the lock file is removed.
+
+    The journal starts with a JSON header naming the watched paths and the
+    method used, then lists one changed path per line (`EVERYTHING` if
+    changes may have been missed). The line `STOPPED` is written once the
+    watcher has stopped and the journal is complete.
+
+    Parameters
+    ----------
+    paths : list of str
+        files and directories to watch
+    journal : str
+        path of the journal
+    lock : str, optional
+        the watcher stops, without completing the journal, once this file
+        has existed and is removed
+    method : str, optional
+        "inotify", "polling", or "auto" to use inotify where available
+        (default)
+    interval : float, optional
+        seconds between scans when polling
+    """
+    paths = [os.path.abspath(path) for path in paths]
+    watcher = None
+    if method in ("auto", "inotify"):
+        try:
+            watcher = InotifyWatcher(paths)
+        except OSError:
+            if method == "inotify":
+                raise
+    if watcher is None:
+        watcher = PollingWatcher(paths, interval)
+
+    stopping = []
+    handler = lambda signum, frame: stopping.append(signum)
+    signal.signal(signal.SIGTERM, handler)
+    signal.signal(signal.SIGINT, handler)
+
+    # the journal (and the catalogue_results directory holding it) may be
+    # inside a watched tree, and must not journal itself
+    own = os.path.dirname(os.path.abspath(journal))
+    if changed_under(paths, own):
+        own = os.path.abspath(journal)
+    record = lambda changed: _journal(f, [path for path in changed
+                                          if path != own and not path.startswith(own + os.sep)])
+
+    seen_lock = False
+    with open(journal, "w") as f:
+        f.write(json.dumps({"method": watcher.method, "paths": paths, "pid": os.getpid()}) + "\n")
+        f.flush()
+        try:
+            while not stopping:
+                record(watcher.changes(min(interval, 1.0)))
+                if lock is not None:
+                    exists = os.path.exists(lock)
+                    if seen_lock and not exists:
+                        return
+                    seen_lock = seen_lock or exists
+            # pick up the changes made before the watcher was stopped
+            if isinstance(watcher, PollingWatcher):
+                record(watcher.changes(0, force=True))
+            else:
+                record(watcher.changes(0))
+            f.write(STOPPED + "\n")
+        finally:
+            watcher.close()
+
+
+def _journal(f, changed):
+    if changed:
+        f.write("".join(path + "\n" for path in changed))
+        f.flush()
+
+
+def start_watcher(paths, catalogue_results, method="auto", interval=POLL_INTERVAL):
+    """
+    Start a watcher in the background, writing the changes inside paths to
+    a journal in catalogue_results, see `watch`. Returns once it is
+    watching.
+
+    Parameters
+    ----------
+    paths : list of str
+        files and directories to watch
+    catalogue_results : str
+        directory for the journal, the process id of the watcher and the
+        `.lock` file
+
+    Returns
+    -------
+    bool
+        whether the watcher started
+    """
+    os.makedirs(catalogue_results, exist_ok=True)
+    journal = os.path.join(catalogue_results, JOURNAL_NAME)
+    if os.path.exists(journal):
+        os.remove(journal)
+    process = subprocess.Popen(
+        [sys.executable, "-m", "catalogue.watch", journal, "--lock", os.path.join(catalogue_results, ".lock"),
+         "--method", method, "--interval", str(interval)] + [os.path.abspath(path) for path in paths],
+        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+    deadline = time.monotonic() + WAIT_TIMEOUT
+    while time.monotonic() < deadline and process.poll() is None:
+        if _read_journal(journal):
+            with open(os.path.join(catalogue_results, PID_NAME), "w") as f:
+                f.write(str(process.pid))
+            return True
+        time.sleep(0.05)
+    if process.poll() is None:
+        process.terminate()
+    return False
+
+
+def stop_watcher(catalogue_results):
+    """
+    Stop the watcher started by `start_watcher` and return the paths that
+    changed while it ran.
+
+    Parameters
+    ----------
+    catalogue_results : str
+
+    Returns
+    -------
+    set of str or None
+        absolute paths of the changed files and directories, or None if
+        there was no watcher or it may have missed changes (it stopped
+        early, or inotify dropped events)
+    """
+    pid_path = os.path.join(catalogue_results, PID_NAME)
+    journal = os.path.join(catalogue_results, JOURNAL_NAME)
+    try:
+        with open(pid_path) as f:
+            pid = int(f.read())
+        os.kill(pid, signal.SIGTERM)
+    except (OSError, ValueError):
+        pid = None
+    if pid is not None:
+        deadline = time.monotonic() + WAIT_TIMEOUT
+        while time.monotonic() < deadline:
+            lines = _read_journal(journal)
+            if lines and lines[-1] == STOPPED:
+                break
+            time.sleep(0.05)
+    lines = _read_journal(journal) if pid is not None else []
+    for path in [pid_path, journal]:
+        if os.path.exists(path):
+            os.remove(path)
+    if not lines or lines[-1] != STOPPED or EVERYTHING in lines:
+        return None
+    return set(lines[1:-1])
+
+
+def _read_journal(journal):
+    try:
+        with open(journal) as f:
+            data = f.read()
+    except FileNotFoundError:
+        return []
+    # ignore a line that is still being written
+    return data.split("\n")[:-1]
+
+
+def _filesystem(path):
+    """
+    Return the type of the filesystem holding path, or None if it cannot be
+    told (there is no /proc/self/mounts).
+    """
+    try:
+        with open("/proc/self/mounts") as f:
+            mounts = [line.split()[1:3] for line in f]
+    except OSError:
+        return None
+    path = os.path.realpath(path)
+    # spaces and other characters in mount points are written in octal
+    mounts = [(re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), mount), fstype)
+              for mount, fstype in mounts]
+    found = [(len(mount), fstype) for mount, fstype in mounts
+             if path == mount or path.startswith(mount.rstrip(os.sep) + os.sep)]
+    return max(found)[1] if found else None
+
+
+def watchable(path):
+    """
+    Return True if a watcher of path sees every change to the files inside.
+
+    A change is missed if it is made through a symlink to a file outside
+    path, or through a hard link outside path, and inotify does not see
+    changes made by other machines to a network filesystem. So path must
+    hold no symlinks and no files with more than one link, and be on a local
+    filesystem.
+    """
+    fstype = _filesystem(path)
+    if fstype is None or fstype in REMOTE_FILESYSTEMS or os.path.islink(path):
+        return False
+    entries = [(os.path.dirname(path), [], [os.path.basename(path)])] if not os.path.isdir(path) else \
+        os.walk(path)
+    for root, dirs, files in entries:
+        for name in dirs + files:
+            st = os.lstat(os.path.join(root, name))
+            if stat.S_ISLNK(st.st_mode) or (not stat.S_ISDIR(st.st_mode) and st.st_nlink > 1):
+                return False
+    return True
+
+
+def changed_under(changed, path):
+    """
+    Return True if any of the changed paths is path or inside it, or
+    contains it.
+    """
+    path = os.path.abspath(path)
+    return any(p == path or p.startswith(path + os.sep) or path.startswith(p + os.sep) for p in changed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Journal the changes inside files and directories.")
+    parser.add_argument("journal")
+    parser.add_argument("paths", nargs="+")
+    parser.add_argument("--lock")
+    parser.add_argument("--method", choices=["auto", "inotify", "polling"], default="auto")
+    parser.add_argument("--interval", type=float, default=POLL_INTERVAL)
+    args = parser.parse_args()
+    watch(args.paths, args.journal, lock=args.lock, method=args.method, interval=args.interval)
+
+
+if __name__ == "__main__":
+    main()
@@ -38,6 +38,10 @@ setup(
     name="repro-catalogue",
     version=version,
     install_requires=install_packages,
+    extras_require={
+        # faster, non-cryptographic hash algorithm for --algorithm xxh3_128
+        "xxhash": ["xxhash"],
+    },
     include_package_data=True,
     python_requires=">=3.6",
     author='The Alan Turing Institute Research Engineering Group',
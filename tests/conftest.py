@@ -107,3 +107,17 @@ def copy_fixtures_dir(workspace, fixtures_dir):
     """
     workspace.run("cp -R {} fixtures/".format(fixtures_dir))
     return os.path.join(workspace.workspace, "fixtures")
+
+@pytest.fixture
+def nested_dir(tmpdir):
+    """
+    Create a small directory tree in a temporary directory.
+    Return path.
+    """
+    root = tmpdir.mkdir("nested")
+    root.join("top.txt").write("top")
+    root.mkdir("a").join("a1.txt").write("a1")
+    root.join("a").mkdir("deep").join("deep1.txt").write("deep1")
+    root.mkdir("b").join("b1.txt").write("b1")
+    root.join("b").join("b2.txt").write("b2")
+    return root.strpath
@@ -0,0 +1,186 @@
+import os
+import time
+import argparse
+import pytest
+
+import catalogue.catalogue as ct
+from catalogue.cache import DigestCache, open_cache, CACHE_NAME
+
+
+def age_files(folder, seconds=60):
+    """
+    Move the modification time of all files in folder into the past, so they
+    are outside the window in which the cache refuses to store digests.
+    """
+    past = time.time() - seconds
+    for path, directories, files in os.walk(folder):
+        for f in files:
+            os.utime(os.path.join(path, f), (past, past))
+
+
+@pytest.fixture
+def aged_fixtures_dir(copy_fixtures_dir):
+    age_files(copy_fixtures_dir)
+    return copy_fixtures_dir
+
+
+def test_lookup_store(tmpdir, aged_fixtures_dir):
+
+    path = os.path.join(aged_fixtures_dir, "fixture1.json")
+    st = os.stat(path)
+
+    with DigestCache(os.path.join(tmpdir, CACHE_NAME)) as cache:
+        assert cache.lookup(st) is None
+        cache.store(st, "abc")
+        assert cache.lookup(st) == "abc"
+        # the algorithm is part of the key
+        assert cache.lookup(st, algorithm="sha256") is None
+        assert (cache.hits, cache.misses) == (1, 2)
+
+    # digests survive reopening the cache
+    with DigestCache(os.path.join(tmpdir, CACHE_NAME)) as cache:
+        assert cache.lookup(st) == "abc"
+
+        # any change to the file metadata is a miss
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+        assert cache.lookup(os.stat(path)) is None
+
+
+def test_recently_modified_not_cached(tmpdir, copy_fixtures_dir):
+
+    st = os.stat(os.path.join(copy_fixtures_dir, "fixture1.json"))
+    with DigestCache(os.path.join(tmpdir, CACHE_NAME)) as cache:
+        cache.store(st, "abc")
+        assert cache.lookup(st) is None
+
+
+def test_eviction(tmpdir, aged_fixtures_dir):
+
+    paths = sorted(os.path.join(aged_fixtures_dir, f) for f in os.listdir(aged_fixtures_dir))
+    with DigestCache(os.path.join(tmpdir, CACHE_NAME), max_entries=3) as cache:
+        for path in paths:
+            cache.store(os.stat(path), path)
+
+    with DigestCache(os.path.join(tmpdir, CACHE_NAME), max_entries=3) as cache:
+        assert sum(cache.lookup(os.stat(path)) is not None for path in paths) == 3
+
+    with pytest.raises(AssertionError):
+        DigestCache(os.path.join(tmpdir, "other.sqlite"), max_entries=0)
+
+
+def test_damaged_cache(tmpdir, aged_fixtures_dir):
+
+    cache_path = os.path.join(tmpdir, CACHE_NAME)
+    with open(cache_path, "w") as f:
+        f.write("not a database")
+    # a write-ahead log left by the damaged database is removed with it
+    with open(cache_path + "-wal", "w") as f:
+        f.write("not a log")
+
+    st = os.stat(os.path.join(aged_fixtures_dir, "fixture1.json"))
+    with DigestCache(cache_path) as cache:
+        assert cache.lookup(st) is None
+        cache.store(st, "abc")
+        assert cache.lookup(st) == "abc"
+    with DigestCache(cache_path) as cache:
+        assert cache.lookup(st) == "abc"
+
+
+def test_hash_dir_by_file_cache(tmpdir, aged_fixtures_dir, monkeypatch):
+
+    expected = ct.hash_dir_by_file(aged_fixtures_dir)
+    cache_path = os.path.join(tmpdir, CACHE_NAME)
+
+    with DigestCache(cache_path) as cache:
+        assert ct.hash_dir_by_file(aged_fixtures_dir, cache=cache) == expected
+        assert cache.misses == len(expected)
+
+    # second run is served from the cache without reading any file
+    def fail(*args, **kwargs):
+        raise AssertionError("file was hashed")
+    with monkeypatch.context() as m:
+        m.setattr(ct, "hash_file", fail)
+        with DigestCache(cache_path) as cache:
+            assert ct.hash_dir_by_file(aged_fixtures_dir, jobs=4, cache=cache) == expected
+            assert cache.hits == len(expected)
+
+    # a changed file is hashed again
+    changed = os.path.join(aged_fixtures_dir, "fixture4.csv")
+    with open(changed, "a") as f:
+        f.write("new line\n")
+    past = time.time() - 30
+    os.utime(changed, (past, past))
+    with DigestCache(cache_path) as cache:
+        hashes = ct.hash_dir_by_file(aged_fixtures_dir, cache=cache)
+        assert hashes[changed] == ct.hash_file(changed).hexdigest()
+        assert hashes[changed] != expected[changed]
+        assert cache.misses == 1
+
+
+def test_hash_dir_full_cache(tmpdir, aged_fixtures_dir, monkeypatch):
+
+    expected = ct.hash_dir_full(aged_fixtures_dir)
+    cache_path = os.path.join(tmpdir, CACHE_NAME)
+
+    with DigestCache(cache_path) as cache:
+        assert ct.hash_dir_full(aged_fixtures_dir, cache=cache) == expected
+
+    with monkeypatch.context() as m:
+        m.setattr(ct, "hash_file", None)
+        with DigestCache(cache_path) as cache:
+            assert ct.hash_dir_full(aged_fixtures_dir, cache=cache) == expected
+            assert ct.hash_input(aged_fixtures_dir, cache=cache) == expected
+
+
+def test_hash_dir_full_manifest_cache(tmpdir, aged_fixtures_dir, monkeypatch):
+
+    expected_manifest = {}
+    expected = ct.hash_dir_full(aged_fixtures_dir, manifest=expected_manifest)
+    cache_path = os.path.join(tmpdir, CACHE_NAME)
+
+    with DigestCache(cache_path) as cache:
+        assert ct.hash_dir_full(aged_fixtures_dir, cache=cache) == expected
+
+    # the directory digest is cached, but not yet the file digests for the manifest
+    with DigestCache(cache_path) as cache:
+        manifest = {}
+        assert ct.hash_dir_full(aged_fixtures_dir, cache=cache, manifest=manifest) == expected
+        assert manifest == expected_manifest
+
+    with monkeypatch.context() as m:
+        m.setattr(ct, "hash_file", None)
+        with DigestCache(cache_path) as cache:
+            manifest = {}
+            assert ct.hash_dir_full(aged_fixtures_dir, cache=cache, manifest=manifest) == expected
+            assert manifest == expected_manifest
+
+
+def test_verify_cache(tmpdir, aged_fixtures_dir, capsys):
+
+    path = os.path.join(aged_fixtures_dir, "fixture1.json")
+    cache_path = os.path.join(tmpdir, CACHE_NAME)
+
+    # plant a wrong digest, as if the file changed without its metadata changing
+    with DigestCache(cache_path) as cache:
+        cache.store(os.stat(path), "wrong")
+        assert ct.file_digest(path, cache=cache) == "wrong"
+
+    with DigestCache(cache_path, verify=True) as cache:
+        assert ct.file_digest(path, cache=cache) == ct.hash_file(path).hexdigest()
+        assert cache.mismatches == [path]
+    assert "out of date" in capsys.readouterr().out
+
+    with DigestCache(cache_path) as cache:
+        assert ct.file_digest(path, cache=cache) == ct.hash_file(path).hexdigest()
+
+
+def test_open_cache(tmpdir):
+
+    args = argparse.Namespace(catalogue_results=os.path.join(tmpdir, "catalogue_results"))
+    assert open_cache(args) is None
+
+    setattr(args, "cache", True)
+    cache = open_cache(args)
+    assert isinstance(cache, DigestCache)
+    cache.close()
+    assert os.path.exists(os.path.join(tmpdir, "catalogue_results", CACHE_NAME))
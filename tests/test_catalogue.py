@@ -1,8 +1,14 @@
-
+import io
 import os
+import sys
+import copy
 import git
+import shutil
+import subprocess
 import hashlib
 import pytest
+from types import SimpleNamespace
+from concurrent.futures import ProcessPoolExecutor
 
 import catalogue.catalogue as ct
 from git import InvalidGitRepositoryError, RepositoryDirtyError
@@ -11,29 +17,29 @@ from git import InvalidGitRepositoryError, RepositoryDirtyError
 def test_modified_walk(fixtures_dir, fixture1, fixture2, fixture3, fixture4, good_config, bad_config1, bad_config2):
 
     # valid path
-    paths = ct.modified_walk(fixtures_dir)
+    paths = list(ct.modified_walk(fixtures_dir))
     assert paths == [bad_config1, bad_config2, fixture1, fixture2, fixture3, fixture4, good_config]
 
     # use ingore_exts
-    paths = ct.modified_walk(fixtures_dir, ignore_exts=[".json"])
+    paths = list(ct.modified_walk(fixtures_dir, ignore_exts=[".json"]))
     assert paths == [bad_config1, bad_config2, fixture4, good_config]
 
-    paths = ct.modified_walk(fixtures_dir, ignore_exts=[".json", ".csv"])
+    paths = list(ct.modified_walk(fixtures_dir, ignore_exts=[".json", ".csv"]))
     assert paths == [bad_config1, bad_config2, good_config]
 
-    paths = ct.modified_walk(fixtures_dir, ignore_exts=[".py"])
+    paths = list(ct.modified_walk(fixtures_dir, ignore_exts=[".py"]))
     assert paths == [bad_config1, bad_config2, fixture1, fixture2, fixture3, fixture4, good_config ]
 
     # use ignore_subdirs
     base_dir = "tests"
     subdir = os.path.join(base_dir, "fixtures")
-    paths = ct.modified_walk(base_dir, ignore_subdirs=[subdir])
+    paths = list(ct.modified_walk(base_dir, ignore_subdirs=[subdir]))
     assert (all(
         [os.path.join(subdir, os.path.basename(fixture)) not in paths
         for fixture in [bad_config1, bad_config2, fixture1, fixture2, fixture3, fixture4, good_config]]))
 
     # change ignore_dot_files to False
-    paths = ct.modified_walk(".", ignore_dot_files=False)
+    paths = list(ct.modified_walk(".", ignore_dot_files=False))
     assert "./.gitignore" in paths
 
     # path does not exist or not provided
@@ -45,6 +51,88 @@ def test_modified_walk(fixtures_dir, fixture1, fixture2, fixture3, fixture4, goo
         ct.modified_walk()
 
 
+def test_modified_walk_scandir(nested_dir, monkeypatch):
+
+    # paths are yielded lazily, in the order of sorting all of them
+    paths = ct.modified_walk(nested_dir)
+    assert not isinstance(paths, list)
+    paths = list(paths)
+    assert paths == sorted(paths)
+    assert paths == sorted(os.path.join(path, f) for path, _, files in os.walk(nested_dir) for f in files)
+
+    # a directory whose name sorts between files that share its prefix
+    for name in ["a.txt", "a0.txt", "a-b.txt"]:
+        with open(os.path.join(nested_dir, name), "w") as f:
+            f.write(name)
+    paths = list(ct.modified_walk(nested_dir))
+    assert paths == sorted(paths)
+
+    # ignored directories are not entered at all
+    listed = []
+    scandir = os.scandir
+    def spy(path):
+        listed.append(os.path.normpath(path))
+        return scandir(path)
+    ignored = os.path.join(nested_dir, "a")
+    with monkeypatch.context() as m:
+        m.setattr(os, "scandir", spy)
+        paths = list(ct.modified_walk(nested_dir, ignore_subdirs=[ignored]))
+    assert not any(path.startswith(ignored + os.sep) for path in paths)
+    assert os.path.normpath(ignored) not in listed
+    assert os.path.normpath(os.path.join(ignored, "deep")) not in listed
+    assert os.path.join(nested_dir, "b", "b1.txt") in paths
+
+
+def test_modified_walk_links(nested_dir):
+
+    # symlinked directories are only entered when following symlinks, and a
+    # link back to a directory above is not followed round the loop
+    os.symlink(os.path.join(nested_dir, "b"), os.path.join(nested_dir, "link"))
+    os.symlink(nested_dir, os.path.join(nested_dir, "b", "up"))
+    special = {}
+    paths = list(ct.modified_walk(nested_dir, special=special))
+    assert not any(os.sep + "link" + os.sep in path for path in paths)
+    assert special == {}
+    followed = list(ct.modified_walk(nested_dir, follow_symlinks=True, special=special))
+    assert os.path.join(nested_dir, "link", "b1.txt") in followed
+    assert set(paths) < set(followed)
+    assert special == {os.path.join(nested_dir, "b", "up"): "symlink loop",
+                       os.path.join(nested_dir, "link", "up"): "symlink loop"}
+
+    # special files are recorded instead of being read
+    special = {}
+    os.mkfifo(os.path.join(nested_dir, "pipe"))
+    os.symlink(os.path.join(nested_dir, "missing"), os.path.join(nested_dir, "broken"))
+    paths = list(ct.modified_walk(nested_dir, special=special))
+    assert special == {os.path.join(nested_dir, "pipe"): "fifo",
+                       os.path.join(nested_dir, "broken"): "broken symlink"}
+    assert os.path.join(nested_dir, "pipe") not in paths
+    assert ct.hash_dir_full(nested_dir) == ct.hash_dir_full(nested_dir)
+
+
+def test_hard_links(nested_dir, tmpdir, monkeypatch):
+    from catalogue.cache import DigestCache
+
+    linked = [os.path.join(nested_dir, "b", "b1.txt"), os.path.join(nested_dir, "b", "b1-link.txt")]
+    os.link(*linked)
+    expected = ct.hash_dir_by_file(nested_dir)
+    assert expected[linked[0]] == expected[linked[1]]
+
+    # each inode is only hashed once, and its digest reused for every link
+    hashed = []
+    digest = ct._digest
+    def spy(path, **kwargs):
+        hashed.append(path)
+        return digest(path, **kwargs)
+    monkeypatch.setattr(ct, "_digest", spy)
+    with DigestCache(tmpdir.join("cache.sqlite").strpath) as cache:
+        for kwargs in [{}, {"jobs": 2}, {"cache": cache}]:
+            hashed.clear()
+            assert ct.hash_dir_by_file(nested_dir, **kwargs) == expected
+            assert len(set(linked) & set(hashed)) == 1
+            assert len(hashed) == len(expected) - 1
+
+
 @pytest.mark.parametrize(
     "hash_f",
     [ct.hash_file, ct.hash_dir_full, ct.hash_dir_by_file, ct.hash_input, ct.hash_output]
@@ -78,6 +166,31 @@ def test_hash_file(fixtures_dir, copy_fixtures_dir, empty_hash):
             assert ct.hash_file(file_path).hexdigest() == ct.hash_file(copy_file_path).hexdigest()
 
 
+@pytest.mark.parametrize("size", [0, 1, 2**10, 2**16 - 1, 2**16, 2**16 + 1, 3 * 2**20 + 7])
+@pytest.mark.parametrize("mmap_threshold", [2**26, 1])
+def test_hash_file_read_paths(tmpdir, monkeypatch, size, mmap_threshold):
+
+    # every read path gives the same digest as hashing the whole file at once
+    monkeypatch.setattr(ct, "MMAP_THRESHOLD", mmap_threshold)
+    data = os.urandom(size)
+    file = tmpdir.join("data.bin")
+    file.write_binary(data)
+
+    assert ct.hash_file(file.strpath).hexdigest() == hashlib.sha512(data).hexdigest()
+    m = hashlib.sha512(b"prefix")
+    assert ct.hash_file(file.strpath, m).hexdigest() == hashlib.sha512(b"prefix" + data).hexdigest()
+
+
+def test_chunk_size():
+
+    for block_size in [512, 4096, 3 * 2**20]:
+        for size in [0, 100, 2**20, 2**40]:
+            st = SimpleNamespace(st_size=size, st_blksize=block_size)
+            chunk_size = ct._chunk_size(st)
+            assert ct.MIN_CHUNK_SIZE <= chunk_size < ct.MAX_CHUNK_SIZE + block_size
+            assert chunk_size % block_size == 0
+
+
 def test_hash_dir_by_file(fixtures_dir, copy_fixtures_dir, empty_hash, fixture1):
 
     # input is a directory
@@ -91,6 +204,287 @@ def test_hash_dir_by_file(fixtures_dir, copy_fixtures_dir, empty_hash, fixture1)
         ct.hash_dir_by_file(fixture1)
 
 
+@pytest.mark.parametrize("jobs", [2, 4, 16])
+def test_hash_dir_by_file_jobs(fixtures_dir, jobs):
+
+    # hashing concurrently gives exactly the same mapping, in the same order
+    sequential = ct.hash_dir_by_file(fixtures_dir)
+    concurrent = ct.hash_dir_by_file(fixtures_dir, jobs=jobs)
+    assert concurrent == sequential
+    assert list(concurrent.keys()) == list(sequential.keys())
+
+    assert ct.hash_output(fixtures_dir, jobs=jobs) == sequential
+
+
+@pytest.mark.parametrize("jobs,prefetch", [(1, 1), (1, 4), (3, 2)])
+def test_prefetch(nested_dir, monkeypatch, jobs, prefetch):
+
+    # prefetching changes when files are read, never the digests or their order
+    sequential = ct.hash_dir_by_file(nested_dir)
+    prefetched = ct.hash_dir_by_file(nested_dir, jobs=jobs, prefetch=prefetch)
+    assert list(prefetched.items()) == list(sequential.items())
+    assert ct.hash_dir_full(nested_dir, prefetch=prefetch) == ct.hash_dir_full(nested_dir)
+
+    # including files hashed from a memory map after their first chunk
+    monkeypatch.setattr(ct, "MMAP_THRESHOLD", 1)
+    assert ct.hash_dir_by_file(nested_dir, jobs=jobs, prefetch=prefetch) == sequential
+    assert ct.hash_dir_full(nested_dir, prefetch=prefetch) == ct.hash_dir_full(nested_dir)
+
+
+def test_prefetch_open_files(nested_dir, monkeypatch):
+
+    # the files opened ahead and the one being hashed
+    open_files = []
+    most_open = []
+
+    class CountedFile(io.FileIO):
+        def close(self):
+            if self in open_files:
+                open_files.remove(self)
+            super().close()
+
+    def open_ahead(filepath):
+        f = CountedFile(filepath, 'rb')
+        open_files.append(f)
+        most_open.append(len(open_files))
+        return filepath, f, f.read(ct.MIN_CHUNK_SIZE)
+
+    monkeypatch.setattr(ct, "_open_ahead", open_ahead)
+    assert ct.hash_dir_by_file(nested_dir, prefetch=2) == ct.hash_dir_by_file(nested_dir)
+    assert max(most_open) == 3
+    assert open_files == []
+
+
+def test_ordered_map():
+
+    running = []
+    peak = []
+    def work(i):
+        running.append(i)
+        peak.append(len(running))
+        running.remove(i)
+        return i * i
+
+    assert list(ct._ordered_map(work, range(50), 4, 6)) == [i * i for i in range(50)]
+    assert max(peak) <= 4
+
+    # stopping early discards the results already computed
+    discarded = []
+    results = ct._ordered_map(work, range(50), 2, 3, discard=discarded.append)
+    assert next(results) == 0
+    results.close()
+    assert len(discarded) <= 3
+    assert set(discarded) <= {i * i for i in range(1, 4)}
+
+
+@pytest.mark.parametrize("jobs", [0, -1, 1.5, "2"])
+def test_hash_dir_by_file_bad_jobs(fixtures_dir, jobs):
+    with pytest.raises(AssertionError):
+        ct.hash_dir_by_file(fixtures_dir, jobs=jobs)
+
+
+@pytest.fixture
+def small_fingerprints(monkeypatch):
+    """
+    Shrink fingerprint blocks so small files are sampled like very large ones.
+    """
+    monkeypatch.setattr(ct, "FINGERPRINT_BLOCK", 16)
+    monkeypatch.setattr(ct, "FINGERPRINT_SAMPLES", 4)
+
+
+def test_fingerprint_file(tmpdir, small_fingerprints):
+
+    path = tmpdir.join("big.dat")
+    data = bytearray(os.urandom(1000))
+    path.write_binary(bytes(data))
+    fingerprint = ct.fingerprint_file(path.strpath).hexdigest()
+    assert fingerprint == ct.fingerprint_file(path.strpath).hexdigest()
+    assert fingerprint != ct.hash_file(path.strpath).hexdigest()
+
+    offsets = list(ct._fingerprint_offsets(1000))
+    assert len(offsets) == 6 and offsets == sorted(offsets)
+    assert offsets[0] == 0 and offsets[-1] == 1000 - 16
+
+    # changes to sampled bytes or the size are detected
+    for change in [lambda d: d.__setitem__(0, d[0] ^ 1), lambda d: d.__setitem__(-1, d[-1] ^ 1),
+                   lambda d: d.__setitem__(offsets[2], d[offsets[2]] ^ 1), lambda d: d.append(0)]:
+        changed = bytearray(data)
+        change(changed)
+        path.write_binary(bytes(changed))
+        assert ct.fingerprint_file(path.strpath).hexdigest() != fingerprint
+
+    # but not to bytes that are not sampled
+    sampled = {i for offset in offsets for i in range(offset, offset + 16)}
+    unsampled = min(set(range(1000)) - sampled)
+    changed = bytearray(data)
+    changed[unsampled] ^= 1
+    path.write_binary(bytes(changed))
+    assert ct.fingerprint_file(path.strpath).hexdigest() == fingerprint
+
+
+def test_fingerprint_threshold(nested_dir, tmpdir, small_fingerprints):
+
+    path = os.path.join(nested_dir, "big.dat")
+    with open(path, "wb") as f:
+        f.write(os.urandom(1000))
+
+    hashes = ct.hash_dir_by_file(nested_dir, fingerprint_threshold=100)
+    assert hashes[path] == "fp-sha512:" + ct.fingerprint_file(path).hexdigest()
+    small = os.path.join(nested_dir, "top.txt")
+    assert hashes[small] == ct.hash_file(small).hexdigest()
+    assert ct.hash_dir_by_file(nested_dir, jobs=2, prefetch=2, fingerprint_threshold=100) == hashes
+    assert ct.hash_output(path, fingerprint_threshold=100) == {path: hashes[path]}
+    assert ct.hash_input(path, algorithm="blake2b", fingerprint_threshold=100).startswith("fp-blake2b:")
+
+    # fingerprints are cached apart from full hashes of the same file
+    from catalogue.cache import DigestCache
+    past = 1000000000
+    os.utime(path, (past, past))
+    with DigestCache(tmpdir.join("cache.sqlite").strpath) as cache:
+        assert ct.file_digest(path, cache=cache, fingerprint_threshold=100) == hashes[path]
+        assert ct.file_digest(path, cache=cache) == ct.hash_file(path).hexdigest()
+        assert ct.file_digest(path, cache=cache, fingerprint_threshold=100) == hashes[path]
+        assert cache.hits == 1
+
+    # a Merkle tree with fingerprints never matches one without
+    assert ct.hash_dir_tree(nested_dir, fingerprint_threshold=100) != ct.hash_dir_tree(nested_dir)
+    assert ct.hash_dir_tree(nested_dir, fingerprint_threshold=10**6) == ct.hash_dir_tree(nested_dir)
+
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    """
+    Shrink content-defined chunks so small files are split into many.
+    """
+    monkeypatch.setattr(ct, "CDC_MIN_CHUNK", 64)
+    monkeypatch.setattr(ct, "CDC_MAX_CHUNK", 1024)
+    monkeypatch.setattr(ct, "CDC_WINDOW", 8)
+    monkeypatch.setattr(ct, "CDC_READ_SIZE", 1000)
+
+
+def test_hash_chunks(tmpdir, small_chunks):
+
+    path = tmpdir.join("big.dat")
+    data = bytearray(os.urandom(50000))
+    path.write_binary(bytes(data))
+    m, chunks = ct.hash_chunks(path.strpath)
+
+    # the whole file digest is unchanged, and the chunks cover the file
+    assert m.hexdigest() == ct.hash_file(path.strpath).hexdigest()
+    assert sum(length for length, _ in chunks) == len(data)
+    assert all(64 <= length <= 1024 for length, _ in chunks[:-1])
+    assert 20 < len(chunks) < 200
+    assert ct.unpack_chunks(ct.pack_chunks(chunks)) == ("cdc-sha512", chunks)
+
+    # an insertion only changes the chunk it lands in
+    data[25000:25000] = b"inserted"
+    path.write_binary(bytes(data))
+    new_chunks = ct.hash_chunks(path.strpath)[1]
+    old_digests = set(digest for _, digest in chunks)
+    assert 1 <= sum(digest not in old_digests for _, digest in new_chunks) <= 2
+
+    # empty files have no chunks
+    tmpdir.join("empty.dat").write_binary(b"")
+    assert ct.hash_chunks(tmpdir.join("empty.dat").strpath)[1] == []
+
+
+def test_chunk_threshold(nested_dir, tmpdir, small_chunks):
+
+    path = os.path.join(nested_dir, "big.dat")
+    with open(path, "wb") as f:
+        f.write(os.urandom(5000))
+
+    chunks = {}
+    hashes = ct.hash_dir_by_file(nested_dir, chunk_threshold=1000, chunks=chunks)
+    assert hashes == ct.hash_dir_by_file(nested_dir)
+    assert list(chunks) == [path]
+    assert chunks[path] == ct.pack_chunks(ct.hash_chunks(path)[1])
+    for kwargs in [dict(jobs=2), dict(prefetch=2)]:
+        other = {}
+        assert ct.hash_dir_by_file(nested_dir, chunk_threshold=1000, chunks=other, **kwargs) == hashes
+        assert other == chunks
+
+    # chunk tables are cached next to the digests
+    from catalogue.cache import DigestCache
+    past = 1000000000
+    os.utime(path, (past, past))
+    with DigestCache(tmpdir.join("cache.sqlite").strpath) as cache:
+        assert ct.file_digest(path, cache=cache) == hashes[path]
+        other = {}
+        assert ct.file_digest(path, cache=cache, chunk_threshold=1000, chunks=other) == hashes[path]
+        assert other == chunks
+        other = {}
+        ct.file_digest(path, cache=cache, chunk_threshold=1000, chunks=other)
+        assert other == chunks and cache.hits == 3
+
+    # fingerprinted files are not split into chunks
+    other = {}
+    ct.hash_output(path, chunk_threshold=1000, fingerprint_threshold=1000, chunks=other)
+    assert other == {}
+
+
+@pytest.fixture
+def archives(nested_dir, tmpdir):
+    import tarfile
+    import zipfile
+    paths = {}
+    for name, mode in [("data.tar", "w"), ("data.tar.gz", "w:gz"), ("data.tar.xz", "w:xz")]:
+        paths[name] = tmpdir.join(name).strpath
+        with tarfile.open(paths[name], mode) as archive:
+            archive.add(nested_dir, arcname="nested")
+    paths["data.zip"] = tmpdir.join("data.zip").strpath
+    with zipfile.ZipFile(paths["data.zip"], "w", zipfile.ZIP_DEFLATED) as archive:
+        for path in ct.modified_walk(nested_dir):
+            archive.write(path, "nested/" + os.path.relpath(path, nested_dir).replace(os.sep, "/"))
+    return paths
+
+
+def test_hash_archive(nested_dir, archives, tmpdir):
+
+    expected = {"nested/" + os.path.relpath(path, nested_dir).replace(os.sep, "/"): digest
+                for path, digest in ct.hash_dir_by_file(nested_dir).items()}
+    for name, path in archives.items():
+        m, members = ct.hash_archive(path)
+        assert m.hexdigest() == ct.hash_file(path).hexdigest()
+        assert members == expected
+
+    # files that only look like archives are hashed as a whole
+    fake = tmpdir.join("fake.tar.gz").strpath
+    with open(fake, "wb") as f:
+        f.write(os.urandom(1000))
+    m, members = ct.hash_archive(fake)
+    assert m.hexdigest() == ct.hash_file(fake).hexdigest() and members is None
+
+
+def test_archive_members(archives, tmpdir):
+    from catalogue.cache import DigestCache
+
+    folder = os.path.dirname(archives["data.tar"])
+    members = {}
+    hashes = ct.hash_output(folder, archive_members=True, members=members)
+    assert hashes == ct.hash_output(folder)
+    assert sorted(members) == sorted(archives.values())
+    assert members[archives["data.zip"]] == ct.hash_archive(archives["data.zip"])[1]
+    for kwargs in [dict(jobs=2), dict(prefetch=2), dict(chunk_threshold=100)]:
+        other = {}
+        assert ct.hash_output(folder, archive_members=True, members=other, **kwargs) == hashes
+        assert other == members
+
+    # member digests are cached next to the digests
+    past = 1000000000
+    os.utime(archives["data.tar"], (past, past))
+    with DigestCache(tmpdir.join("cache.sqlite").strpath) as cache:
+        for hits in [0, 2]:
+            other = {}
+            ct.file_digest(archives["data.tar"], cache=cache, archive_members=True, members=other)
+            assert other == {archives["data.tar"]: members[archives["data.tar"]]} and cache.hits == hits
+
+    # fingerprinted archives are not opened
+    other = {}
+    ct.hash_output(archives["data.tar"], archive_members=True, fingerprint_threshold=1, members=other)
+    assert other == {}
+
+
 def test_hash_dir_full(fixtures_dir, copy_fixtures_dir, empty_hash, fixture1):
 
     # input is a directory
@@ -103,6 +497,169 @@ def test_hash_dir_full(fixtures_dir, copy_fixtures_dir, empty_hash, fixture1):
         ct.hash_dir_full(fixture1)
 
 
+@pytest.mark.parametrize("algorithm", ["sha512", "sha256", "blake2b", "blake2s"])
+def test_algorithms(fixtures_dir, fixture1, algorithm):
+
+    expected = getattr(hashlib, algorithm)(open(fixture1, "rb").read()).hexdigest()
+    assert ct.hash_file(fixture1, algorithm=algorithm).hexdigest() == expected
+
+    # digests are labelled with their algorithm, except the default sha512
+    digest = ct.file_digest(fixture1, algorithm=algorithm)
+    assert ct.split_digest(digest) == (algorithm, expected)
+    assert digest == (expected if algorithm == "sha512" else algorithm + ":" + expected)
+    assert ct.check_digest(digest)
+
+    hashes = ct.hash_output(fixtures_dir, algorithm=algorithm)
+    assert hashes[fixture1] == digest
+    assert ct.hash_dir_by_file(fixtures_dir, jobs=2, algorithm=algorithm) == hashes
+
+    full = ct.hash_input(fixtures_dir, algorithm=algorithm)
+    assert ct.split_digest(full)[0] == algorithm
+    assert (full == ct.hash_dir_full(fixtures_dir)) == (algorithm == "sha512")
+
+
+def test_xxhash(fixture1):
+    xxhash = pytest.importorskip("xxhash")
+    digest = ct.file_digest(fixture1, algorithm="xxh3_128")
+    assert digest == "xxh3_128:" + xxhash.xxh3_128(open(fixture1, "rb").read()).hexdigest()
+    assert ct.check_digest(digest)
+
+
+def test_unknown_algorithm(fixtures_dir, fixture1):
+    with pytest.raises(AssertionError):
+        ct.hash_file(fixture1, algorithm="md4")
+    with pytest.raises(AssertionError):
+        ct.hash_output(fixtures_dir, algorithm="md4")
+
+
+def test_check_digest():
+    sha512 = hashlib.sha512().hexdigest()
+    assert ct.check_digest(sha512)
+    assert ct.check_digest("blake2s:" + hashlib.blake2s().hexdigest())
+    # digests from an algorithm that is not installed can still be loaded
+    assert ct.check_digest("somehash:0123abcd")
+
+    assert not ct.check_digest(sha512[:-1])
+    assert not ct.check_digest("blake2s:" + sha512)
+    assert not ct.check_digest("sha256:xyz")
+
+
+def test_hash_dir_tree(nested_dir):
+
+    tree = {}
+    digest = ct.hash_dir_tree(nested_dir, tree=tree)
+    assert ct.split_digest(digest)[0] == "merkle-sha512"
+    assert ct.check_digest(digest)
+    assert digest == tree["."]
+    assert sorted(tree) == [".", "a", "a/deep", "b"]
+
+    # same digest with several jobs, and independent of where the tree is
+    assert ct.hash_dir_tree(nested_dir, jobs=3) == digest
+    copy = os.path.join(os.path.dirname(nested_dir), "copy")
+    shutil.copytree(nested_dir, copy)
+    assert ct.hash_dir_tree(copy) == digest
+
+    # leaf directory digest is built from its files' names and digests
+    deep1 = os.path.join(nested_dir, "a", "deep", "deep1.txt")
+    m = hashlib.sha512(b"f deep1.txt\0" + ct.hash_file(deep1).hexdigest().encode() + b"\n")
+    assert tree["a/deep"] == "merkle-sha512:" + m.hexdigest()
+
+    # changing a file changes its directory and their parents only
+    with open(deep1, "a") as f:
+        f.write("changed")
+    new_tree = {}
+    assert ct.hash_dir_tree(nested_dir, tree=new_tree) != digest
+    assert sorted(d for d in tree if tree[d] != new_tree[d]) == [".", "a", "a/deep"]
+
+    # renaming a file changes the digest
+    os.rename(os.path.join(copy, "top.txt"), os.path.join(copy, "top2.txt"))
+    assert ct.hash_dir_tree(copy) != digest
+
+    # other algorithms
+    assert ct.split_digest(ct.hash_dir_tree(nested_dir, algorithm="blake2b"))[0] == "merkle-blake2b"
+
+    # input is a file
+    with pytest.raises(AssertionError):
+        ct.hash_dir_tree(deep1)
+
+
+@pytest.mark.parametrize("algorithm", ["sha512", "blake2s"])
+def test_hash_dir_full_manifest(nested_dir, monkeypatch, algorithm):
+
+    expected = ct.hash_dir_full(nested_dir, algorithm=algorithm)
+
+    # every file is read once for both the directory hash and the manifest
+    calls = []
+    hash_file = ct.hash_file
+    def counting_hash_file(path, *args, **kwargs):
+        calls.append(path)
+        return hash_file(path, *args, **kwargs)
+    monkeypatch.setattr(ct, "hash_file", counting_hash_file)
+
+    manifest = {}
+    assert ct.hash_dir_full(nested_dir, algorithm=algorithm, manifest=manifest) == expected
+    assert sorted(calls) == sorted(set(calls))
+    assert manifest == {
+        relpath: ct.file_digest(os.path.join(nested_dir, *relpath.split("/")), algorithm=algorithm)
+        for relpath in ["top.txt", "a/a1.txt", "a/deep/deep1.txt", "b/b1.txt", "b/b2.txt"]
+    }
+
+    # the merkle mode fills the same manifest
+    merkle_manifest = {}
+    ct.hash_input(nested_dir, mode="merkle", algorithm=algorithm, manifest=merkle_manifest)
+    assert merkle_manifest == manifest
+
+
+def test_pack_manifest():
+
+    manifest = {"b/x.txt": "abc", "a.txt": "def"}
+    assert ct.pack_manifest(manifest) == manifest
+    assert list(ct.pack_manifest(manifest)) == ["a.txt", "b/x.txt"]
+    assert ct.unpack_manifest(ct.pack_manifest(manifest)) == manifest
+
+    packed = ct.pack_manifest(manifest, compress=True)
+    assert packed.startswith("zlib:")
+    assert ct.unpack_manifest(packed) == manifest
+
+    with pytest.raises(AssertionError):
+        ct.unpack_manifest("gzip:abc")
+
+
+def test_hash_input_modes(nested_dir, fixture1):
+
+    assert ct.hash_input(nested_dir) == ct.hash_dir_full(nested_dir)
+    tree = {}
+    assert ct.hash_input(nested_dir, mode="merkle", jobs=2, tree=tree) == ct.hash_dir_tree(nested_dir)
+    assert "a/deep" in tree
+
+    # a single input file has the same digest in both modes
+    assert ct.hash_input(fixture1, mode="merkle") == ct.hash_input(fixture1)
+
+    with pytest.raises(AssertionError):
+        ct.hash_input(nested_dir, mode="other")
+
+
+def test_record_options(nested_dir, fixture1):
+
+    record = ct.load_hash(fixture1)
+    assert ct.record_options(record) == {"algorithm": "sha512", "input_mode": "full", "input_ignore": [],
+                                         "fingerprint_threshold": 0, "chunk_threshold": 0,
+                                         "follow_symlinks": False, "archive_members": False,
+                                         "code_identity": "commit"}
+
+    record["input_data"] = {nested_dir: ct.hash_dir_tree(nested_dir, algorithm="blake2s")}
+    record["ignore"] = {"input_data": ["*.log"]}
+    record["fingerprint_threshold"] = 2**30
+    record["chunk_threshold"] = 2**20
+    record["follow_symlinks"] = True
+    record["archive_members"] = True
+    record["code"] = {"code": "tree:0"}
+    assert ct.record_options(record) == {"algorithm": "blake2s", "input_mode": "merkle", "input_ignore": ["*.log"],
+                                         "fingerprint_threshold": 2**30, "chunk_threshold": 2**20,
+                                         "follow_symlinks": True, "archive_members": True,
+                                         "code_identity": "tree"}
+
+
 def test_hash_input(fixtures_dir, copy_fixtures_dir, fixture1, empty_hash):
 
     # 1. input is a directory
@@ -169,6 +726,8 @@ def test_hash_code(git_repo, git_hash, workspace):
     # missing arguments
     with pytest.raises(TypeError):
         ct.hash_code()
+    with pytest.raises(AssertionError):
+        ct.hash_code(git_repo, 'catalogue_results', identity="branch")
 
     # path not a git repo
     workspace.run("rm -rf .git")
@@ -176,6 +735,93 @@ def test_hash_code(git_repo, git_hash, workspace):
         ct.hash_code(git_repo, 'catalogue_results')
 
 
+def _same_as_gitpython(state):
+    repo = git.Repo(state.repo.working_dir)
+    assert state.dirty == repo.is_dirty()
+    assert sorted(state.untracked) == sorted(repo.untracked_files)
+
+
+def test_repo_state(git_repo, git_hash, workspace):
+
+    state = ct.repo_state(git_repo)
+    assert (state.head, state.dirty, state.untracked) == (git_hash, False, [])
+    assert state.is_clean("catalogue_results")
+
+    workspace.run("mkdir -p catalogue_results new/dir")
+    workspace.run("touch catalogue_results/test.csv 'new/dir/with space.txt'")
+    state = ct.repo_state(git_repo)
+    _same_as_gitpython(state)
+    assert "new/dir/with space.txt" in state.untracked
+    assert not state.is_clean("catalogue_results")
+
+    # a staged rename is recorded with its original path
+    workspace.run("rm -rf new")
+    workspace.run("git mv data renamed")
+    state = ct.repo_state(git_repo)
+    _same_as_gitpython(state)
+    assert state.dirty and state.untracked == ["catalogue_results/test.csv"]
+    assert not state.is_clean("catalogue_results")
+
+
+def test_repo_state_no_commits(git_repo_no_commits):
+
+    state = ct.repo_state(git_repo_no_commits)
+    assert state.head is None
+    _same_as_gitpython(state)
+
+
+def test_repo_state_excludes(git_repo, workspace, tmpdir):
+
+    workspace.run("mkdir -p .venv/lib code")
+    workspace.run("touch .venv/lib/site.py code/run.py")
+    workspace.run("git add code")
+    git.Repo(git_repo).index.commit("Add code")
+    workspace.run("touch .venv/lib/more.py data/new.txt")
+    with open(os.path.join(git_repo, "data", "fixture1.json"), "a") as f:
+        f.write("changed")
+
+    state = ct.repo_state(git_repo)
+    assert state.dirty and len(state.untracked) == 3
+    state = ct.repo_state(git_repo, excludes=[os.path.join(git_repo, "data"), os.path.join(git_repo, ".venv"),
+                                              tmpdir.strpath])
+    assert not state.dirty and state.untracked == []
+
+    # only the code subdirectory is checked
+    assert ct.repo_state(os.path.join(git_repo, "code")).is_clean("catalogue_results")
+    workspace.run("touch code/new.py")
+    assert ct.repo_state(os.path.join(git_repo, "code")).untracked == ["code/new.py"]
+
+    # excludes containing the code are dropped
+    assert ct.status_pathspecs(git_repo, os.path.join(git_repo, "code"), [git_repo, tmpdir.strpath]) == [
+        ":(top)code"]
+
+
+def test_hash_code_tree(git_repo, workspace):
+
+    workspace.run("mkdir -p analysis docs")
+    workspace.run("touch analysis/run.py docs/notes.md")
+    repo = git.Repo(git_repo)
+    repo.index.add(["analysis/run.py", "docs/notes.md"])
+    repo.index.commit("Add analysis")
+    code = os.path.join(git_repo, "analysis")
+    tree = ct.hash_code(code, 'catalogue_results', identity="tree")
+    assert tree == "tree:" + (repo.head.commit.tree / "analysis").hexsha
+    assert ct.hash_code(git_repo, 'catalogue_results', identity="tree") == "tree:" + repo.head.commit.tree.hexsha
+
+    # a commit outside the code directory does not change its tree
+    with open(os.path.join(git_repo, "docs", "notes.md"), "w") as f:
+        f.write("notes")
+    repo.index.add(["docs/notes.md"])
+    repo.index.commit("Update notes")
+    assert ct.hash_code(code, 'catalogue_results', identity="tree") == tree
+
+    with open(os.path.join(code, "run.py"), "w") as f:
+        f.write("print('run')")
+    repo.index.add(["analysis/run.py"])
+    repo.index.commit("Update analysis")
+    assert ct.hash_code(code, 'catalogue_results', identity="tree") != tree
+
+
 def test_construct_dict(git_repo, git_hash, test_args):
 
     data_path = os.path.join(git_repo, "data")
@@ -194,6 +840,29 @@ def test_construct_dict(git_repo, git_hash, test_args):
         assert hash_dict["code"] == {git_repo: git_hash}
 
     assert "output_data" not in hash_dict_1.keys()
+    assert "input_tree" not in hash_dict_1.keys()
+
+    # merkle input mode also records the directory digests
+    setattr(test_args, "input_mode", "merkle")
+    hash_dict_3 = ct.construct_dict(timestamp, test_args)
+    tree = {}
+    assert hash_dict_3["input_data"] == {data_path: ct.hash_dir_tree(data_path, tree=tree)}
+    assert hash_dict_3["input_tree"] == {data_path: tree}
+    setattr(test_args, "input_mode", "full")
+
+    # input manifests, plain and compressed
+    manifest = {}
+    ct.hash_dir_full(data_path, manifest=manifest)
+    setattr(test_args, "input_manifest", "plain")
+    hash_dict_4 = ct.construct_dict(timestamp, test_args)
+    assert hash_dict_4["input_data"] == hash_dict_1["input_data"]
+    assert hash_dict_4["input_manifest"] == {data_path: manifest}
+    assert ct.record_options(hash_dict_4)["input_manifest"] == "plain"
+    setattr(test_args, "input_manifest", "compressed")
+    hash_dict_5 = ct.construct_dict(timestamp, test_args)
+    assert ct.unpack_manifest(hash_dict_5["input_manifest"][data_path]) == manifest
+    assert ct.record_options(hash_dict_5)["input_manifest"] == "compressed"
+    setattr(test_args, "input_manifest", "none")
 
     tmp_fixture1 = os.path.join(results_path, "fixture1.json")
     tmp_fixture2 = os.path.join(results_path, "fixture2.json")
@@ -311,6 +980,18 @@ def test_save_csv(tmpdir, fixture3, fixture4):
     with pytest.raises(AssertionError):
         ct.save_csv(hash_dict, timestamp, file.strpath)
 
+    # records made with ignore patterns cannot be stored
+    file = tmpdir.join('ignore.csv')
+    with pytest.raises(AssertionError):
+        ct.save_csv(dict(hash_dict, ignore={"input_data": ["*.log"]}), timestamp, file.strpath)
+    assert not file.exists()
+    # and so can records made with a fingerprint threshold, or following symlinks
+    with pytest.raises(AssertionError):
+        ct.save_csv(dict(hash_dict, fingerprint_threshold=1024), timestamp, file.strpath)
+    with pytest.raises(AssertionError):
+        ct.save_csv(dict(hash_dict, follow_symlinks=True), timestamp, file.strpath)
+    assert not file.exists()
+
 
 def test_load_csv(tmpdir, fixture3, fixture4):
 
@@ -327,6 +1008,109 @@ def test_load_csv(tmpdir, fixture3, fixture4):
         ct.load_csv("abc.csv", timestamp)
 
 
+def test_csv_algorithm(tmpdir, fixture3):
+
+    # a record made with another algorithm is saved and loaded with its labels
+    hash_dict = ct.load_hash(fixture3)
+    timestamp = hash_dict["timestamp"]["disengage"]
+    input_path = list(hash_dict["input_data"].keys())[0]
+    hash_dict["input_data"][input_path] = "blake2b:" + hashlib.blake2b().hexdigest()
+    output_path = list(hash_dict["output_data"].keys())[0]
+    for out_file in hash_dict["output_data"][output_path]:
+        hash_dict["output_data"][output_path][out_file] = "sha256:" + hashlib.sha256().hexdigest()
+
+    file = tmpdir.join('test.csv')
+    ct.save_csv(hash_dict, timestamp, file.strpath)
+    assert ct.load_csv(file.strpath, timestamp) == hash_dict
+    assert ct.record_algorithm(hash_dict) == "blake2b"
+
+
+def test_csv_index(tmpdir, fixture3, fixture4):
+
+    hash_dict = ct.load_hash(fixture3)
+    file = tmpdir.join('test.csv').strpath
+    index = ct.csv_index_path(file)
+    timestamps = ["20200430-17202{}".format(i) for i in range(3)]
+    records = []
+    for i, timestamp in enumerate(timestamps):
+        record = copy.deepcopy(hash_dict)
+        record["timestamp"]["disengage"] = timestamp
+        # a path with a line break spans several lines of the file
+        record["input_data"] = {"data\n{}".format(i): list(hash_dict["input_data"].values())[0]}
+        ct.save_csv(record, timestamp, file)
+        records.append(record)
+    assert len(open(index).readlines()) == 4
+    assert ct.load_csv_many(file, timestamps[::-1]) == records[::-1]
+
+    # rows appended without updating the index are indexed when loading
+    with open(fixture4) as f:
+        row = f.readlines()[1]
+    with open(file, "a") as f:
+        f.write(row)
+    assert ct.load_csv(file, "20200430-172025") == ct.load_csv(fixture4, "20200430-172025")
+    assert len(open(index).readlines()) == 5
+
+    # an index that does not match the file, or is torn, is rebuilt
+    with open(index, "w") as f:
+        f.write("id 0 5\n20200430-172020 7 100\n20200430-1720")
+    assert ct.load_csv(file, timestamps[1]) == records[1]
+    with open(index, "a") as f:
+        f.write("20200430-172029 0 10\n")
+    assert ct.load_csv(file, timestamps[2]) == records[2]
+    assert len(open(index).readlines()) == 5
+
+    # no index is made for a file that was not saved by save_csv
+    ct.load_csv(fixture4, "20200430-172025")
+    assert not os.path.exists(ct.csv_index_path(fixture4))
+
+
+def _save_records(hash_dict, file, worker):
+    """
+    Save 10 records one at a time and 10 in a batch, as one of several processes.
+    """
+    timestamps = ["202001{:02d}-{:06d}".format(worker, i) for i in range(20)]
+    for timestamp in timestamps[:10]:
+        ct.save_csv(dict(hash_dict, timestamp={"disengage": timestamp, "engage": timestamp}), timestamp, file)
+    ct.save_csv_many([(dict(hash_dict, timestamp={"disengage": timestamp, "engage": timestamp}), timestamp)
+                      for timestamp in timestamps[10:]], file)
+    return timestamps
+
+
+def test_save_csv_concurrent(tmpdir, fixture3):
+
+    hash_dict = ct.load_hash(fixture3)
+    file = tmpdir.join('test.csv').strpath
+    with ProcessPoolExecutor(8) as pool:
+        timestamps = sum(pool.map(_save_records, [hash_dict] * 16, [file] * 16, range(16)), [])
+
+    # one header, and every row whole
+    lines = open(file).read().splitlines()
+    assert lines[0].split(",") == ct.CSV_HEADERS
+    assert len(lines) == 1 + len(timestamps)
+    assert sorted(run_id for run_id, _ in ct.load_csv_records(file)) == sorted(timestamps)
+    assert [record["timestamp"]["disengage"] for record in ct.load_csv_many(file, timestamps)] == timestamps
+
+
+def test_save_csv_locked(tmpdir, fixture3):
+
+    hash_dict = ct.load_hash(fixture3)
+    file = tmpdir.join('test.csv').strpath
+    ct.save_csv(hash_dict, "20200430-172025", file)
+    # a lock held by another process
+    process = subprocess.Popen([sys.executable, "-c", "import fcntl, sys, time; f = open(sys.argv[1], 'a');"
+                                " fcntl.lockf(f, fcntl.LOCK_EX); print(flush=True); time.sleep(30)", file],
+                               stdout=subprocess.PIPE)
+    process.stdout.readline()
+    try:
+        with pytest.raises(TimeoutError):
+            ct.save_csv(hash_dict, "20200430-172026", file, timeout=0.2)
+    finally:
+        process.kill()
+        process.wait()
+    ct.save_csv(hash_dict, "20200430-172026", file)
+    assert len(open(file).readlines()) == 3
+
+
 @pytest.mark.parametrize(
     "timestamp,exp_error",
     [("abc", AssertionError), (1, AssertionError), ("20200430-120000", EOFError)]
@@ -0,0 +1,100 @@
+import os
+import json
+import pytest
+
+import catalogue.catalogue as ct
+from catalogue.cache import DigestCache
+from catalogue.checkpoint import Checkpoint
+
+
+OPTIONS = {"algorithm": "sha512", "fingerprint_threshold": 0, "chunk_threshold": 0, "archive_members": False}
+
+
+def _age(folder):
+    """
+    Make the files in folder old enough to be checkpointed.
+    """
+    past = 1000000000
+    for path in ct.modified_walk(folder):
+        os.utime(path, (past, past))
+
+
+def test_checkpoint(nested_dir, tmpdir):
+
+    _age(nested_dir)
+    journal = tmpdir.join("disengage.checkpoint").strpath
+    path = os.path.join(nested_dir, "top.txt")
+    result = (ct.file_digest(path), None, None)
+
+    checkpoint = Checkpoint(journal, OPTIONS, interval=3600)
+    assert checkpoint.lookup(path, os.stat(path)) is None
+    checkpoint.record(path, result)
+    # a file that was not looked up first has no stat data to check against
+    other = os.path.join(nested_dir, "a", "a1.txt")
+    checkpoint.record(other, result)
+    checkpoint.close()
+    assert len(open(journal).read().splitlines()) == 2
+
+    # a torn line at the end is left out, and the journal can be added to
+    with open(journal, "a") as f:
+        f.write('{"path": "')
+    checkpoint = Checkpoint(journal, OPTIONS)
+    assert checkpoint.lookup(path, os.stat(path)) == result
+    assert checkpoint.resumed == 1
+    checkpoint.close()
+    assert [json.loads(line) for line in open(journal).read().splitlines()[1:-1]]
+
+    # a changed file is hashed again
+    os.utime(path, (2000000000, 2000000000))
+    checkpoint = Checkpoint(journal, OPTIONS)
+    assert checkpoint.lookup(path, os.stat(path)) is None
+    checkpoint.close()
+
+    # a journal made with other options is started again
+    checkpoint = Checkpoint(journal, dict(OPTIONS, algorithm="sha256"))
+    assert open(journal).read().splitlines() == [json.dumps(dict(OPTIONS, algorithm="sha256"), sort_keys=True)]
+    checkpoint.discard()
+    assert not os.path.exists(journal)
+
+
+@pytest.mark.parametrize("kwargs", [{}, {"jobs": 2}, {"prefetch": 2}])
+def test_resume(nested_dir, tmpdir, monkeypatch, kwargs):
+
+    _age(nested_dir)
+    journal = tmpdir.join("disengage.checkpoint").strpath
+    expected = ct.hash_dir_by_file(nested_dir)
+
+    # interrupt hashing after two files
+    hashed = []
+    hash_open_file = ct._hash_open_file
+    def interrupted(f, m, head=b""):
+        if len(hashed) == 2:
+            raise KeyboardInterrupt
+        hashed.append(f.name)
+        return hash_open_file(f, m, head)
+    monkeypatch.setattr(ct, "_hash_open_file", interrupted)
+    checkpoint = Checkpoint(journal, OPTIONS, interval=0)
+    with pytest.raises(KeyboardInterrupt):
+        ct.hash_dir_by_file(nested_dir, checkpoint=checkpoint, **kwargs)
+    checkpoint.close()
+
+    # the files hashed before the interruption are not hashed again
+    monkeypatch.setattr(ct, "_hash_open_file", hash_open_file)
+    checkpoint = Checkpoint(journal, OPTIONS)
+    assert ct.hash_dir_by_file(nested_dir, checkpoint=checkpoint, **kwargs) == expected
+    assert checkpoint.resumed == 2
+    checkpoint.discard()
+
+
+def test_checkpoint_cache_hits(nested_dir, tmpdir):
+
+    _age(nested_dir)
+    cache = DigestCache(tmpdir.join("digests.sqlite").strpath)
+    expected = ct.hash_dir_by_file(nested_dir, cache=cache)
+
+    # files found in the digest cache are not kept waiting to be recorded
+    checkpoint = Checkpoint(tmpdir.join("disengage.checkpoint").strpath, OPTIONS)
+    assert ct.hash_dir_by_file(nested_dir, cache=cache, checkpoint=checkpoint) == expected
+    assert checkpoint._before == {}
+    checkpoint.discard()
+    cache.close()
@@ -1,9 +1,11 @@
 
+import os
 import pytest
 import argparse
 
 import catalogue.catalogue as ct
-from catalogue.compare import compare, compare_hashes
+from catalogue.compare import (compare, compare_hashes, compare_inputs, changed_dirs, verify_fingerprints,
+                               fingerprint_matches, changed_chunks, chunk_changes, compare_members)
 
 
 def test_compare_json(fixture1, fixture2, fixtures_dir, capsys, git_repo):
@@ -134,3 +136,229 @@ def test_compare_hashes(fixture1, fixture2):
     assert len(diff_output["matches"]) == 2
     assert len(diff_output['differs']) == 1
     assert len(diff_output["failures"]) == 2
+
+
+def test_compare_hashes_algorithms(fixture2):
+
+    # hashes made with different algorithms cannot be compared
+    dict1 = ct.load_hash(fixture2)
+    dict2 = ct.load_hash(fixture2)
+    input_path = list(dict2["input_data"].keys())[0]
+    dict2["input_data"][input_path] = "blake2b:" + dict2["input_data"][input_path][:128]
+    output_path = list(dict2["output_data"].keys())[0]
+    out_file = sorted(dict2["output_data"][output_path].keys())[0]
+    dict2["output_data"][output_path][out_file] = "sha256:" + dict2["output_data"][output_path][out_file][:64]
+
+    output = compare_hashes(dict1, dict2)
+    assert sorted(output["failures"]) == sorted(["input_data", out_file])
+    assert len(output["matches"]) == 3
+    assert len(output["differs"]) == 0
+
+
+def test_compare_hashes_ignore(fixture2):
+
+    # input data hashed with different ignore patterns cannot be compared
+    dict1 = ct.load_hash(fixture2)
+    dict2 = ct.load_hash(fixture2)
+    dict2["ignore"] = {"input_data": ["*.log"]}
+    output = compare_hashes(dict1, dict2)
+    assert output["failures"] == ["input_data"]
+
+    dict1["ignore"] = {"input_data": ["*.log"], "output_data": ["tmp/"]}
+    output = compare_hashes(dict1, dict2)
+    assert output["failures"] == []
+    assert "input_data" in output["matches"]
+
+
+def test_compare_hashes_code_tree(fixture2):
+
+    # code identified by its tree matches even if the commits differ
+    dict1 = ct.load_hash(fixture2)
+    dict2 = ct.load_hash(fixture2)
+    code_path = list(dict1["code"].keys())[0]
+    dict1["code"] = {code_path: "tree:0"}
+    dict2["code"] = {code_path: "tree:0"}
+    dict1["code_commit"] = {code_path: "1"}
+    dict2["code_commit"] = {code_path: "2"}
+    assert "code" in compare_hashes(dict1, dict2)["matches"]
+
+    dict2["code"] = {code_path: "tree:1"}
+    assert "code" in compare_hashes(dict1, dict2)["differs"]
+
+    # a tree and a commit cannot be compared
+    dict2 = ct.load_hash(fixture2)
+    assert "code" in compare_hashes(dict1, dict2)["failures"]
+
+
+def test_verify_fingerprints(tmpdir):
+
+    path = tmpdir.join("big.dat")
+    path.write_binary(os.urandom(1000))
+    full = ct.hash_file(path.strpath).hexdigest()
+    fingerprint = "fp-sha512:" + ct.fingerprint_file(path.strpath).hexdigest()
+    record = lambda digest: {"timestamp": {"engage": "TIMESTAMP"}, "input_data": {"data": "abc"},
+                             "code": {"code": "abc"}, "output_data": {tmpdir.strpath: {path.strpath: digest}}}
+
+    # a fingerprint and a full hash can only be compared through the file
+    output = compare_hashes(record(full), record(fingerprint))
+    assert output["failures"] == [path.strpath]
+    verify_fingerprints(record(full), record(fingerprint), output)
+    assert output["failures"] == [] and path.strpath in output["matches"]
+
+    # files larger than the threshold are not hashed in full
+    output = compare_hashes(record(full), record(fingerprint))
+    verify_fingerprints(record(full), record(fingerprint), output, threshold=999)
+    assert output["failures"] == [path.strpath]
+    verify_fingerprints(record(full), record(fingerprint), output, threshold=1000)
+    assert output["failures"] == [] and path.strpath in output["matches"]
+
+    output = compare_hashes(record(fingerprint), record("0" * 128))
+    verify_fingerprints(record(fingerprint), record("0" * 128), output)
+    assert output["failures"] == [] and path.strpath in output["differs"]
+
+    # matches of two fingerprints are pointed out
+    assert fingerprint_matches(record(fingerprint), record(fingerprint), [path.strpath, "code"]) == [path.strpath]
+    assert fingerprint_matches(record(full), record(full), [path.strpath, "code"]) == []
+
+    # nothing can be said once the file has changed from both
+    path.write_binary(b"new")
+    output = compare_hashes(record(full), record(fingerprint))
+    verify_fingerprints(record(full), record(fingerprint), output)
+    assert output["failures"] == [path.strpath]
+
+
+def test_changed_chunks():
+
+    chunks = [(100, bytes([i]) * 16) for i in range(10)]
+    table_1 = ct.pack_chunks(chunks)
+
+    # a changed chunk and an inserted chunk, next to each other, after a moved one
+    changed = chunks[:3] + [(150, b"x" * 16), (100, b"y" * 16)] + chunks[4:]
+    assert changed_chunks(table_1, ct.pack_chunks(changed)) == (2, 11, [(300, 549)])
+    assert changed_chunks(table_1, ct.pack_chunks(chunks[:1] + chunks[2:])) == (0, 9, [])
+
+    record = lambda table, digest: {"input_data": {"data": digest}, "output_data": {"out": {"out/a": "0"}},
+                                    "chunks": {"data": table}}
+    lines = chunk_changes(record(table_1, "1"), record(ct.pack_chunks(changed), "2"), ["input_data", "out/a"])
+    assert lines == ["data: 2 of 11 chunks changed, bytes 300-549"]
+    lines = chunk_changes(record(table_1, "1"), record(ct.pack_chunks(chunks[1:]), "2"), ["input_data"])
+    assert lines == ["data: no new chunks, data was only removed"]
+
+
+def test_compare_members():
+
+    record = lambda digest, files: {"timestamp": {"engage": "1"}, "code": {"code": "0"},
+                                    "input_data": {"data.zip": digest}, "output_data": {"out": {"out.tar": digest}},
+                                    "members": {"data.zip": files, "out.tar": files}}
+    record_1 = record("1", {"a": "1", "b/c": "1", "d": "1"})
+    record_2 = record("2", {"a": "1", "b/c": "2", "e": "1"})
+    assert compare_members(record_1, record_2, "out.tar") == (["out.tar::b/c"], ["out.tar::d", "out.tar::e"])
+    assert compare_members(record_1, {}, "out.tar") == ([], [])
+
+    comparison = compare_hashes(record_1, record_2)
+    assert sorted(comparison["differs"]) == ["data.zip::b/c", "input_data", "out.tar", "out.tar::b/c"]
+    assert sorted(comparison["failures"]) == ["data.zip::d", "data.zip::e", "out.tar::d", "out.tar::e"]
+
+
+def test_compare_rehash_algorithm(fixtures_dir, git_repo, tmpdir, capsys):
+    """
+    Comparing a record against the current state hashes with the algorithm of the record.
+    """
+    args = argparse.Namespace(
+        command = "compare",
+        input_data = fixtures_dir,
+        output_data = fixtures_dir,
+        catalogue_results = "catalogue_results",
+        code = git_repo,
+        csv = None,
+        algorithm = "sha512"
+    )
+    setattr(args, "algorithm", "blake2b")
+    record = ct.construct_dict("TIMESTAMP", args)
+    assert ct.record_algorithm(record) == "blake2b"
+
+    # the current state is hashed with blake2b, not sha256, so all hashes can be compared
+    setattr(args, "algorithm", "sha256")
+    hash_file = os.path.join(tmpdir, "record.json")
+    ct.store_hash(record, "record", tmpdir.strpath)
+    setattr(args, "hashes", [hash_file])
+    compare(args)
+    captured = capsys.readouterr()
+    assert "could not be compared in 0 places" in captured.out
+    assert "differ in 1 places" in captured.out
+
+
+def test_changed_dirs():
+
+    tree_1 = {".": "r1", "a": "a1", "a/deep": "d1", "b": "b1", "c": "c1", "c/x": "x1"}
+
+    assert changed_dirs(tree_1, tree_1) == []
+
+    # change deep in the tree is reported at the deepest changed directory
+    tree_2 = dict(tree_1, **{".": "r2", "a": "a2", "a/deep": "d2"})
+    assert changed_dirs(tree_1, tree_2) == ["a/deep"]
+
+    # change in a directory's own files
+    tree_2 = dict(tree_1, **{".": "r2", "b": "b2"})
+    assert changed_dirs(tree_1, tree_2) == ["b"]
+    tree_2 = dict(tree_1, **{".": "r2"})
+    assert changed_dirs(tree_1, tree_2) == ["."]
+
+    # directories only in one tree are reported without descending into them
+    tree_2 = {k: v for k, v in tree_1.items() if not k.startswith("c")}
+    tree_2.update({".": "r2", "e": "e1", "e/f": "f1"})
+    assert changed_dirs(tree_1, tree_2) == ["c", "e"]
+
+
+def test_compare_hashes_merkle(nested_dir, fixture2):
+
+    def record():
+        tree = {}
+        return {
+            "timestamp": {"engage": "TIMESTAMP"},
+            "input_data": {nested_dir: ct.hash_dir_tree(nested_dir, tree=tree)},
+            "input_tree": {nested_dir: tree},
+            "code": {"code": "abc"}
+        }
+
+    dict1 = record()
+    with open(os.path.join(nested_dir, "a", "deep", "deep1.txt"), "a") as f:
+        f.write("changed")
+    dict2 = record()
+
+    output = compare_hashes(dict1, dict2)
+    assert output["differs"] == ["input_data", os.path.join(nested_dir, "a", "deep")]
+    assert output["matches"] == ["timestamp", "code"]
+
+    # full and merkle digests of the input cannot be compared
+    dict2["input_data"][nested_dir] = ct.hash_dir_full(nested_dir)
+    output = compare_hashes(dict1, dict2)
+    assert output["failures"] == ["input_data", "output_data"]
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_compare_hashes_manifest(nested_dir, compress):
+
+    def record():
+        manifest = {}
+        return {
+            "timestamp": {"engage": "TIMESTAMP"},
+            "input_data": {nested_dir: ct.hash_dir_full(nested_dir, manifest=manifest)},
+            "input_manifest": {nested_dir: ct.pack_manifest(manifest, compress)},
+            "code": {"code": "abc"}
+        }
+
+    dict1 = record()
+    with open(os.path.join(nested_dir, "a", "deep", "deep1.txt"), "a") as f:
+        f.write("changed")
+    os.remove(os.path.join(nested_dir, "b", "b2.txt"))
+    dict2 = record()
+
+    output = compare_hashes(dict1, dict2)
+    assert output["differs"] == ["input_data", os.path.join(nested_dir, "a", "deep", "deep1.txt")]
+    assert output["failures"] == [os.path.join(nested_dir, "b", "b2.txt"), "output_data"]
+
+    # without manifests on both sides only input_data is reported
+    del dict2["input_manifest"]
+    assert compare_inputs(dict1, dict2) == ([], [])
+    assert compare_hashes(dict1, dict2)["differs"] == ["input_data"]
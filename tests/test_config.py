@@ -79,3 +79,41 @@ def test_config_validator(tmpdir, capsys, good_config, bad_config1, bad_config2)
     captured = capsys.readouterr()
     assert 'Config error: invalid keys present in the yaml file' in captured.out
     assert 'Config error: config files are not all strings'in captured.out
+
+@pytest.mark.parametrize("jobs,valid", [(4, True), (0, False), ("4", False), (True, False)])
+def test_config_validator_jobs(tmpdir, capsys, jobs, valid):
+
+    config_file = os.path.join(tmpdir, 'catalogue_config.yaml')
+    with open(config_file, 'w') as yaml_file:
+        yaml.dump({'code': 'code', 'jobs': jobs}, yaml_file)
+
+    assert config_validator(config_file) == valid
+    if not valid:
+        captured = capsys.readouterr()
+        assert 'Config error: jobs must be a positive integer' in captured.out
+
+
+@pytest.mark.parametrize("prefetch,valid", [(0, True), (8, True), (-1, False), (False, False)])
+def test_config_validator_prefetch(tmpdir, capsys, prefetch, valid):
+
+    config_file = os.path.join(tmpdir, 'catalogue_config.yaml')
+    with open(config_file, 'w') as yaml_file:
+        yaml.dump({'code': 'code', 'prefetch': prefetch}, yaml_file)
+
+    assert config_validator(config_file) == valid
+    if not valid:
+        captured = capsys.readouterr()
+        assert 'Config error: prefetch must be a non-negative integer' in captured.out
+
+
+@pytest.mark.parametrize("ignore,valid", [(["*.log", "tmp/"], True), ([], True), ("*.log", False), ([1], False)])
+def test_config_validator_ignore(tmpdir, capsys, ignore, valid):
+
+    config_file = os.path.join(tmpdir, 'catalogue_config.yaml')
+    with open(config_file, 'w') as yaml_file:
+        yaml.dump({'code': 'code', 'ignore': ignore}, yaml_file)
+
+    assert config_validator(config_file) == valid
+    if not valid:
+        captured = capsys.readouterr()
+        assert 'Config error: ignore must be a list of patterns' in captured.out
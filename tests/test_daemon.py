@@ -0,0 +1,149 @@
+import os
+import sys
+import glob
+import json
+import signal
+import time
+import socket
+import argparse
+import subprocess
+import pytest
+
+import catalogue.catalogue as ct
+from catalogue import cache as cc
+from catalogue import daemon as dm
+
+
+@pytest.fixture
+def running_daemon():
+    """
+    Run a daemon for "catalogue_results" in CWD, in another process.
+    """
+    process = subprocess.Popen([sys.executable, "-m", "catalogue.parser", "daemon"],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    path = dm.socket_path("catalogue_results")
+    deadline = time.monotonic() + 30
+    while not os.path.exists(path) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    yield process
+    if process.poll() is None:
+        process.terminate()
+    process.wait(10)
+
+
+def test_forward_not_running(tmpdir):
+
+    args = argparse.Namespace(command="compare", catalogue_results=tmpdir.strpath)
+    assert not dm.forward(args)
+
+    # a socket left by a daemon that did not stop cleanly
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(dm.socket_path(tmpdir.strpath))
+    sock.close()
+    assert not dm.forward(args)
+    assert not dm.stop_daemon(tmpdir.strpath)
+
+
+def test_daemon(git_repo, test_args, running_daemon, monkeypatch, capsys):
+    """
+    NOTE: the catalogue_results directory and files are created in CWD
+    """
+    # output and questions are passed back from the daemon
+    open(os.path.join(git_repo, "untracked.txt"), "w").close()
+    monkeypatch.setattr("builtins.input", lambda prompt="": "n")
+    assert dm.forward(test_args)
+    assert "uncommitted changes" in capsys.readouterr().out
+    assert not os.path.exists(os.path.join("catalogue_results", ".lock"))
+    os.remove(os.path.join(git_repo, "untracked.txt"))
+
+    assert dm.forward(test_args)
+    assert "'catalogue engage' succeeded" in capsys.readouterr().out
+    assert os.path.exists(os.path.join("catalogue_results", ".lock"))
+
+    setattr(test_args, "command", "disengage")
+    setattr(test_args, "output_data", os.path.join(git_repo, "results"))
+    assert dm.forward(test_args)
+    assert "hashes match" in capsys.readouterr().out
+    output_file = glob.glob("catalogue_results/*.json")
+    assert len(output_file) == 1
+
+    # errors are reported by the client
+    setattr(test_args, "output_data", "missing")
+    with pytest.raises(SystemExit) as error:
+        dm.forward(test_args)
+    assert error.value.code == 1
+    assert "AssertionError" in capsys.readouterr().err
+
+    assert dm.stop_daemon("catalogue_results")
+    assert running_daemon.wait(10) == 0
+    assert not dm.forward(test_args)
+
+    # clean up: delete files created in CWD
+    os.remove(output_file[0])
+    os.rmdir("catalogue_results")
+
+
+def test_kept_open(git_repo, tmpdir, monkeypatch):
+
+    monkeypatch.setattr(ct, "_open_repos", {})
+    monkeypatch.setattr(ct, "_pools", {})
+    monkeypatch.setattr(cc, "_open_caches", {})
+
+    repo = ct.open_repo(git_repo)
+    assert ct.open_repo(git_repo) is repo
+    assert list(ct._ordered_map(str, range(5), 2, 3)) == ["0", "1", "2", "3", "4"]
+    pool = ct._pools[2]
+    assert list(ct._ordered_map(str, range(5), 2, 3)) == ["0", "1", "2", "3", "4"]
+    assert ct._pools == {2: pool}
+
+    args = argparse.Namespace(cache=True, catalogue_results=tmpdir.strpath)
+    cache = cc.open_cache(args)
+    cache.misses = 1
+    cache.close()
+    assert cc.open_cache(args) is cache
+    assert cache.misses == 0
+
+    # a deleted cache is opened again
+    cache.close()
+    os.remove(cache.path)
+    assert cc.open_cache(args) is not cache
+    cc._open_caches[cache.path].keep_open = False
+    cc._open_caches[cache.path].close()
+    pool.shutdown()
+    repo.close()
+
+
+def test_stopped_during_command(tmpdir, monkeypatch):
+
+    def command(args):
+        print("started")
+        dm._stop(None, None)
+        print("not reached")
+
+    monkeypatch.setitem(dm.COMMANDS, "compare", command)
+    client, server = socket.socketpair()
+    with client, server, client.makefile("rw", encoding="utf-8") as f_client, \
+            server.makefile("rw", encoding="utf-8") as f_server:
+        dm._send(f_client, {"args": {"command": "compare"}, "cwd": tmpdir.strpath,
+                            "tty": {"out": False, "err": False}})
+        # the client is told the command did not finish before the daemon stops
+        with pytest.raises(dm.DaemonStopped):
+            dm._handle(f_server, os.getcwd())
+        server.shutdown(socket.SHUT_WR)
+        messages = [json.loads(line) for line in f_client.readlines()]
+        assert "".join(message.get("out", "") for message in messages) == "started\n"
+        message = messages[-1]
+        assert message["exit"] == 128 + signal.SIGTERM
+        assert "stopped before compare finished" in message["error"]
+
+
+def test_sigterm(running_daemon):
+    """
+    NOTE: the catalogue_results directory is created in CWD
+    """
+    running_daemon.send_signal(signal.SIGTERM)
+    assert running_daemon.wait(10) == 0
+    assert not os.path.exists(dm.socket_path("catalogue_results"))
+
+    # clean up: delete the directory created in CWD
+    os.rmdir("catalogue_results")
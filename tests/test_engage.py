@@ -6,6 +6,7 @@ import glob
 import pytest
 
 from git import InvalidGitRepositoryError
+import catalogue.catalogue as ct
 from catalogue.engage import engage, disengage, git_query
 
 def test_git_query(git_repo, capsys, workspace, monkeypatch):
@@ -170,6 +171,31 @@ def test_csv_with_ext(git_repo, test_args, capsys):
     output_file = glob.glob("catalogue_results/*.csv")
     print(output_file)
     assert len(output_file) == 1
+    assert os.path.exists(output_file[0] + ".index")
+
+    # clean up: delete files created in CWD
+    os.remove(output_file[0])
+    os.remove(output_file[0] + ".index")
+    os.rmdir("catalogue_results")
+
+def test_csv_with_ignore(git_repo, test_args):
+    setattr(test_args, "csv", "catalogue_res.csv")
+    setattr(test_args, "ignore", ["*.csv"])
+
+    engage(test_args)
+    setattr(test_args, "output_data", os.path.join(git_repo, "results"))
+    setattr(test_args, 'command', 'disengage')
+    # the patterns could not be stored in the CSV file
+    with pytest.raises(AssertionError):
+        disengage(test_args)
+    assert glob.glob("catalogue_results/*.csv") == []
+
+    # still engaged, so the run can be disengaged to a JSON record
+    setattr(test_args, "csv", None)
+    disengage(test_args)
+    output_file = glob.glob("catalogue_results/*.json")
+    assert len(output_file) == 1
+    assert ct.load_hash(output_file[0])["ignore"] == {"input_data": ["*.csv"], "output_data": ["*.csv"]}
 
     # clean up: delete files created in CWD
     os.remove(output_file[0])
@@ -192,3 +218,60 @@ def test_csv_without_ext(git_repo, test_args, capsys):
     # clean up: delete files created in CWD
     os.remove(output_filejson[0])
     os.rmdir("catalogue_results")
+
+def test_disengage_interrupted(git_repo, test_args, monkeypatch):
+    """
+    NOTE: the catalogue_results directory and files are created in CWD
+    """
+    import catalogue.catalogue as ct
+
+    engage(test_args)
+    lock_file = os.path.join("catalogue_results", ".lock")
+    setattr(test_args, "command", "disengage")
+    setattr(test_args, "output_data", os.path.join(git_repo, "results"))
+    setattr(test_args, "checkpoint_interval", 60)
+
+    # the lock is kept, and the files hashed so far checkpointed, until the
+    # record is saved
+    hash_output = ct.hash_output
+    def interrupted(*args, **kwargs):
+        raise KeyboardInterrupt
+    monkeypatch.setattr(ct, "hash_output", interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        disengage(test_args)
+    assert os.path.exists(lock_file)
+    assert os.path.exists(os.path.join("catalogue_results", "disengage.checkpoint"))
+
+    monkeypatch.setattr(ct, "hash_output", hash_output)
+    disengage(test_args)
+    assert not os.path.exists(lock_file)
+    assert not os.path.exists(os.path.join("catalogue_results", "disengage.checkpoint"))
+    output_file = glob.glob("catalogue_results/*.json")
+    assert len(output_file) == 1
+
+    # clean up: delete files created in CWD
+    os.remove(output_file[0])
+    os.rmdir("catalogue_results")
+
+
+def test_csv_with_follow_symlinks(git_repo, test_args):
+    setattr(test_args, "csv", "catalogue_res.csv")
+    setattr(test_args, "follow_symlinks", True)
+
+    engage(test_args)
+    setattr(test_args, "output_data", os.path.join(git_repo, "results"))
+    setattr(test_args, 'command', 'disengage')
+    # reloaded from the CSV file, the record would be compared without following symlinks
+    with pytest.raises(AssertionError):
+        disengage(test_args)
+    assert glob.glob("catalogue_results/*.csv") == []
+
+    setattr(test_args, "csv", None)
+    disengage(test_args)
+    output_file = glob.glob("catalogue_results/*.json")
+    assert len(output_file) == 1
+    assert ct.load_hash(output_file[0])["follow_symlinks"]
+
+    # clean up: delete files created in CWD
+    os.remove(output_file[0])
+    os.rmdir("catalogue_results")
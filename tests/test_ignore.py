@@ -0,0 +1,87 @@
+import os
+import pytest
+
+import catalogue.catalogue as ct
+from catalogue.ignore import IgnoreMatcher, read_ignore_file, active_patterns, IGNORE_FILE
+
+
+@pytest.mark.parametrize("patterns,path,is_dir,ignored", [
+    (["*.log"], "run.log", False, True),
+    (["*.log"], "a/deep/run.log", False, True),
+    (["*.log"], "run.log.gz", False, False),
+    (["tmp/"], "a/tmp", True, True),
+    (["tmp/"], "a/tmp", False, False),
+    (["/top.txt"], "top.txt", False, True),
+    (["/top.txt"], "a/top.txt", False, False),
+    (["a/*.txt"], "a/a1.txt", False, True),
+    (["a/*.txt"], "a/deep/deep1.txt", False, False),
+    (["a/**/*.txt"], "a/deep/deep1.txt", False, True),
+    (["a/**/*.txt"], "a/a1.txt", False, True),
+    (["**/deep"], "a/deep", True, True),
+    (["a/**"], "a/deep/deep1.txt", False, True),
+    (["b?.txt"], "b/b1.txt", False, True),
+    (["b[12].txt"], "b/b2.txt", False, True),
+    (["b[!12].txt"], "b/b2.txt", False, False),
+    (["*.txt", "!b1.txt"], "b/b1.txt", False, False),
+    (["*.txt", "!b1.txt", "b/*"], "b/b1.txt", False, True),
+    (["\\!important"], "!important", False, True),
+    ([], "top.txt", False, False),
+])
+def test_match(patterns, path, is_dir, ignored):
+    assert IgnoreMatcher(patterns).match(path, is_dir=is_dir) == ignored
+
+
+def test_read_ignore_file(tmpdir):
+
+    assert read_ignore_file(tmpdir.strpath) == []
+    tmpdir.join(IGNORE_FILE).write("# scratch files\n*.log\n\ntmp/  \nspace\\ \n")
+    assert read_ignore_file(tmpdir.strpath) == ["*.log", "tmp/", "space\\ "]
+    assert active_patterns(tmpdir.strpath, ["*.ckpt"]) == ["*.log", "tmp/", "space\\ ", "*.ckpt"]
+    assert active_patterns(tmpdir.join(IGNORE_FILE).strpath, ["*.ckpt"]) == ["*.ckpt"]
+
+
+def test_modified_walk_ignore(nested_dir, monkeypatch):
+
+    matcher = IgnoreMatcher(["deep/", "/top.txt", "b2.txt"])
+    listed = []
+    scandir = os.scandir
+    def spy(path):
+        listed.append(os.path.relpath(path, nested_dir))
+        return scandir(path)
+    with monkeypatch.context() as m:
+        m.setattr(os, "scandir", spy)
+        paths = list(ct.modified_walk(nested_dir, ignore=matcher))
+    assert paths == [os.path.join(nested_dir, "a", "a1.txt"), os.path.join(nested_dir, "b", "b1.txt")]
+    assert os.path.join("a", "deep") not in listed
+
+    # the same patterns apply to every way of hashing a directory
+    manifest = {}
+    ct.hash_dir_full(nested_dir, manifest=manifest, ignore=matcher)
+    assert sorted(manifest) == ["a/a1.txt", "b/b1.txt"]
+    assert list(ct.hash_dir_by_file(nested_dir, ignore=matcher)) == paths
+    tree = {}
+    ct.hash_dir_tree(nested_dir, tree=tree, ignore=matcher)
+    assert sorted(tree) == [".", "a", "b"]
+
+
+def test_construct_dict_ignore(nested_dir, test_args):
+
+    expected = ct.hash_input(nested_dir)
+    setattr(test_args, "input_data", nested_dir)
+    hash_dict = ct.construct_dict("TIMESTAMP", test_args)
+    assert hash_dict["input_data"] == {nested_dir: expected}
+    assert "ignore" not in hash_dict
+
+    # patterns from .catalogueignore and the config are applied and recorded
+    with open(os.path.join(nested_dir, IGNORE_FILE), "w") as f:
+        f.write("a/\n")
+    setattr(test_args, "ignore", ["b2.txt"])
+    hash_dict = ct.construct_dict("TIMESTAMP", test_args)
+    assert hash_dict["input_data"] == {nested_dir: ct.hash_input(nested_dir, ignore=IgnoreMatcher(["a/", "b2.txt"]))}
+    assert hash_dict["input_data"] != {nested_dir: expected}
+    assert hash_dict["ignore"] == {"input_data": ["a/", "b2.txt"]}
+
+    # re-hashing a record uses the recorded patterns
+    os.remove(os.path.join(nested_dir, IGNORE_FILE))
+    vars(test_args).update(ct.record_options(hash_dict))
+    assert ct.construct_dict("TIMESTAMP", test_args)["input_data"] == hash_dict["input_data"]
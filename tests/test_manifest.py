@@ -0,0 +1,89 @@
+import os
+import json
+import copy
+import pytest
+
+import catalogue.catalogue as ct
+from catalogue.compare import compare_hashes
+from catalogue.manifest import ManifestWriter, read_manifest, merge_manifests
+
+
+def test_manifest(tmpdir):
+
+    path = tmpdir.join("out.manifest.jsonl").strpath
+    writer = ManifestWriter(path)
+    writer.add("a/1.txt", "sha512:1")
+    writer.add("a/2.txt", "sha512:2")
+    with pytest.raises(AssertionError):
+        writer.add("a/1.txt", "sha512:1")
+    # nothing is visible until the manifest is finished
+    assert not os.path.exists(path)
+    writer.close()
+    assert writer.files == 2
+    assert list(read_manifest(path)) == [("a/1.txt", "sha512:1"), ("a/2.txt", "sha512:2")]
+
+    writer = ManifestWriter(path)
+    writer.discard()
+    assert os.listdir(tmpdir.strpath) == []
+
+
+def test_merge_manifests():
+
+    items_1 = [("a", "1"), ("b", "2"), ("d", "4")]
+    items_2 = [("b", "2"), ("c", "3"), ("d", "5")]
+    assert list(merge_manifests(items_1, items_2)) == [
+        ("a", "1", None), ("b", "2", "2"), ("c", None, "3"), ("d", "4", "5")]
+    assert list(merge_manifests([], items_2)) == [(path, None, digest) for path, digest in items_2]
+
+
+@pytest.mark.parametrize("kwargs", [{}, {"jobs": 2}, {"batch_size": 2}])
+def test_hash_dir_to_manifest(nested_dir, tmpdir, kwargs):
+
+    path = tmpdir.join("out.manifest.jsonl").strpath
+    writer = ManifestWriter(path)
+    assert ct.hash_dir_to_manifest(nested_dir, writer, **kwargs) == 5
+    writer.close()
+    assert dict(read_manifest(path)) == ct.hash_dir_by_file(nested_dir)
+
+
+def test_compare_streamed(nested_dir, tmpdir):
+
+    record = {
+        "timestamp": {"disengage": "200204-114329"},
+        "input_data": {"data": "sha512:0"},
+        "code": {"code": "0"},
+        "output_data": {nested_dir: ct.hash_dir_by_file(nested_dir)}
+    }
+    writer = ManifestWriter(os.path.join(tmpdir.strpath, "records", "out.manifest.jsonl"))
+    streamed = copy.deepcopy(record)
+    streamed["timestamp"]["disengage"] = "200204-120000"
+    streamed["output_data"][nested_dir] = ct.hash_output(nested_dir, manifest_writer=writer)
+    writer.close()
+    streamed["output_manifest"] = {nested_dir: {"file": writer.path, "files": writer.files}}
+    assert streamed["output_data"][nested_dir] == {}
+
+    # the manifest is stored relative to the record, and found again when it is loaded
+    ct.store_hash(streamed, "200204-114329", os.path.join(tmpdir.strpath, "records"))
+    record_path = os.path.join(tmpdir.strpath, "records", "200204-114329.json")
+    assert json.load(open(record_path))["output_manifest"][nested_dir]["file"] == "out.manifest.jsonl"
+    assert ct.load_hash(record_path) == streamed
+    assert ct.record_options(streamed)["stream_outputs"]
+
+    comparison = compare_hashes(record, streamed)
+    assert comparison["matches"] == ["input_data", "code", "5 files in {}".format(nested_dir)]
+    assert comparison["differs"] == ["timestamp"]
+
+    changed = os.path.join(nested_dir, "a", "a1.txt")
+    record["output_data"][nested_dir][changed] = "sha512:1"
+    record["output_data"][nested_dir][os.path.join(nested_dir, "extra.txt")] = "sha512:2"
+    comparison = compare_hashes(streamed, record)
+    assert comparison["matches"][-1] == "4 files in {}".format(nested_dir)
+    assert comparison["differs"] == ["timestamp", changed]
+    assert comparison["failures"] == [os.path.join(nested_dir, "extra.txt")]
+
+    # an output directory only in one record is summarised
+    del record["output_data"]
+    assert compare_hashes(streamed, record)["failures"] == ["5 files in {}".format(nested_dir)]
+
+    ct.remove_manifests(streamed)
+    assert not os.path.exists(writer.path)
@@ -0,0 +1,132 @@
+import io
+import os
+import pytest
+
+import catalogue.catalogue as ct
+from catalogue import progress as pg
+from catalogue.progress import Progress, scan_size, format_bytes, format_duration
+
+
+def test_format():
+
+    assert format_bytes(999) == "999 B"
+    assert format_bytes(1500) == "1.5 kB"
+    assert format_bytes(2.5e9) == "2.5 GB"
+    assert format_bytes(3e15) == "3000.0 TB"
+    assert format_duration(3.4) == "3s"
+    assert format_duration(125) == "2m05s"
+    assert format_duration(3723) == "1h02m03s"
+
+
+def test_scan_size(nested_dir):
+
+    assert scan_size(nested_dir, ct.modified_walk) == (5, len("top" + "a1" + "deep1" + "b1" + "b2"))
+    assert scan_size(os.path.join(nested_dir, "top.txt"), ct.modified_walk) == (1, 3)
+
+
+def test_progress(monkeypatch):
+
+    stream = io.StringIO()
+    progress = Progress(stream, tty=False)
+    progress.expect(10, 10000)
+    monkeypatch.setattr(progress, "elapsed", lambda: 2.0)
+    for i in range(7):
+        progress.add("file{}".format(i), 1000, 0.1 * (i + 1))
+    progress.skip("cached", 1000)
+    assert progress.line() == "hashed 8 of 10 files, 8.0 kB of 10.0 kB (80%), 4.0 kB/s, ETA 0s"
+
+    # the log is only written to every LOG_INTERVAL seconds
+    assert stream.getvalue() == ""
+
+    stats = progress.stats()
+    assert (stats["files"], stats["bytes"], stats["hashed_bytes"]) == (8, 8000, 7000)
+    assert stats["mb_per_s"] == pytest.approx(7000 / 2.8 / 1e6, abs=1e-3)
+    assert list(stats["slowest"]) == ["file6", "file5", "file4", "file3", "file2"]
+    summary = progress.summary()
+    assert summary.startswith("hashed 8 files, 8.0 kB (7.0 kB read) in 2s")
+    assert "  file6 (0.700s)" in summary
+
+
+def test_progress_display(monkeypatch):
+
+    monkeypatch.setattr(pg, "TTY_INTERVAL", 0)
+    monkeypatch.setattr(pg, "LOG_INTERVAL", 0)
+
+    # a terminal has one line redrawn in place, cleared at the end
+    stream = io.StringIO()
+    progress = Progress(stream, tty=True)
+    progress.add("a", 100, 0.1)
+    progress.add("b", 100, 0.1)
+    progress.close()
+    assert stream.getvalue().count("\r") == 4 and "\n" not in stream.getvalue()
+    assert stream.getvalue().startswith("\rhashed 1 files, 100 B, ")
+
+    # a log gets whole lines
+    stream = io.StringIO()
+    progress = Progress(stream, tty=False)
+    progress.add("a", 100, 0.1)
+    progress.add("b", 100, 0.1)
+    progress.close()
+    assert stream.getvalue().count("\n") == 2 and "\r" not in stream.getvalue()
+
+
+def test_progress_hashing(nested_dir, tmpdir):
+    from catalogue.cache import DigestCache
+
+    # every file is reported, whichever way it is hashed
+    for kwargs in [{}, {"jobs": 2}, {"prefetch": 2}]:
+        progress = Progress(None)
+        ct.hash_dir_by_file(nested_dir, progress=progress, **kwargs)
+        assert (progress.files, progress.bytes) == scan_size(nested_dir, ct.modified_walk)
+    for kwargs in [{}, {"prefetch": 2}]:
+        progress = Progress(None)
+        ct.hash_dir_full(nested_dir, progress=progress, **kwargs)
+        assert (progress.files, progress.bytes) == scan_size(nested_dir, ct.modified_walk)
+
+    # files found in the digest cache are counted, but not as hashed
+    past = 1000000000
+    for path in ct.modified_walk(nested_dir):
+        os.utime(path, (past, past))
+    with DigestCache(tmpdir.join("cache.sqlite").strpath) as cache:
+        ct.hash_dir_tree(nested_dir, cache=cache)
+        progress = Progress(None)
+        ct.hash_dir_tree(nested_dir, cache=cache, progress=progress)
+        assert (progress.files, progress.hashed_bytes) == (5, 0)
+
+
+def test_construct_dict_stats(nested_dir, test_args, capsys):
+
+    setattr(test_args, "input_data", nested_dir)
+    hash_dict = ct.construct_dict("TIMESTAMP", test_args)
+    assert "hashing_stats" not in hash_dict
+
+    setattr(test_args, "progress", True)
+    setattr(test_args, "record_stats", True)
+    hash_dict = ct.construct_dict("TIMESTAMP", test_args)
+    assert hash_dict["hashing_stats"]["files"] == 5
+    assert len(hash_dict["hashing_stats"]["slowest"]) == pg.SLOWEST
+    assert "hashed 5 files" in capsys.readouterr().out
+
+
+@pytest.mark.parametrize("mmap_threshold", [0, 2**40])
+def test_progress_within_file(tmpdir, monkeypatch, mmap_threshold):
+
+    monkeypatch.setattr(ct, "MMAP_THRESHOLD", mmap_threshold)
+    monkeypatch.setattr(ct, "_chunk_size", lambda st: 2**16)
+    path = tmpdir.join("big.dat")
+    path.write_binary(os.urandom(2**20))
+    progress = Progress(None)
+
+    # the bytes hashed so far, as each chunk is hashed
+    seen = []
+    class Hash:
+        def update(self, data):
+            seen.append(progress.bytes)
+    with pg.reading(progress):
+        ct.hash_file(path.strpath, Hash())
+    assert seen[0] == 0 and 0 < seen[len(seen) // 2] < 2**20
+    assert progress.bytes == 2**20 and progress.files == 0
+
+    # the file is only counted once when it is done
+    progress.add(path.strpath, 2**20, 0.1)
+    assert (progress.bytes, progress.files, progress.stats()["hashed_bytes"]) == (2**20, 1, 2**20)
@@ -0,0 +1,88 @@
+import os
+import shutil
+import argparse
+import pytest
+
+import catalogue.catalogue as ct
+from catalogue.manifest import ManifestWriter
+from catalogue.store import RecordStore, import_records, store_path
+
+
+def test_record_store(fixture2, tmpdir):
+
+    path = store_path(tmpdir.strpath)
+    record = ct.load_hash(fixture2)
+    with RecordStore(path) as store:
+        store.save(record, "20200428-141757")
+        assert "20200428-141757" in store
+        assert store.load("20200428-141757") == record
+        with pytest.raises(EOFError):
+            store.load("20200428-000000")
+        # saving the same record again changes nothing, but a different one cannot take its id
+        store.save(record, "20200428-141757")
+        assert store.find() == ["20200428-141757"]
+        with pytest.raises(AssertionError, match="A different record"):
+            store.save(dict(record, code={"code": "changed"}), "20200428-141757")
+        output_path = list(record["output_data"])[0]
+        with pytest.raises(AssertionError, match="A different record"):
+            store.save(dict(record, output_data={output_path: {"changed.txt": "sha512:0"}}), "20200428-141757")
+        assert store.load("20200428-141757") == record
+        assert store._db.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+    # a second process saving records at the same time
+    other = dict(record, input_data={"data": "def"}, timestamp={"engage": "20200429-100000",
+                                                                "disengage": "20200429-100005"})
+    store_1 = RecordStore(path)
+    store_2 = RecordStore(path)
+    store_2.save(other, "20200429-100005")
+    assert store_1.load("20200429-100005") == other
+    store_1.close()
+    store_2.close()
+
+    output_file, digest = sorted(list(record["output_data"].values())[0].items())[0]
+    with RecordStore(path) as store:
+        assert store.find(input_hash="abc") == ["20200428-141757"]
+        assert store.find(code_hash="xyz") == ["20200428-141757", "20200429-100005"]
+        assert store.find(code_hash="xyz", input_hash="def") == ["20200429-100005"]
+        assert store.find(output_digest=digest) == ["20200428-141757", "20200429-100005"]
+        assert store.find(since="20200429-000000") == ["20200429-100005"]
+        assert store.find(input_hash="missing") == []
+
+
+def test_record_store_streamed(nested_dir, tmpdir):
+
+    writer = ManifestWriter(os.path.join(tmpdir.strpath, "out.manifest.jsonl"))
+    record = {
+        "timestamp": {"engage": "200204-114300", "disengage": "200204-114329"},
+        "input_data": {"data": "sha512:0"},
+        "code": {"code": "0"},
+        "output_data": {nested_dir: ct.hash_output(nested_dir, manifest_writer=writer)},
+    }
+    writer.close()
+    record["output_manifest"] = {nested_dir: {"file": writer.path, "files": writer.files}}
+
+    with RecordStore(store_path(tmpdir.strpath)) as store:
+        store.save(record, "200204-114329")
+        assert store.load("200204-114329") == record
+        store.save(record, "200204-114329")
+        digest = ct.hash_dir_by_file(nested_dir)[os.path.join(nested_dir, "top.txt")]
+        assert store.find(output_digest=digest) == ["200204-114329"]
+
+
+def test_import_records(fixture1, fixture2, fixture4, tmpdir, capsys):
+
+    records = tmpdir.mkdir("records")
+    shutil.copy(fixture2, records.join("20200428-141757.json").strpath)
+    args = argparse.Namespace(sources=[records.strpath, fixture4], catalogue_results=tmpdir.strpath)
+    import_records(args)
+    assert "Imported 2 records" in capsys.readouterr().out
+
+    with RecordStore(store_path(tmpdir.strpath)) as store:
+        assert store.load("20200428-141757") == ct.load_hash(fixture2)
+        assert store.load("20200430-172025") == ct.load_csv(fixture4, "20200430-172025")
+
+    # records already in the store are skipped
+    args.sources.append(fixture1)
+    import_records(args)
+    assert "Imported 1 records into {}, skipped 2 already there".format(
+        store_path(tmpdir.strpath)) in capsys.readouterr().out
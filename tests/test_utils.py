@@ -23,6 +23,11 @@ def test_check_paths_exists(test_args):
     setattr(test_args, "output_data", 123)
     assert check_paths_exists(test_args) == False
 
+    # arguments that are not paths are skipped
+    setattr(test_args, "output_data", test_args.input_data)
+    setattr(test_args, "jobs", 4)
+    assert check_paths_exists(test_args) == True
+
 def test_read_config_file(good_config):
 
     dict = read_config_file(good_config)
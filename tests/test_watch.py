@@ -0,0 +1,196 @@
+import os
+import glob
+import json
+import time
+import threading
+import pytest
+
+import catalogue.catalogue as ct
+from catalogue import watch as wt
+from catalogue.engage import engage, disengage
+
+
+def _watched(watcher, change, timeout=2.0):
+    """
+    Make a change and return the paths the watcher reports afterwards.
+    """
+    change()
+    changed = set()
+    for _ in range(3):
+        changed.update(watcher.changes(timeout))
+    return changed
+
+
+def test_polling_watcher(nested_dir):
+
+    watcher = wt.PollingWatcher([nested_dir], interval=0)
+    assert watcher.changes(0) == []
+
+    path = os.path.join(nested_dir, "a", "a1.txt")
+    assert _watched(watcher, lambda: open(path, "a").write("more")) == {path}
+    new = os.path.join(nested_dir, "new.txt")
+    assert _watched(watcher, lambda: open(new, "w").write("new")) >= {new}
+    assert _watched(watcher, lambda: os.remove(new)) >= {new}
+
+
+@pytest.mark.skipif(wt._libc() is None, reason="inotify is not available")
+def test_inotify_watcher(nested_dir):
+
+    watcher = wt.InotifyWatcher([nested_dir])
+    try:
+        assert watcher.changes(0) == []
+        path = os.path.join(nested_dir, "a", "a1.txt")
+        assert path in _watched(watcher, lambda: open(path, "a").write("more"), 0.2)
+
+        # new directories are watched, and their files listed
+        new_dir = os.path.join(nested_dir, "new")
+        def make_dir():
+            os.makedirs(os.path.join(new_dir, "sub"))
+            open(os.path.join(new_dir, "sub", "early.txt"), "w").close()
+        assert {new_dir, os.path.join(new_dir, "sub", "early.txt")} <= _watched(watcher, make_dir, 0.2)
+        late = os.path.join(new_dir, "sub", "late.txt")
+        assert late in _watched(watcher, lambda: open(late, "w").close(), 0.2)
+    finally:
+        watcher.close()
+
+
+def _wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_watch_journal(nested_dir, tmpdir, monkeypatch):
+
+    journal = tmpdir.join("watch.journal").strpath
+    # signals can only be handled in the main thread, so stop the watcher by
+    # removing its lock instead
+    lock = tmpdir.join(".lock")
+    lock.write("")
+    thread = threading.Thread(target=wt.watch, args=([nested_dir], journal),
+                              kwargs={"lock": lock.strpath, "method": "polling", "interval": 0.05})
+    monkeypatch.setattr(wt.signal, "signal", lambda *args: None)
+    thread.start()
+    _wait_for(lambda: wt._read_journal(journal))
+    path = os.path.join(nested_dir, "top.txt")
+    with open(path, "a") as f:
+        f.write("more")
+    _wait_for(lambda: path in wt._read_journal(journal))
+    lock.remove()
+    thread.join(5)
+    lines = wt._read_journal(journal)
+    assert json.loads(lines[0])["method"] == "polling"
+    # stopped by removing the lock, so the journal is not complete
+    assert lines[-1] != wt.STOPPED
+
+
+def test_watchable(nested_dir, tmpdir, monkeypatch):
+
+    assert wt.watchable(nested_dir)
+    assert wt.watchable(os.path.join(nested_dir, "top.txt"))
+
+    outside = tmpdir.join("outside.txt")
+    outside.write("outside")
+    link = os.path.join(nested_dir, "a", "link.txt")
+    os.symlink(outside.strpath, link)
+    assert not wt.watchable(nested_dir)
+    os.remove(link)
+
+    os.link(outside.strpath, link)
+    assert not wt.watchable(nested_dir)
+    assert not wt.watchable(link)
+    os.remove(link)
+    assert wt.watchable(nested_dir)
+
+    monkeypatch.setattr(wt, "_filesystem", lambda path: "nfs4")
+    assert not wt.watchable(nested_dir)
+    monkeypatch.setattr(wt, "_filesystem", lambda path: None)
+    assert not wt.watchable(nested_dir)
+
+
+def test_changed_under(tmpdir):
+
+    data = tmpdir.join("data").strpath
+    assert wt.changed_under({os.path.join(data, "a", "b.txt")}, data)
+    assert wt.changed_under({data}, data)
+    assert wt.changed_under({tmpdir.strpath}, data)
+    assert not wt.changed_under({data + "2"}, data)
+    assert not wt.changed_under(set(), data)
+
+
+def test_engage_watch(git_repo, test_args, nested_dir, monkeypatch, capsys):
+    """
+    NOTE: the catalogue_results directory and files are created in CWD
+    """
+    # input data outside the code repository, so that changing it does not
+    # leave the repository dirty
+    setattr(test_args, "input_data", nested_dir)
+    setattr(test_args, "watch", True)
+    results_path = os.path.join(git_repo, "results")
+    hashed = []
+    hash_input = ct.hash_input
+    monkeypatch.setattr(ct, "hash_input", lambda *args, **kwargs: hashed.append(args[0]) or
+                        hash_input(*args, **kwargs))
+
+    # unchanged input data is not hashed again
+    engage(test_args)
+    assert os.path.exists(os.path.join("catalogue_results", wt.PID_NAME))
+    assert ct.load_hash(os.path.join("catalogue_results", ".lock"))["watch"]
+    setattr(test_args, "command", "disengage")
+    setattr(test_args, "output_data", results_path)
+    disengage(test_args)
+    assert len(hashed) == 1
+    output_file = glob.glob("catalogue_results/*.json")
+    assert len(output_file) == 1
+    assert "watch" not in ct.load_hash(output_file[0])
+    assert sorted(os.listdir("catalogue_results")) == [os.path.basename(output_file[0])]
+    os.remove(output_file[0])
+
+    # changed input data is hashed again, and found to differ
+    setattr(test_args, "command", "engage")
+    engage(test_args)
+    with open(os.path.join(test_args.input_data, "new.txt"), "w") as f:
+        f.write("new")
+    setattr(test_args, "command", "disengage")
+    disengage(test_args)
+    assert len(hashed) == 3
+    assert glob.glob("catalogue_results/*.json") == []
+    assert "input_data" in capsys.readouterr().out
+
+    # a file reached through a symlink can change without the watcher seeing
+    # it, so the input data is hashed again
+    outside = os.path.join(os.path.dirname(nested_dir), "outside.txt")
+    with open(outside, "w") as f:
+        f.write("outside")
+    os.symlink(outside, os.path.join(nested_dir, "link.txt"))
+    setattr(test_args, "command", "engage")
+    engage(test_args)
+    assert "will be hashed again at disengage" in capsys.readouterr().out
+    assert not os.path.exists(os.path.join("catalogue_results", wt.PID_NAME))
+    with open(outside, "a") as f:
+        f.write("changed")
+    setattr(test_args, "command", "disengage")
+    disengage(test_args)
+    assert len(hashed) == 5
+    assert glob.glob("catalogue_results/*.json") == []
+    assert "input_data" in capsys.readouterr().out
+
+    # a hard link made outside the input data after engage is found at
+    # disengage, even if the watcher missed it
+    os.remove(os.path.join(nested_dir, "link.txt"))
+    setattr(test_args, "command", "engage")
+    engage(test_args)
+    assert os.path.exists(os.path.join("catalogue_results", wt.PID_NAME))
+    os.link(os.path.join(nested_dir, "top.txt"), os.path.join(os.path.dirname(nested_dir), "linked.txt"))
+    monkeypatch.setattr("catalogue.engage.stop_watcher",
+                        lambda catalogue_results: wt.stop_watcher(catalogue_results) and set())
+    setattr(test_args, "command", "disengage")
+    disengage(test_args)
+    assert len(hashed) == 7
+    output_file = glob.glob("catalogue_results/*.json")
+    assert len(output_file) == 1
+    os.remove(output_file[0])
+
+    # clean up: delete files created in CWD
+    os.rmdir("catalogue_results")